@@ -0,0 +1,150 @@
+# ==============================================================================
+# This file attributes the failed trials of a campaign to kernel symbols. The
+# flips of every trial (results.py) are joined with the crash of the trial:
+# the faulting PC and the call trace of the oops in the console log (see
+# console.crash_report), or the PC of `info registers` when the guest was
+# paused by its panic.
+#
+# Every flipped physical address is mapped to its kernel symbol with one
+# NumPy searchsorted over the symbol intervals (ksyms.SymbolIndex.lookup_array),
+# never with a gdb `info symbol` per address. A failed trial then counts once:
+#   - for the symbols of its flips that are on the crash path (the PC or a
+#     frame of the call trace), split evenly between them, or
+#   - split evenly between the symbols of all its flips when none is.
+# Symbols are ranked by this contribution, next to the number of their flips,
+# the flips in failed trials and the flips found on a crash path.
+#
+# The crash of a trial is printed as a "Crash <n>: pc=<frame> trace=<frames>"
+# line by snapinject and snapinject_ram, results.py ingests it with the
+# "Trial <n>: <label>" lines, campaign.py stores it directly.
+#
+# Usage: python3 attribution.py results.db --symbol-map System.map [--iomem iomem.txt]
+#
+# Note: ranking runs in Host machine, the gdb side only uses register_pc and
+# crash_line (standard library only).
+# ==============================================================================
+
+import re
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# the PC in `info registers`: PC=... on arm64, RIP=... on x86_64, EIP=... on i386
+REGISTER_PC = re.compile(r"\b(?:PC|RIP|EIP)=([0-9a-fA-F]+)")
+CRASH_LINE = re.compile(r"^Crash (\d+): pc=(\S+) trace=(\S*)\s*$")
+# pc of a crash line without any PC
+NO_PC = "?"
+# rows of the flips table read at once
+BATCH = 1 << 18
+NO_SYMBOL = "(no symbol)"
+
+def register_pc(output):
+    """The PC of the first CPU in the output of `info registers` as a "0x..." frame, None if there is none"""
+    match = REGISTER_PC.search(output or "")
+    return "0x%x" % int(match.group(1), 16) if match else None
+
+def crash_line(trial, pc, backtrace):
+    return "Crash %d: pc=%s trace=%s" % (trial, pc or NO_PC, ",".join(backtrace))
+
+def parse_crash_line(line):
+    """(trial, pc, backtrace) of a crash line, None for other lines"""
+    match = CRASH_LINE.match(line)
+    if not match:
+        return None
+    pc = match.group(2)
+    return int(match.group(1)), None if pc == NO_PC else pc, [frame for frame in match.group(3).split(",") if frame]
+
+def frame_symbol(frame, symbol_index):
+    """Symbol name of a "symbol+0xoffset" or "0x<virtual address>" frame, None outside all symbols"""
+    if frame.startswith("0x"):
+        symbol = symbol_index.lookup(int(frame, 16))
+        return symbol[0] if symbol else None
+    return frame.split("+")[0]
+
+def read_flips(db):
+    """(trial, physical address, failed) arrays of the ram flips of a results.py database, read BATCH rows at a time.
+    Trials are numbered by their row in the trials table, unique across runs, -1 for flips of an unknown trial."""
+    cursor = db.execute("SELECT COALESCE(trials.rowid, -1), address, flips.failed FROM flips "
+                        "LEFT JOIN trials USING (run, trial) WHERE kind = 'ram' AND address IS NOT NULL")
+    chunks = []
+    for rows in iter(lambda: cursor.fetchmany(BATCH), []):
+        chunks.append(numpy.array(rows, dtype=numpy.int64).reshape(-1, 3))
+    flips = numpy.concatenate(chunks) if chunks else numpy.zeros((0, 3), dtype=numpy.int64)
+    # addresses are stored as signed 64 bit integers
+    return flips[:, 0], flips[:, 1].view(numpy.uint64), flips[:, 2].astype(bool)
+
+def attribute(db, symbol_index, offset):
+    """
+    Rank the kernel symbols by their contribution to the failed trials of a results.py database.
+
+    :param symbol_index: ksyms.SymbolIndex of the guest kernel
+    :param offset: physical - virtual address of the kernel image, see ksyms.kernel_offset
+    :return: ([(symbol, contribution, flips on a crash path, flips in failed trials, flips)] by contribution,
+              [(symbol, crashes)] of the crash PCs by count, failed trials with ram flips)
+    """
+    trials, addresses, failed = read_flips(db)
+    # one id per symbol name, 0 is no symbol
+    ids = {NO_SYMBOL: 0}
+    name_ids = numpy.array([ids.setdefault(name, len(ids)) for name in symbol_index.names] + [0], dtype=numpy.int64)
+    virtual = addresses - numpy.uint64(offset % (1 << 64))
+    # -1 outside all symbols picks the trailing 0
+    symbols = name_ids[symbol_index.lookup_array(virtual)]
+
+    # (trial, symbol id) pairs of every crash path
+    path_keys = []
+    sites = {}
+    for trial, pc, backtrace in db.execute("SELECT COALESCE(trials.rowid, -1), pc, backtrace FROM crashes "
+                                           "LEFT JOIN trials USING (run, trial)"):
+        frames = ([pc] if pc else []) + (backtrace.split(",") if backtrace else [])
+        names = {frame_symbol(frame, symbol_index) for frame in frames}
+        path_keys += [trial * len(ids) + ids[name] for name in names if name in ids]
+        site = frame_symbol(pc, symbol_index) if pc else None
+        sites[site or NO_SYMBOL] = sites.get(site or NO_SYMBOL, 0) + 1
+
+    on_path = failed & (symbols > 0) & numpy.isin(trials * len(ids) + symbols, numpy.array(path_keys, dtype=numpy.int64))
+    # every failed trial is split between its flips on the crash path, or between all its flips
+    failed_trials, inverse = numpy.unique(trials[failed], return_inverse=True)
+    flip_counts = numpy.bincount(inverse)
+    path_counts = numpy.bincount(inverse, weights=on_path[failed])
+    weights = numpy.where(path_counts[inverse] > 0, on_path[failed] / numpy.maximum(path_counts[inverse], 1),
+                          1 / flip_counts[inverse])
+
+    contribution = numpy.bincount(symbols[failed], weights=weights, minlength=len(ids))
+    implicated = numpy.bincount(symbols[on_path], minlength=len(ids))
+    failed_flips = numpy.bincount(symbols[failed], minlength=len(ids))
+    flips = numpy.bincount(symbols, minlength=len(ids))
+    names = list(ids)
+    ranked = [(names[i], float(contribution[i]), int(implicated[i]), int(failed_flips[i]), int(flips[i]))
+              for i in numpy.argsort(-contribution, kind="stable") if flips[i]]
+    return ranked, sorted(sites.items(), key=lambda site: -site[1]), len(failed_trials)
+
+if __name__ == '__main__':
+    import argparse
+    import sqlite3
+    import time
+    import iomem
+    import ksyms
+
+    parser = argparse.ArgumentParser(description="Rank kernel symbols by their contribution to the failed trials")
+    parser.add_argument("database", help="results.py database")
+    parser.add_argument("--symbol-map", default="System.map", help="System.map or vmlinux of the guest kernel")
+    parser.add_argument("--iomem", default="iomem.txt")
+    parser.add_argument("--offset", type=lambda x: int(x, 0), help="physical - virtual address of the kernel image")
+    parser.add_argument("--limit", type=int, default=20)
+    args = parser.parse_args()
+
+    st = time.time()
+    index = ksyms.load(args.symbol_map)
+    offset = args.offset if args.offset is not None else ksyms.kernel_offset(index, iomem.load(args.iomem))
+    ranked, sites, crashes = attribute(sqlite3.connect(args.database), index, offset)
+    print(f"{crashes} failed trials with ram flips, {sum(row[4] for row in ranked)} ram flips")
+    print("symbol: contribution, flips on a crash path, flips in failed trials, flips")
+    for name, contribution, implicated, failed_flips, flips in ranked[:args.limit]:
+        share = contribution / crashes * 100 if crashes else 0.0
+        print(f"  {name}: {contribution:.2f} ({share:.1f}%), {implicated}, {failed_flips}, {flips}")
+    print("crash sites:")
+    for name, count in sites[:args.limit]:
+        print(f"  {name}: {count}")
+    print(f"attribution took {time.time() - st:.3f}s")
@@ -0,0 +1,335 @@
+# ==============================================================================
+# This file holds the benchmarks of the host side scripts.
+#
+# The injection benchmarks run every flip path against a local fake VM
+# (fakestub.py), so they need no QEMU:
+#   rsp        RspSession, the gdb remote protocol spoken from python
+#   pygdbmi    FlipSession, one gdb driven through pygdbmi
+#   gdbsh      flip_bit without session, one ./gdb.sh process per flip
+#   gdbpython  `benchinject` of gdb/fliputils.py inside gdb
+#   qmp        savevm/loadvm over the QMP socket
+# Every path reports per-flip latency percentiles, flips/s and the mean cost
+# of its phases (connect, stop, read, write, verify, cont, detach, savevm,
+# loadvm). The gdb paths are skipped when there is no gdb binary.
+#
+# Usage: python3 bench.py [--flips 1000] [--paths rsp,qmp] [--save out.json]
+#                         [--compare baseline.json [--tolerance 0.25]]
+# ==============================================================================
+
+import asyncio
+import collections
+import contextlib
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from countpanic import parse_json_objects
+from fakestub import FakeGdbStub, FakeQmpServer
+from qmp import READ_SIZE, QmpClient, QmpDecoder
+from rsp import RspSession
+from snapshot import SnapshotPool
+
+REPO = os.path.dirname(os.path.abspath(__file__))
+# the port gdb.sh attaches to
+GDBSH_PORT = 1234
+# savevm/loadvm rounds of every path
+SNAPSHOTS = 5
+PATHS = ("rsp", "pygdbmi", "gdbsh", "gdbpython", "qmp")
+
+def qmp_event_stream(events):
+    """A QMP byte stream of `events` events, like a STOP/RESUME storm with some larger events in between"""
+    lines = []
+    for i in range(events):
+        if i % 100 == 0:
+            event = {"event": "BLOCK_IO_ERROR", "data": {"device": "virtio0", "node-name": "#block123",
+                     "operation": "write", "action": "report", "nospace": False, "reason": "Input/output error"}}
+        else:
+            event = {"event": "STOP" if i % 2 else "RESUME"}
+        event["timestamp"] = {"seconds": 1729000000 + i, "microseconds": i % 1000000}
+        lines.append(json.dumps(event).encode() + b"\r\n")
+    return b"".join(lines)
+
+def bench_qmp_decoder(events=100000):
+    """Feed `events` QMP events to QmpDecoder in READ_SIZE chunks and to parse_json_objects in 1024 byte chunks"""
+    stream = qmp_event_stream(events)
+
+    st = time.time()
+    decoder = QmpDecoder()
+    count = 0
+    for offset in range(0, len(stream), READ_SIZE):
+        count += len(decoder.feed(stream[offset:offset + READ_SIZE]))
+    et = time.time()
+    assert count == events, "decoded %d of %d events" % (count, events)
+    print("QmpDecoder: %d events, %.1f MB in %.3fs, %.0f events/s" % (events, len(stream) / 1e6, et - st, events / (et - st)))
+
+    st = time.time()
+    buffer = ""
+    count = 0
+    for offset in range(0, len(stream), 1024):
+        buffer += stream[offset:offset + 1024].decode()
+        results, buffer = parse_json_objects(buffer)
+        count += len(results)
+    et = time.time()
+    assert count == events, "parsed %d of %d events" % (count, events)
+    print("parse_json_objects: %d events in %.3fs, %.0f events/s" % (events, et - st, events / (et - st)))
+
+class PhaseTimer:
+    """Collects the samples of named phases in seconds"""
+    def __init__(self):
+        self.samples = collections.defaultdict(list)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        st = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.samples[name].append(time.perf_counter() - st)
+
+def percentile(values, q):
+    """q-th percentile (0-100) of values, nearest rank"""
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(q / 100 * len(ordered)) - 1))]
+
+def summarize(samples, flips=None):
+    """
+    Summarize {phase: [seconds]}, phase "flip" holds the latency of whole flips.
+    Return {"flips", "flips_per_sec", "latency": {"p50", "p90", "p99", "max"}, "phases": {phase: mean}}
+    """
+    summary = {"phases": {phase: sum(values) / len(values) for phase, values in samples.items() if values and phase != "flip"}}
+    latency = samples.get("flip")
+    if latency:
+        summary["flips"] = flips or len(latency)
+        summary["flips_per_sec"] = len(latency) / sum(latency)
+        summary["latency"] = {f"p{q}": percentile(latency, q) for q in (50, 90, 99)}
+        summary["latency"]["max"] = max(latency)
+    return summary
+
+def flip_targets(stub, flips, seed=0):
+    """(address, bit) of flips random bytes of the fake RAM"""
+    rng = random.Random(seed)
+    return [(stub.ram_base + rng.randrange(len(stub.ram)), rng.randrange(8)) for _ in range(flips)]
+
+def bench_snapshots(timer, hmp):
+    for _ in range(SNAPSHOTS):
+        for action in ("savevm", "loadvm"):
+            with timer.phase(action):
+                hmp(f"{action} bench")
+    hmp("delvm bench")
+
+def bench_session(session, stub, flips, timer, steps):
+    """
+    Time session.flip for every flip, then the steps of the same flips one by one.
+    steps is {phase: function(address, bit)} in the order of a flip.
+    """
+    with timer.phase("connect"):
+        session.attach()
+    targets = flip_targets(stub, flips)
+    for address, bit in targets:
+        with timer.phase("flip"):
+            session.flip(address, bit)
+    for address, bit in targets:
+        for phase, step in steps.items():
+            with timer.phase(phase):
+                step(address, bit)
+    bench_snapshots(timer, session.monitor)
+    with timer.phase("detach"):
+        session.close()
+    return timer.samples
+
+def bench_rsp(stub, flips):
+    session = RspSession(port=stub.port)
+    client = session.client
+    state = {}
+
+    def read(address, bit):
+        state["old"] = client.read_memory(address, 1)[0]
+
+    steps = {"stop": lambda address, bit: client.monitor("stop"),
+             "read": read,
+             "write": lambda address, bit: client.write_memory(address, bytes((state["old"] ^ (1 << bit),))),
+             "verify": lambda address, bit: client.read_memory(address, 1),
+             "cont": lambda address, bit: client.monitor("cont")}
+    return bench_session(session, stub, flips, PhaseTimer(), steps)
+
+def bench_pygdbmi(stub, flips):
+    from fliputils import FlipSession
+    session = FlipSession(address=f"localhost:{stub.port}")
+    state = {}
+
+    def read(address, bit):
+        state["old"] = session.read_byte(address)
+
+    steps = {"stop": lambda address, bit: session.console("monitor stop"),
+             "read": read,
+             "write": lambda address, bit: session.command(f"-data-write-memory-bytes 0x{address:x} {state['old'] ^ (1 << bit):02x}"),
+             "verify": lambda address, bit: session.read_byte(address),
+             "cont": lambda address, bit: session.console("monitor cont")}
+    return bench_session(session, stub, flips, PhaseTimer(), steps)
+
+def run_gdbsh(commands):
+    """Run gdb.sh once with commands as gdb_command.txt, return the seconds it took"""
+    with open(os.path.join(REPO, "gdb_command.txt"), "w") as f:
+        f.writelines(command + "\n" for command in commands)
+    st = time.perf_counter()
+    subprocess.run(["./gdb.sh"], cwd=REPO, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return time.perf_counter() - st
+
+def bench_gdbsh(stub, flips):
+    """
+    Every gdb.sh run connects and detaches, so the phases are the differences of the mean run time with more and more
+    of the flip commands in gdb_command.txt.
+    """
+    from fliputils import flip_bit
+    timer = PhaseTimer()
+    targets = flip_targets(stub, flips)
+    cwd = os.getcwd()
+    os.chdir(REPO)
+    try:
+        for address, bit in targets:
+            with timer.phase("flip"):
+                flip_bit(address, bit, "bench")
+    finally:
+        os.chdir(cwd)
+
+    address, bit = targets[0]
+    steps = [("connect", None), ("read", f"x/bx 0x{address:x}"), ("write", f"set *(char *)0x{address:x}^=1<<{bit}"),
+             ("verify", f"x/bx 0x{address:x}")]
+    commands, previous = [], 0.0
+    rounds = max(1, min(flips, 20))
+    for phase, command in steps:
+        if command:
+            commands.append(command)
+        mean = sum(run_gdbsh(commands) for _ in range(rounds)) / rounds
+        # connect includes the detach, gdb.sh always does both
+        timer.samples[phase].append(mean - previous)
+        previous = mean
+    for action in ("savevm", "loadvm"):
+        mean = sum(run_gdbsh([f"monitor {action} bench"]) for _ in range(SNAPSHOTS)) / SNAPSHOTS
+        timer.samples[action].append(mean - timer.samples["connect"][0])
+    run_gdbsh(["monitor delvm bench"])
+    return timer.samples
+
+def bench_gdbpython(stub, flips):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        output = os.path.join(tmpdir, "samples.json")
+        st = time.perf_counter()
+        subprocess.run(["gdb", "-q", "-nx", "-batch", "-ex", f"target remote localhost:{stub.port}",
+                        "-ex", "maintenance packet Qqemu.PhyMemMode:1", "-x", os.path.join(REPO, "gdb", "fliputils.py"),
+                        "-ex", f"benchinject {flips} {output}", "-ex", "detach"],
+                       check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        elapsed = time.perf_counter() - st
+        with open(output) as f:
+            samples = json.load(f)
+    # gdb start, connect, memory map, flips and detach
+    samples["gdb run"] = [elapsed]
+    return samples
+
+def bench_qmp(stub, qmp_path):
+    timer = PhaseTimer()
+
+    async def run():
+        client = QmpClient(qmp_path)
+        with timer.phase("connect"):
+            await client.connect()
+        # only load_qmp of the pool is used, the snapshot is made over qmp below
+        pool = SnapshotPool(client.hmp)
+        pool.snapshots["bench"] = {"persistent": True, "save": [0, 0.0, 0.0], "load": [0, 0.0, 0.0]}
+        for _ in range(SNAPSHOTS):
+            with timer.phase("savevm"):
+                await client.hmp("savevm bench")
+            with timer.phase("loadvm"):
+                await client.hmp("loadvm bench")
+            with timer.phase("snapshot-load"):
+                await pool.load_qmp("bench", client)
+        await client.hmp("delvm bench")
+        with timer.phase("detach"):
+            await client.close()
+
+    asyncio.run(run())
+    return timer.samples
+
+def bench_injection(flips=1000, paths=PATHS):
+    """Run the injection paths against fresh fake VMs, return {path: summary or {"skipped": reason}}"""
+    results = {}
+    for path in paths:
+        if path in ("pygdbmi", "gdbsh", "gdbpython") and shutil.which("gdb") is None:
+            results[path] = {"skipped": "no gdb binary"}
+            continue
+        port = GDBSH_PORT if path == "gdbsh" else 0
+        try:
+            stub = FakeGdbStub(port).start()
+        except OSError as e:
+            results[path] = {"skipped": f"port {port}: {e.strerror}"}
+            continue
+        qmp_server = FakeQmpServer(os.path.join(tempfile.gettempdir(), f"benchqmp{os.getpid()}.sock"), stub).start()
+        try:
+            # the flip paths print every flip
+            with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+                if path == "qmp":
+                    samples = bench_qmp(stub, qmp_server.path)
+                else:
+                    samples = globals()[f"bench_{path}"](stub, flips)
+            results[path] = summarize(samples, flips)
+        finally:
+            qmp_server.stop()
+            stub.stop()
+    return results
+
+def print_results(results):
+    for path, summary in results.items():
+        if "skipped" in summary:
+            print(f"{path:>10}: skipped, {summary['skipped']}")
+            continue
+        line = f"{path:>10}:"
+        if "latency" in summary:
+            latency = summary["latency"]
+            line += (f" {summary['flips_per_sec']:9.0f} flips/s  p50 {latency['p50'] * 1e6:8.1f} us"
+                     f"  p90 {latency['p90'] * 1e6:8.1f} us  p99 {latency['p99'] * 1e6:8.1f} us  max {latency['max'] * 1e6:8.1f} us")
+        print(line)
+        print(" " * 12 + ", ".join(f"{phase} {mean * 1e6:.1f} us" for phase, mean in summary["phases"].items()))
+
+def compare(results, baseline, tolerance):
+    """Return the regressions of results against baseline, a p50 latency or phase mean more than tolerance slower"""
+    regressions = []
+    for path, summary in results.items():
+        old = baseline.get(path, {})
+        if "skipped" in summary or "skipped" in old:
+            continue
+        pairs = [("p50", summary.get("latency", {}).get("p50"), old.get("latency", {}).get("p50"))]
+        pairs += [(phase, mean, old.get("phases", {}).get(phase)) for phase, mean in summary["phases"].items()]
+        for name, new, before in pairs:
+            if new is not None and before and new > before * (1 + tolerance):
+                regressions.append(f"{path} {name}: {before * 1e6:.1f} us -> {new * 1e6:.1f} us")
+    return regressions
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Benchmark the flip paths against a fake VM and the QMP decoder")
+    parser.add_argument("--flips", type=int, default=1000, help="flips per path")
+    parser.add_argument("--paths", default=",".join(PATHS), help="comma separated, from " + ",".join(PATHS))
+    parser.add_argument("--save", help="write the results as json")
+    parser.add_argument("--compare", help="json results of an earlier run, exit with 1 if a path got slower")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed slowdown for --compare")
+    parser.add_argument("--no-decoder", action="store_true", help="skip the QMP decoder benchmark")
+    args = parser.parse_args()
+
+    if not args.no_decoder:
+        bench_qmp_decoder(100000)
+    results = bench_injection(args.flips, args.paths.split(","))
+    print_results(results)
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=1)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print("regression: " + regression)
+        sys.exit(1 if regressions else 0)
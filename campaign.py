@@ -0,0 +1,549 @@
+# ==============================================================================
+# This file runs a fault injection campaign on several VMs in parallel.
+# Every worker process owns one QEMU instance (its gdb port, QMP socket and
+# baseline snapshot) and takes trials from a shared queue. A trial injects
+# fault_number flips, observes the VM and reverts it to the baseline snapshot,
+# the outcomes of all workers are merged like the panic count of count_panic.
+#
+# Only the steps that touch the guest (inject, observe, revert) run one after
+# the other. The revert is awaited over QMP (snapshot-load job if QEMU has it)
+# while the worker reports the finished trial and plans the next one, the
+# per-phase timings of every trial show what is left of the host stall.
+#
+# With the console log of a VM (`| tee <file>`, third field of --vm) every
+# trial is also labeled crash/oops/hang/SDC/benign, see console.py. The crash
+# of a failed trial (PC and call trace of the oops, or the PC of `info
+# registers` after a panic) is kept for attribution.py.
+#
+# Record/replay: --record writes a manifest (JSON lines) with the settings and
+# seed, then per trial its plan records, outcome and the guest instruction
+# count of every flip. The counts come from `info replay` when QEMU records
+# (`-icount shift=auto,rr=record,rrfile=<file>`), they are null otherwise.
+# The baseline snapshot is kept, and --replay <manifest> --trial <n> runs that
+# one trial again from it. Every trial reverts to the same baseline, but the
+# recording goes on, so on a recording QEMU every trial also saves a snapshot
+# <baseline>_rr<n> before its flips (one vm state per trial, plan the disk or
+# tmpfs for it) and the manifest names it. On a QEMU replaying the recording
+# (`rr=replay,rrfile=<file>`) loading that snapshot puts the replay at the
+# start of trial n, and every flip is injected at its recorded instruction
+# count with `replay_break`, otherwise after the recorded intervals.
+#
+# --results <database> adds every trial and its flips to a results.py store,
+# as a run named after the --record manifest or a generated one. Unlike
+# --record it neither delays the flips nor keeps the baseline snapshot.
+#
+# --target-width <w> makes --trials the maximum: no new trial starts once the
+# confidence interval of the failure rate (--per-area: of every iomem area hit)
+# is at most w wide, the estimate is printed after every trial, see estimate.py.
+#
+# Usage: python3 campaign.py --vm 1234:/tmp/qmp0.sock --vm 1235:/tmp/qmp1.sock --trials 1000
+#        python3 campaign.py --fake 4 --trials 100     (local fake VMs, no QEMU)
+#        python3 campaign.py --vm 1234:/tmp/qmp0.sock --trials 1000 --record run.jsonl
+#        python3 campaign.py --vm 1234:/tmp/qmp0.sock --replay run.jsonl --trial 417
+#        python3 campaign.py --vm 1234:/tmp/qmp0.sock --trials 1000 --results results.db
+#        python3 campaign.py --vm 1234:/tmp/qmp0.sock --trials 10000 --target-width 0.02 --per-area
+#
+# Note: This file should run in Host machine.
+# ==============================================================================
+
+import asyncio
+import collections
+import json
+import multiprocessing
+import queue
+import re
+import time
+
+import numpy
+
+import plan
+from attribution import register_pc
+from console import OBSERVE_POLL_SEC, ConsoleClassifier
+from qmp import FAILURE_EVENTS, QmpClient
+from rsp import RspSession
+from snapshot import DEFAULT_TMPFS, SnapshotPool
+
+class Vm:
+    def __init__(self, gdb_port, qmp_path, snapname="campaign_begin", gdb_host="localhost", tmpfs=None, console=None):
+        """
+        :param gdb_port: port of the qemu gdb server, qemu option `-gdb tcp::<port>`
+        :param qmp_path: qmp socket file, qemu option `-qmp unix:<path>,server,nowait`
+        :param snapname: baseline snapshot the worker creates and reverts to after every trial
+        :param tmpfs: directory of the disk overlay, the baseline is then kept for later campaigns (see snapshot.py)
+        :param console: console log file of the vm, written by `| tee <file>`"""
+        self.gdb_host = gdb_host
+        self.gdb_port = gdb_port
+        self.qmp_path = qmp_path
+        self.snapname = snapname
+        self.tmpfs = tmpfs
+        self.console = console
+
+    def __repr__(self):
+        return f"Vm({self.gdb_host}:{self.gdb_port}, {self.qmp_path})"
+
+class TrialSettings:
+    def __init__(self, fault_number, min_interval, max_interval, observe_time, ranges, seed=0, golden=None, record=False,
+                 keep_flips=False):
+        """
+        :param min_interval: nanoseconds between two flips of a trial
+        :param max_interval: nanoseconds between two flips of a trial
+        :param observe_time: seconds to observe the VM after the flips
+        :param ranges: inclusive (start, end) physical address ranges to flip in
+        :param seed: campaign seed, the flips of trial i only depend on (seed, i)
+        :param golden: result of the workload in a fault free run, see console.ConsoleClassifier
+        :param record: results carry the flips and their instruction counts, the baseline snapshot is kept
+        :param keep_flips: results carry the flips, injection and snapshots are unchanged"""
+        self.fault_number = fault_number
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.observe_time = observe_time
+        self.ranges = ranges
+        self.seed = seed
+        self.golden = golden
+        self.record = record
+        self.keep_flips = keep_flips
+
+    def plan(self, trial):
+        return plan.generate(self.fault_number, self.min_interval, self.max_interval, self.ranges, seed=[self.seed, trial])
+
+# phases of a trial in the result timings, in seconds
+PHASES = ("savevm", "inject", "observe", "revert", "analysis", "prepare", "stall")
+# a replayed guest has to reach the instruction count of the next flip within this many seconds
+REPLAY_TIMEOUT = 60
+# how often a replayed guest is checked for the stop at a flip
+REPLAY_POLL_SEC = 0.001
+
+class VmWorker:
+    """Runs the trials of one VM, over one gdb remote protocol session and one QMP connection"""
+    def __init__(self, vm: Vm, settings: TrialSettings, replay=False):
+        """
+        :param replay: the vm starts from the kept baseline of a recorded campaign instead of a new one"""
+        self.vm = vm
+        self.settings = settings
+        self.replay = replay
+        self.session = RspSession(vm.gdb_host, vm.gdb_port)
+        self.qmp = QmpClient(vm.qmp_path)
+        self.console = None
+        self.pool = None
+        # events seen during the current trial
+        self.events = collections.Counter()
+        self.failed = None
+        self.failed_at = None
+        # QEMU records the execution, every trial saves where its replay starts
+        self.recording = False
+
+    def on_event(self, message):
+        self.events[message["event"]] += 1
+        if message["event"] in FAILURE_EVENTS:
+            self.fail()
+
+    def fail(self):
+        if not self.failed.is_set():
+            self.failed_at = time.time()
+            self.failed.set()
+
+    async def watch_console(self):
+        """End the observation when the console shows a failure"""
+        while not self.failed.is_set():
+            if self.console.failure(self.console.classify()):
+                self.fail()
+                return
+            await asyncio.sleep(OBSERVE_POLL_SEC)
+
+    async def start(self):
+        self.failed = asyncio.Event()
+        self.qmp.on("*", self.on_event)
+        await self.qmp.connect()
+        if self.vm.console:
+            self.console = ConsoleClassifier(self.vm.console, golden=self.settings.golden)
+        self.session.attach()
+        self.pool = SnapshotPool(self.session.monitor, self.vm.tmpfs)
+        if self.replay:
+            self.pool.adopt(self.vm.snapname)
+            self.pool.load(self.vm.snapname)
+        elif self.vm.tmpfs or self.settings.record:
+            # a recorded baseline outlives the campaign for replays
+            self.pool.baseline(self.vm.snapname)
+        else:
+            self.pool.save(self.vm.snapname)
+        self.recording = self.settings.record and not self.replay and \
+            self.session.monitor("info replay").startswith("Recording")
+
+    def icount(self):
+        """Instruction count of the guest from `info replay`, None when QEMU does not record or replay"""
+        match = re.search(r"instruction count = (\d+)", self.session.monitor("info replay"))
+        return int(match.group(1)) if match else None
+
+    def wait_paused(self):
+        deadline = time.time() + REPLAY_TIMEOUT
+        while "running" in self.session.monitor("info status"):
+            if time.time() > deadline:
+                raise TimeoutError(f"{self.vm} did not reach the recorded instruction count")
+            time.sleep(REPLAY_POLL_SEC)
+
+    def inject(self, flips, icounts=None):
+        """
+        Flip the plan records in order, after their intervals. Return the instruction count of every flip when
+        settings.record is set. With the icounts of a recorded trial and a replaying QEMU, every flip is injected at
+        its recorded instruction count instead.
+        """
+        replaying = bool(icounts) and None not in icounts and self.session.monitor("info replay").startswith("Replaying")
+        if replaying:
+            self.session.monitor("stop")
+            self.session.monitor(f"replay_break {icounts[0]}")
+            self.session.monitor("cont")
+        counts = []
+        last = 0
+        for i, record in enumerate(flips):
+            if replaying:
+                self.wait_paused()
+                # the guest is stopped, the next break cannot be passed before it is set
+                if i + 1 < len(flips):
+                    self.session.monitor(f"replay_break {icounts[i + 1]}")
+            else:
+                time.sleep((int(record["time"]) - last) * 1e-9)
+            last = int(record["time"])
+            if self.settings.record:
+                self.session.monitor("stop")
+                counts.append(self.icount())
+            address, bit = int(record["address"]), int(record["bit"])
+            self.session.flip(address + bit // 8, bit % 8)
+        return counts
+
+    def outcome(self, events):
+        if events["GUEST_PANICKED"]:
+            return "panic"
+        if events["SHUTDOWN"]:
+            return "shutdown"
+        return "ok"
+
+    def label(self, events):
+        """crash, oops, hang, SDC or benign, see console.py"""
+        label = self.console.end() if self.console else "benign"
+        if events["GUEST_PANICKED"] or events["SHUTDOWN"]:
+            return "crash"
+        return label
+
+    def prepare(self, trials):
+        """Take the next trial from the queue and plan its flips, runs in an executor thread.
+        Return (trial, flips, seconds), trial is None when the queue is done."""
+        trial = trials.get()
+        st = time.perf_counter()
+        flips = self.settings.plan(trial) if trial is not None else None
+        return trial, flips, time.perf_counter() - st
+
+    async def revert(self, panicked):
+        st = time.perf_counter()
+        await self.pool.load_qmp(self.vm.snapname, self.qmp)
+        if panicked:
+            # a panicked guest is paused, loading a snapshot only resumes a running vm
+            await self.qmp.cont()
+        return time.perf_counter() - st
+
+    async def run_trial(self, trial, flips, icounts=None):
+        """Inject and observe trial, return (result, events of the trial). icounts replays a recorded trial."""
+        self.events.clear()
+        self.failed.clear()
+        timings = {"savevm": 0.0}
+        snapshot = None
+        if self.recording:
+            # the baseline restores the guest, not the position in the recording
+            snapshot = f"{self.vm.snapname}_rr{trial}"
+            if snapshot in self.pool.snapshots:
+                self.pool.delete(snapshot)
+            timings["savevm"] = self.pool.save(snapshot, persistent=True)
+        if self.console:
+            self.console.begin(trial)
+        started = time.time()
+        st = time.perf_counter()
+        counts = self.inject(flips, icounts)
+        timings["inject"] = time.perf_counter() - st
+        watcher = asyncio.ensure_future(self.watch_console()) if self.console else None
+        try:
+            # the observation ends early when the guest panics or shuts down
+            await asyncio.wait_for(self.failed.wait(), self.settings.observe_time)
+        except asyncio.TimeoutError:
+            pass
+        if watcher:
+            watcher.cancel()
+        # let the reader task handle the events that already arrived
+        await asyncio.sleep(0)
+        timings["observe"] = time.perf_counter() - st - timings["inject"]
+        failure_time = self.failed_at - started if self.failed.is_set() else None
+        result = {"trial": trial, "vm": repr(self.vm), "failure_time": failure_time, "timings": timings,
+                  "snapshot": snapshot}
+        if self.events["GUEST_PANICKED"]:
+            # the panicked guest is paused until the revert
+            result["pc"] = register_pc(self.session.monitor("info registers"))
+        if self.settings.record or self.settings.keep_flips:
+            result["flips"] = [[int(value) for value in record] for record in flips.tolist()]
+        if self.settings.record:
+            result["icounts"] = counts
+        # the revert causes events of its own
+        return result, self.events.copy()
+
+    def analyse(self, result, events):
+        st = time.perf_counter()
+        result["outcome"] = self.outcome(events)
+        result["label"] = self.label(events)
+        pc, backtrace = self.console.crash(result["trial"]) if self.console else (None, [])
+        pc = pc or result.pop("pc", None)
+        result["crash"] = [pc, backtrace] if result["label"] != "benign" and (pc or backtrace) else None
+        result["panic"] = events["GUEST_PANICKED"]
+        result["timings"]["analysis"] = time.perf_counter() - st
+
+    async def close(self):
+        self.pool.report()
+        self.pool.close()
+        await self.qmp.close()
+        if self.console:
+            self.console.close()
+        self.session.close()
+
+    async def run(self, trials, results):
+        await self.start()
+        try:
+            loop = asyncio.get_running_loop()
+            upcoming = loop.run_in_executor(None, self.prepare, trials)
+            while True:
+                st = time.perf_counter()
+                trial, flips, prepare_time = await upcoming
+                stall = time.perf_counter() - st
+                if trial is None:
+                    break
+                result, events = await self.run_trial(trial, flips)
+                result["timings"]["prepare"] = prepare_time
+                # the guest is restored while the trial is analysed and the next one planned
+                st = time.perf_counter()
+                revert = asyncio.ensure_future(self.revert(events["GUEST_PANICKED"] > 0))
+                upcoming = loop.run_in_executor(None, self.prepare, trials)
+                self.analyse(result, events)
+                result["timings"]["revert"] = await revert
+                # host time not hidden behind the guest: waiting for the plan of this trial, or analysis that
+                # outlasted the revert
+                result["timings"]["stall"] = stall + max(0.0, time.perf_counter() - st - result["timings"]["revert"])
+                results.put(result)
+        finally:
+            await self.close()
+
+    async def replay_trial(self, entry):
+        """Run the trial entry of a manifest again from its snapshot, return its result"""
+        await self.start()
+        try:
+            flips = numpy.array([tuple(record) for record in entry["flips"]], dtype=plan.plan_dtype())
+            if not numpy.array_equal(flips, self.settings.plan(entry["trial"])):
+                print(f"trial {entry['trial']}: the recorded flips differ from the plan of the seed, replaying the recorded ones")
+            result, events = await self.run_trial(entry["trial"], flips, entry["icounts"])
+            self.analyse(result, events)
+            return result
+        finally:
+            await self.close()
+
+def worker_main(vm, settings, trials, results):
+    try:
+        asyncio.run(VmWorker(vm, settings).run(trials, results))
+    finally:
+        # tell the parent this worker is done
+        results.put(None)
+
+# fields of a result kept in a manifest
+MANIFEST_FIELDS = ("trial", "vm", "snapshot", "flips", "icounts", "outcome", "label", "failure_time", "crash")
+
+def load_manifest(filename):
+    """Return (TrialSettings, {vm: snapshot name}, {trial: entry}) of a manifest written by run_campaign"""
+    with open(filename) as f:
+        header = json.loads(f.readline())
+        entries = {entry["trial"]: entry for entry in map(json.loads, f)}
+    settings = TrialSettings(**header["settings"])
+    settings.ranges = [tuple(r) for r in settings.ranges]
+    return settings, header["snapshots"], entries
+
+def replay_trial(vm, manifest, trial):
+    """Run one trial of a recorded campaign again on vm, return (recorded entry, new result)"""
+    settings, snapshots, entries = load_manifest(manifest)
+    assert trial in entries, f"trial {trial} is not in {manifest}"
+    entry = entries[trial]
+    # the snapshot of a trial recorded by QEMU is at its position in the recording, the baseline is at trial 0's
+    vm.snapname = entry.get("snapshot") or snapshots.get(entry["vm"], vm.snapname)
+    return entry, asyncio.run(VmWorker(vm, settings, replay=True).replay_trial(entry))
+
+def drain(trials, workers):
+    """Take the trials nobody started yet out of the queue, and end every worker after its current trial"""
+    while True:
+        try:
+            trials.get_nowait()
+        except queue.Empty:
+            break
+    for _ in range(workers):
+        trials.put(None)
+
+def run_campaign(vms, trials, settings: TrialSettings, on_result=None, manifest=None, results=None, stop=None):
+    """
+    Run trials 0 .. trials-1 on all vms in parallel, one worker process per vm.
+    on_result(result) is called in this process for every finished trial.
+    manifest is a file the settings and every trial are recorded in for replay_trial, it sets settings.record.
+    results is a results.ResultStore every trial and its flips are added to, it sets settings.keep_flips only, so the
+    flips are injected at the same times and the baseline is reverted to as without it.
+    stop is an estimate.AdaptiveStop, no new trial starts once it is done.
+    Return {"trials": n, "panic": total panic events, "outcomes": {outcome: count}, "labels": {label: count},
+    "timings": {phase: total seconds}}.
+    """
+    record = open(manifest, "w") if manifest else None
+    if record:
+        settings.record = True
+    if results:
+        settings.keep_flips = True
+    if record:
+        json.dump({"settings": vars(settings), "snapshots": {repr(vm): vm.snapname for vm in vms}}, record)
+        record.write("\n")
+    ctx = multiprocessing.get_context("spawn")
+    trial_queue, result_queue = ctx.Queue(), ctx.Queue()
+    for trial in range(trials):
+        trial_queue.put(trial)
+    for _ in vms:
+        trial_queue.put(None)
+
+    workers = [ctx.Process(target=worker_main, args=(vm, settings, trial_queue, result_queue)) for vm in vms]
+    for worker in workers:
+        worker.start()
+
+    summary = {"trials": 0, "panic": 0, "outcomes": collections.Counter(), "labels": collections.Counter(),
+               "timings": dict.fromkeys(PHASES, 0.0)}
+    running = len(workers)
+    stopping = False
+    while running:
+        result = result_queue.get()
+        if result is None:
+            running -= 1
+            continue
+        summary["trials"] += 1
+        summary["panic"] += result["panic"]
+        summary["outcomes"][result["outcome"]] += 1
+        summary["labels"][result["label"]] += 1
+        for phase, elapsed in result["timings"].items():
+            summary["timings"][phase] += elapsed
+        if record:
+            json.dump({key: result[key] for key in MANIFEST_FIELDS}, record)
+            record.write("\n")
+            record.flush()
+        if results:
+            results.add_result(result)
+        if stop and not stopping:
+            # the flips of a trial only depend on the seed
+            stop.add(result["label"] != "benign", settings.plan(result["trial"])["address"].tolist())
+            if stop.done():
+                stopping = True
+                drain(trial_queue, len(vms))
+        if on_result:
+            on_result(result)
+
+    for worker in workers:
+        worker.join()
+    if record:
+        record.close()
+    if results:
+        results.flush()
+    summary["outcomes"] = dict(summary["outcomes"])
+    summary["labels"] = dict(summary["labels"])
+    return summary
+
+if __name__ == '__main__':
+    import argparse
+    import os
+    import iomem
+    import ksyms
+    from estimate import CONFIDENCE, METHODS, AdaptiveStop
+    from fakestub import FakeGdbStub, FakeQmpServer
+    from results import ResultStore, run_name
+
+    parser = argparse.ArgumentParser(description="Run a fault injection campaign on several VMs in parallel")
+    parser.add_argument("--vm", action="append", default=[], help="<gdb port>:<qmp socket>[:<console log>]")
+    parser.add_argument("--fake", type=int, default=0, help="run on this many local fake VMs instead")
+    parser.add_argument("--trials", type=int, default=10)
+    parser.add_argument("--faults", type=int, default=1, help="flips per trial")
+    parser.add_argument("--min-interval", type=int, default=1000, help="nanoseconds")
+    parser.add_argument("--max-interval", type=int, default=2000, help="nanoseconds")
+    parser.add_argument("--observe", type=float, default=10, help="seconds")
+    parser.add_argument("--area", default="System RAM", help="resource name in iomem.txt")
+    parser.add_argument("--exclude", action="append", help="resource inside area that is not flipped, * for all")
+    parser.add_argument("--symbols", action="append", help="flip kernel symbols or sections matching this pattern "
+                                                             "instead of area, see ksyms.py")
+    parser.add_argument("--symbol-map", default="System.map", help="System.map or vmlinux of the guest kernel")
+    parser.add_argument("--iomem", default="iomem.txt")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--golden", help="result the workload prints with FLIP_OK in a fault free run")
+    parser.add_argument("--fake-restore", type=float, default=0.02, help="seconds a snapshot restore of a fake VM takes")
+    parser.add_argument("--tmpfs", nargs="?", const=DEFAULT_TMPFS, help="keep snapshots in disk overlays in this directory")
+    parser.add_argument("--record", help="write a manifest of the campaign for --replay")
+    parser.add_argument("--replay", help="manifest of a recorded campaign, run --trial of it again on the first VM")
+    parser.add_argument("--trial", type=int, help="trial of --replay")
+    parser.add_argument("--results", help="add the trials and their flips to this results.py database")
+    parser.add_argument("--target-width", type=float, help="stop once the confidence interval of the failure rate is "
+                                                           "at most this wide, --trials is the maximum")
+    parser.add_argument("--confidence", type=float, default=CONFIDENCE)
+    parser.add_argument("--interval", choices=METHODS, default="wilson")
+    parser.add_argument("--per-area", action="store_true", help="--target-width for every iomem area hit")
+    args = parser.parse_args()
+
+    vms, fakes = [], []
+    for spec in args.vm:
+        port, qmp_path, *console = spec.split(":", 2)
+        vms.append(Vm(int(port), qmp_path, console=console[0] if console else None))
+    for i in range(args.fake):
+        # the first MiB of the fake RAM plays the kernel, a flip in it panics the guest
+        stub = FakeGdbStub(panic_range=(0x40000000, 0x400fffff), restore_time=args.fake_restore).start()
+        qmp_server = FakeQmpServer(f"/tmp/fakeqmp{i}.sock", stub).start()
+        fakes += [stub, qmp_server]
+        vms.append(Vm(stub.port, qmp_server.path))
+    if args.tmpfs:
+        # one overlay directory per VM, registries are not shared between processes
+        for vm in vms:
+            vm.tmpfs = f"{args.tmpfs}/{vm.gdb_port}"
+
+    if args.replay:
+        assert vms and args.trial is not None, "--replay needs a VM and --trial"
+        entry, result = replay_trial(vms[0], args.replay, args.trial)
+        print(f"recorded: {entry['outcome']} {entry['label']} failure_time {entry['failure_time']} icounts {entry['icounts']}")
+        print(f"replayed: {result['outcome']} {result['label']} failure_time {result['failure_time']} icounts {result['icounts']}")
+    else:
+        if args.fake:
+            ranges = [(0x40000000, 0x40ffffff)]
+        elif args.symbols:
+            ranges = ksyms.target_ranges(args.symbols, args.symbol_map, args.iomem)
+        else:
+            exclude = iomem.ALL_CHILDREN if args.exclude == [iomem.ALL_CHILDREN] else args.exclude
+            ranges = iomem.load(args.iomem).ranges(args.area, exclude)
+        settings = TrialSettings(args.faults, args.min_interval, args.max_interval, args.observe, ranges, args.seed, args.golden)
+
+        store = None
+        if args.results:
+            # ram flips are labeled with their iomem resource, the campaign is a run named after its manifest
+            store = ResultStore(args.results, iomem.load(args.iomem) if os.path.exists(args.iomem) else None,
+                                run=run_name(args.record) if args.record else None)
+            print(f"results: run {store.run} in {args.results}")
+
+        stop = None
+        if args.target_width:
+            stop = AdaptiveStop(args.target_width, args.confidence, args.interval,
+                                iomem_index=iomem.load(args.iomem) if args.per_area else None)
+
+        def report(result):
+            # the flips of a recorded trial are in the manifest
+            print({key: value for key, value in result.items() if key not in ("flips", "icounts")})
+            if stop:
+                print(stop.report())
+
+        st = time.time()
+        summary = run_campaign(vms, args.trials, settings, manifest=args.record, results=store, stop=stop,
+                               on_result=report)
+        et = time.time()
+        print(f"{summary['trials']} trials on {len(vms)} VMs in {et - st:.3f}s: {summary['outcomes']}")
+        print("panic count: " + str(summary["panic"]))
+        print(f"labels: {summary['labels']}")
+        if summary["trials"]:
+            print("mean per trial: " + ", ".join(f"{phase} {summary['timings'][phase] / summary['trials'] * 1000:.2f} ms"
+                                                 for phase in PHASES))
+        if store:
+            store.close()
+    for fake in fakes:
+        fake.stop()
@@ -0,0 +1,221 @@
+# ==============================================================================
+# This file follows the serial console log of the guest, the file written by
+# `| tee <some-file>` (see README), and looks for failure messages in the
+# bytes appended since the start of a trial.
+#
+# ConsoleClassifier labels every trial from the messages printed during it:
+#   crash   kernel panic, or the workload segfaulted
+#   oops    Oops or BUG without a panic
+#   hang    soft/hard lockup, RCU stall, or no OK marker from the workload
+#   SDC     the workload finished, but its result differs from the golden one
+#   benign  none of the above
+# The workload reports success by printing the OK marker, e.g. `FLIP_OK` or
+# `FLIP_OK <checksum of its output>`.
+#
+# The text printed from the first failure message of a trial on is kept, and
+# crash_report() takes the faulting PC and the call trace of the oops from it
+# (arm64 `pc : `, x86 `RIP: `, arm `PC is at `), see attribution.py.
+#
+# Note: The log is read incrementally, it is never rescanned from the start.
+# ==============================================================================
+
+import collections
+import os
+import re
+
+# messages of a failed guest, the trial can end as soon as one is printed
+FAILURE_PATTERN = re.compile(rb"Kernel panic|Oops|BUG:|Unable to handle kernel|Internal error"
+                             rb"|soft lockup|hard LOCKUP|rcu_\w+ detected stalls")
+# how often the console log is checked for failures while a trial is observed
+OBSERVE_POLL_SEC = 0.01
+
+# console signatures, all of them are searched in one pass of one regex
+SIGNATURES = {
+    "panic": rb"Kernel panic",
+    "oops": rb"Oops|Unable to handle kernel|Internal error",
+    "bug": rb"BUG:|kernel BUG at",
+    "lockup": rb"soft lockup|hard LOCKUP",
+    "rcu_stall": rb"rcu_\w+ detected stalls",
+    "segfault": rb"segfault at",
+}
+OK_MARKER = rb"FLIP_OK(?: (?P<result>\S+))?"
+
+# signatures -> label, the first label with a signature seen in the trial wins
+LABELS = (("crash", ("panic", "segfault")), ("oops", ("oops", "bug")), ("hang", ("lockup", "rcu_stall")))
+
+# bytes of a failure report kept per trial
+REPORT_BYTES = 64 << 10
+# "[   12.345678] " timestamps of printk
+TIMESTAMP = re.compile(r"^\[[\s\d.]+\]\s?")
+PC_PATTERN = re.compile(r"(?:\bpc : |RIP: [0-9a-f]{4}:|PC is at )(?P<frame>\S+)")
+TRACE_START = re.compile(r"Call [Tt]race:")
+# "func+0x1c/0x40" with kallsyms, a raw address without; x86 marks unreliable frames with "? "
+FRAME_PATTERN = re.compile(r"^\s*(?P<unreliable>\? )?(?P<frame>[\w.$]+\+0x[0-9a-f]+|0x[0-9a-f]+)(?:/0x[0-9a-f]+)?")
+# <TASK>, <IRQ> and </IRQ> lines inside an x86 call trace
+TRACE_MARKER = re.compile(r"^\s*</?[A-Z]+>\s*$")
+
+ConsoleMatch = collections.namedtuple("ConsoleMatch", ["trial", "signature", "text", "offset"])
+
+def classifier_pattern(ok_marker=OK_MARKER):
+    """One regex with a named group per signature, match.lastgroup is the signature"""
+    groups = [b"(?P<%s>%s)" % (name.encode(), pattern) for name, pattern in SIGNATURES.items()]
+    groups.append(b"(?P<ok>%s)" % ok_marker)
+    return re.compile(b"|".join(groups))
+
+def crash_report(text):
+    """
+    (pc, backtrace) of the first oops in the console text, frames as "symbol+0xoffset" or "0x<address>".
+    pc is None when it was not printed, unreliable frames are left out of the backtrace.
+    """
+    pc = None
+    backtrace = []
+    in_trace = False
+    for line in text.splitlines():
+        line = TIMESTAMP.sub("", line)
+        if pc is None:
+            match = PC_PATTERN.search(line)
+            if match:
+                pc = match.group("frame").split("/")[0]
+        if TRACE_START.search(line):
+            in_trace = True
+            continue
+        if not in_trace:
+            continue
+        match = FRAME_PATTERN.match(line)
+        if match:
+            if not match.group("unreliable"):
+                backtrace.append(match.group("frame"))
+        elif not TRACE_MARKER.match(line):
+            # the end of the first call trace
+            break
+    return pc, backtrace
+
+class ConsoleTail:
+    def __init__(self, filename, pattern=FAILURE_PATTERN):
+        """
+        :param filename: console log written by `tee`
+        :param pattern: compiled bytes regex searched in new lines"""
+        self.filename = filename
+        self.pattern = pattern
+        self.file = open(filename, 'rb')
+        self.partial = b""
+        self.mark()
+
+    def mark(self):
+        """Ignore everything written so far"""
+        self.file.seek(0, os.SEEK_END)
+        self.partial = b""
+
+    def read_lines(self):
+        """Return the complete lines appended since the last call as one bytes object"""
+        data = self.file.read()
+        if not data:
+            return b""
+        data = self.partial + data
+        end = data.rfind(b"\n") + 1
+        self.partial = data[end:]
+        return data[:end]
+
+    def poll(self):
+        """Return the first failure match in the new lines, None if there is none"""
+        lines = self.read_lines()
+        return self.pattern.search(lines) if lines else None
+
+    def close(self):
+        self.file.close()
+
+class ConsoleClassifier(ConsoleTail):
+    """
+    Label trials from the console log while they run. Lines are read from the last offset on and belong to the
+    trial started last with begin(), the matches of the current trial are kept in self.matches tagged with its id.
+    Only the current trial is kept, of finished ones the label counts remain, so long campaigns use constant memory.
+    """
+    def __init__(self, filename, ok_marker=OK_MARKER, golden=None, expect_ok=None):
+        """
+        :param ok_marker: bytes regex the workload prints when it is done, an optional `result` group is its result
+        :param golden: result of a fault free run as bytes, None does not check results so SDC is never reported
+        :param expect_ok: a trial without OK marker is a hang, default is True if golden is given"""
+        super().__init__(filename, classifier_pattern(ok_marker))
+        self.golden = golden.encode() if isinstance(golden, str) else golden
+        self.expect_ok = golden is not None if expect_ok is None else expect_ok
+        self.trial = None
+        self.matches = []
+        # trial -> Counter of signatures, trial -> result of the workload
+        self.signatures = {}
+        self.results = {}
+        # (trial, label) of the trial ended last, label -> number of ended trials
+        self.ended = (None, None)
+        self.counts = collections.Counter()
+        # trial -> text from its first failure message on, see crash()
+        self.reports = {}
+
+    def begin(self, trial):
+        """Start trial, lines printed so far still belong to the previous trial"""
+        self.classify()
+        self.trial = trial
+        self.signatures[trial] = collections.Counter()
+        # crash() of the previous trial is taken before the next one starts
+        self.reports.clear()
+        self.matches.clear()
+
+    def classify(self):
+        """Classify the new lines, return the new matches"""
+        # file offset of the new lines
+        start = self.file.tell() - len(self.partial)
+        lines = self.read_lines()
+        if not lines:
+            return []
+        matches = []
+        for match in self.pattern.finditer(lines):
+            signature = match.lastgroup
+            matches.append(ConsoleMatch(self.trial, signature, match.group().decode(errors="replace"), start + match.start()))
+            if self.trial not in self.signatures:
+                # before the first trial or after the end of the current one
+                continue
+            self.signatures[self.trial][signature] += 1
+            if signature == "ok":
+                self.results[self.trial] = match.group("result")
+        self.matches.extend(matches)
+        report = self.reports.get(self.trial)
+        failure = self.failure(matches)
+        if report is not None:
+            self.reports[self.trial] = (report + lines)[:REPORT_BYTES]
+        elif failure and self.trial in self.signatures:
+            self.reports[self.trial] = lines[failure.offset - start:][:REPORT_BYTES]
+        return matches
+
+    def failure(self, matches):
+        """The first match of a failed guest in matches, None if there is none"""
+        return next((match for match in matches if match.signature != "ok"), None)
+
+    def label(self, trial=None):
+        """Label of trial (default: the current one) from what was printed so far"""
+        trial = self.trial if trial is None else trial
+        if trial == self.ended[0]:
+            return self.ended[1]
+        seen = self.signatures.get(trial, {})
+        for label, signatures in LABELS:
+            if any(seen.get(signature) for signature in signatures):
+                return label
+        if not seen.get("ok"):
+            return "hang" if self.expect_ok else "benign"
+        if self.golden is not None and self.results.get(trial) != self.golden:
+            return "SDC"
+        return "benign"
+
+    def crash(self, trial=None):
+        """(pc, backtrace) of the oops printed in trial (default: the current one), see crash_report"""
+        self.classify()
+        report = self.reports.pop(self.trial if trial is None else trial, b"")
+        return crash_report(report.decode(errors="replace"))
+
+    def end(self):
+        """End the current trial and return its final label, its matches are dropped"""
+        self.classify()
+        label = self.label()
+        self.ended = (self.trial, label)
+        self.counts[label] += 1
+        self.signatures.pop(self.trial, None)
+        self.results.pop(self.trial, None)
+        self.matches.clear()
+        return label
@@ -1,9 +1,12 @@
+import asyncio
 import json
 import socket
 import pexpect
 import time
 import threading
 
+from qmp import READ_SIZE, PanicCounter, QmpDecoder
+
 class SocketClient:
     def __init__(self, server_address, need_revert=False, telnethost=None, telnetport=None, snapname=None):
         """
@@ -42,16 +45,15 @@ class SocketClient:
     
     def listen(self):
         """Listen the socket server and get the response, check if guest is paniced."""
-        buffer = ""
+        decoder = QmpDecoder()
         print("socket connection start listening...")
         while True:
-            data = self.sock.recv(1024)
+            data = self.sock.recv(READ_SIZE)
             if not data:
                 # qemu shutdown
                 break
-            buffer += data.decode()
             # parse the response data to json objects
-            results, buffer = parse_json_objects(buffer)
+            results = decoder.feed(data)
             # iterate all objects
             for res in results:
                 print(res)
@@ -147,30 +149,34 @@ class SshClient:
         print("SSH is usable now.")
 
 
+json_decoder = json.JSONDecoder()
+
 def parse_json_objects(buffer):
+    """Parse all complete json objects in buffer, return them with the unparsed rest.
+    Prefer qmp.QmpDecoder for a socket stream, it works on bytes."""
     results = []
-    while buffer:
+    idx = len(buffer) - len(buffer.lstrip())
+    while idx < len(buffer):
         try:
-            obj, idx = json.JSONDecoder().raw_decode(buffer)
-            results.append(obj)
-            buffer = buffer[idx:].lstrip()  # remove parsed part
+            obj, idx = json_decoder.raw_decode(buffer, idx)
         except json.JSONDecodeError:
             # incomplete json object, parse it the next time
             break
-    return results, buffer
+        results.append(obj)
+        # skip the whitespace after the parsed part
+        while idx < len(buffer) and buffer[idx].isspace():
+            idx += 1
+    return results, buffer[idx:]
 
-def count_panic(sockfile):
+def count_panic(sockfile, snapname=None):
+    """Count guest panics until qemu shuts down, revert to snapname after every panic if given"""
     print("start listening...")
-    socketc = SocketClient(sockfile)
-    socketc.send('{"execute": "qmp_capabilities"}')
-    socketc.listen()
-    print("panic count: " + str(socketc.panic))
+    panic = asyncio.run(PanicCounter(sockfile, snapname).run())
+    print("panic count: " + str(panic))
+    return panic
 
 if __name__=="__main__":
     ssh_client = SshClient("localhost", 2222, "root", "519ailab")
     ssh_client.check_ssh()
     # Qemu is already booted now.
-    socketc = SocketClient("/tmp/qmp.sock")
-    socketc.send('{"execute": "qmp_capabilities"}')
-    socketc.listen()
-    print("panic count: " + str(socketc.panic))
\ No newline at end of file
+    count_panic("/tmp/qmp.sock")
\ No newline at end of file
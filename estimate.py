@@ -0,0 +1,150 @@
+# ==============================================================================
+# This file estimates the failure rate of a campaign while it runs, and tells
+# when the estimate is precise enough to stop.
+#
+# Every trial is a Bernoulli draw: failed (any label but benign, see
+# console.py) or not. The failure rate gets a confidence interval:
+#   wilson            Wilson score interval, good coverage also near 0 and 1
+#   clopper-pearson   exact binomial interval, never narrower than it must be
+# A campaign stops once the interval is at most target_width wide, overall or
+# for every area (the innermost iomem resource of the flips of a trial, a
+# trial with flips in two areas counts for both). The loop count of the
+# campaign is the upper bound. No interval is trusted before MIN_TRIALS.
+#
+# Standard library only, snapinject_ram and campaign.py share it.
+# ==============================================================================
+
+import math
+from statistics import NormalDist
+
+METHODS = ("wilson", "clopper-pearson")
+CONFIDENCE = 0.95
+# trials before an interval may stop a campaign
+MIN_TRIALS = 30
+# name of the estimate over all trials
+OVERALL = "overall"
+
+def betainc(a, b, x):
+    """Regularized incomplete beta function I_x(a, b), continued fraction of Numerical Recipes 6.4"""
+    if x <= 0:
+        return 0.0
+    if x >= 1:
+        return 1.0
+    front = math.exp(math.lgamma(a + b) - math.lgamma(a) - math.lgamma(b) + a * math.log(x) + b * math.log1p(-x))
+    # the fraction converges fast below the mean
+    if x < (a + 1) / (a + b + 2):
+        return front * beta_fraction(a, b, x) / a
+    return 1 - front * beta_fraction(b, a, 1 - x) / b
+
+def beta_fraction(a, b, x, tiny=1e-300, eps=1e-14):
+    """Continued fraction of betainc, modified Lentz method"""
+    c = 1.0
+    d = 1 / (1 - (a + b) * x / (a + 1) or tiny)
+    h = d
+    for m in range(1, 100000):
+        for numerator in (m * (b - m) * x / ((a + 2 * m - 1) * (a + 2 * m)),
+                          -(a + m) * (a + b + m) * x / ((a + 2 * m) * (a + 2 * m + 1))):
+            d = 1 / (1 + numerator * d or tiny)
+            c = 1 + numerator / c or tiny
+            h *= d * c
+        if abs(d * c - 1) < eps:
+            break
+    return h
+
+def beta_quantile(q, a, b):
+    """x with I_x(a, b) = q, by bisection"""
+    low, high = 0.0, 1.0
+    for _ in range(60):
+        middle = (low + high) / 2
+        if betainc(a, b, middle) < q:
+            low = middle
+        else:
+            high = middle
+    return (low + high) / 2
+
+def interval(failures, trials, confidence=CONFIDENCE, method="wilson"):
+    """(low, high) confidence interval of the failure rate, (0, 1) without trials"""
+    assert method in METHODS, "unknown interval method %s" % method
+    if not trials:
+        return 0.0, 1.0
+    alpha = 1 - confidence
+    if method == "clopper-pearson":
+        low = beta_quantile(alpha / 2, failures, trials - failures + 1) if failures else 0.0
+        high = beta_quantile(1 - alpha / 2, failures + 1, trials - failures) if failures < trials else 1.0
+        return low, high
+    z = NormalDist().inv_cdf(1 - alpha / 2)
+    rate = failures / trials
+    center = (rate + z * z / (2 * trials)) / (1 + z * z / trials)
+    margin = z / (1 + z * z / trials) * math.sqrt(rate * (1 - rate) / trials + z * z / (4 * trials * trials))
+    return max(0.0, center - margin), min(1.0, center + margin)
+
+class RateEstimate:
+    def __init__(self, confidence=CONFIDENCE, method="wilson"):
+        self.confidence = confidence
+        self.method = method
+        self.trials = 0
+        self.failures = 0
+
+    def add(self, failed):
+        self.trials += 1
+        self.failures += bool(failed)
+
+    def rate(self):
+        return self.failures / self.trials if self.trials else 0.0
+
+    def interval(self):
+        return interval(self.failures, self.trials, self.confidence, self.method)
+
+    def width(self):
+        low, high = self.interval()
+        return high - low
+
+    def __str__(self):
+        low, high = self.interval()
+        return "%d/%d failed, %.2f%% [%.2f%%, %.2f%%]" % (self.failures, self.trials, self.rate() * 100, low * 100,
+                                                          high * 100)
+
+class AdaptiveStop:
+    """Failure rate estimates of a campaign, done() once their intervals are narrow enough"""
+    def __init__(self, target_width, confidence=CONFIDENCE, method="wilson", min_trials=MIN_TRIALS, iomem_index=None):
+        """
+        :param target_width: widest interval of the failure rate that stops the campaign, e.g. 0.05
+        :param iomem_index: iomem.IomemIndex, the interval of every area must be narrow enough instead of the
+                            overall one"""
+        assert 0 < target_width <= 1, "target width must be in (0, 1]"
+        assert method in METHODS, "unknown interval method %s" % method
+        self.target_width = target_width
+        self.confidence = confidence
+        self.method = method
+        self.min_trials = min_trials
+        self.iomem_index = iomem_index
+        self.overall = RateEstimate(confidence, method)
+        # area name -> RateEstimate
+        self.areas = {}
+
+    def area(self, address):
+        resource = self.iomem_index.lookup(address)
+        return resource.name if resource else "unknown"
+
+    def add(self, failed, addresses=()):
+        """Add a trial, addresses are the physical addresses of its flips"""
+        self.overall.add(failed)
+        if self.iomem_index is None:
+            return
+        for area in {self.area(address) for address in addresses}:
+            self.areas.setdefault(area, RateEstimate(self.confidence, self.method)).add(failed)
+
+    def estimates(self):
+        """The estimates that decide when to stop, by name"""
+        return self.areas if self.iomem_index is not None else {OVERALL: self.overall}
+
+    def done(self):
+        estimates = self.estimates().values()
+        return bool(estimates) and all(estimate.trials >= self.min_trials and estimate.width() <= self.target_width
+                                       for estimate in estimates)
+
+    def report(self):
+        """One line per estimate, the overall one first"""
+        lines = ["%s: %s" % (OVERALL, self.overall)]
+        lines += ["%s: %s" % (name, estimate) for name, estimate in sorted(self.areas.items())]
+        return "\n".join(lines)
@@ -0,0 +1,367 @@
+# ==============================================================================
+# This file is a local stand-in for the QEMU gdbstub. It emulates a flat guest
+# RAM, physical memory mode, m/M packets and the monitor commands used by the
+# flip scripts (stop, cont, savevm, loadvm, delvm, pmemsave, info status, info mtree -f,
+# info registers), so the injection backends can be exercised without QEMU.
+# FakeQmpServer adds the QMP socket of the same fake VM: a write into the
+# panic range makes the guest "panic" and emit GUEST_PANICKED, `info registers`
+# then shows the written address as PC. It also runs
+# snapshot-load jobs, restore_time emulates the latency of a real restore.
+#
+# Usage: python3 fakestub.py [port] [qmp socket]
+# ==============================================================================
+
+import json
+import os
+import socket
+import sys
+import threading
+import time
+
+from rsp import checksum, escape, unescape
+
+class FakeGdbStub:
+    def __init__(self, port=0, ram_base=0x40000000, ram_size=0x1000000, host="localhost", panic_range=None,
+                 restore_time=0.0):
+        """
+        :param port: tcp port to listen on, 0 picks a free port (see self.port)
+        :param ram_base: guest physical address of the emulated RAM
+        :param ram_size: size of the emulated RAM in bytes
+        :param panic_range: inclusive (start, end), the guest panics when memory in it is written
+        :param restore_time: seconds a loadvm takes"""
+        self.ram_base = ram_base
+        self.panic_range = panic_range
+        self.restore_time = restore_time
+        # callbacks called with (event, data) for every qmp event of the fake vm
+        self.listeners = []
+        self.ram = bytearray(ram_size)
+        self.snapshots = {}
+        # disk image reported by `info block`, `snapshot_blkdev` switches it to an overlay
+        self.image = "/tmp/fake-disk.qcow2"
+        self.running = True
+        # PC reported by `info registers`
+        self.pc = 0
+        self.phy_mem_mode = False
+        # number of packets served, useful to count round trips
+        self.packets = 0
+        self.server = socket.create_server((host, port))
+        self.port = self.server.getsockname()[1]
+        self.thread = None
+        self.closing = False
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.closing = True
+        self.server.close()
+        if self.thread:
+            self.thread.join(timeout=1)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def serve(self):
+        while not self.closing:
+            try:
+                conn, _ = self.server.accept()
+            except OSError:
+                return
+            # qemu stops the vm when a debugger connects
+            self.running = False
+            with conn:
+                conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                try:
+                    self.handle(conn)
+                except (ConnectionError, OSError):
+                    pass
+            self.running = True
+
+    def handle(self, conn):
+        buffer = bytearray()
+        noack = False
+        while True:
+            start = buffer.find(b'$')
+            end = buffer.find(b'#', start)
+            if start < 0 or end < 0 or len(buffer) < end + 3:
+                data = conn.recv(65536)
+                if not data:
+                    return
+                buffer += data
+                continue
+            body = bytes(buffer[start + 1:end])
+            del buffer[:end + 3]
+            if not noack:
+                conn.sendall(b'+')
+            payload = unescape(body).decode('latin-1')
+            self.packets += 1
+            if payload == "QStartNoAckMode":
+                self.send(conn, "OK")
+                noack = True
+                continue
+            if payload == "D":
+                self.send(conn, "OK")
+                return
+            if payload == "k":
+                return
+            for reply in self.dispatch(payload):
+                self.send(conn, reply)
+
+    def send(self, conn, payload: str):
+        data = escape(payload.encode('latin-1'))
+        conn.sendall(b'$' + data + b'#' + b'%02x' % checksum(data))
+
+    def translate(self, address, length):
+        offset = address - self.ram_base
+        if offset < 0 or offset + length > len(self.ram):
+            return None
+        return offset
+
+    def dispatch(self, payload):
+        """Return the list of packets sent back for one request"""
+        if payload.startswith("qSupported"):
+            return ["PacketSize=1000;qXfer:features:read-;QStartNoAckMode+"]
+        if payload == "?":
+            return ["T02thread:01;"]
+        if payload.startswith("Qqemu.PhyMemMode:"):
+            self.phy_mem_mode = payload.endswith("1")
+            return ["OK"]
+        if payload.startswith("m"):
+            address, length = (int(x, 16) for x in payload[1:].split(","))
+            offset = self.translate(address, length)
+            if offset is None:
+                return ["E14"]
+            return [self.ram[offset:offset + length].hex()]
+        if payload.startswith("M"):
+            header, data = payload[1:].split(":", 1)
+            address, length = (int(x, 16) for x in header.split(","))
+            offset = self.translate(address, length)
+            if offset is None or len(data) != 2 * length:
+                return ["E14"]
+            self.ram[offset:offset + length] = bytes.fromhex(data)
+            if self.panic_range and address <= self.panic_range[1] and address + length > self.panic_range[0]:
+                self.pc = address
+                self.emit("GUEST_PANICKED", {"action": "pause", "info": {"type": "fake"}})
+            return ["OK"]
+        if payload.startswith("qRcmd,"):
+            command = bytes.fromhex(payload[6:]).decode()
+            replies = []
+            output, stopped = self.monitor(command)
+            if output:
+                replies.append("O" + output.encode().hex())
+            if stopped:
+                # qemu reports every vm stop to the debugger
+                replies.append("T02thread:01;")
+            replies.append("OK")
+            return replies
+        # unsupported packet
+        return [""]
+
+    def emit(self, event, data=None):
+        for listener in self.listeners:
+            listener(event, data)
+
+    def monitor(self, command):
+        """Emulate a qemu monitor command, return (output, vm_stopped)"""
+        args = command.split()
+        if not args:
+            return "", False
+        if args[0] == "stop":
+            stopped = self.running
+            self.running = False
+            if stopped:
+                self.emit("STOP")
+            return "", stopped
+        if args[0] == "cont":
+            if not self.running:
+                self.emit("RESUME")
+            self.running = True
+            return "", False
+        if args[0] == "savevm" and args[1:]:
+            self.snapshots[args[1]] = bytes(self.ram)
+            return "", False
+        if args[0] == "loadvm" and args[1:]:
+            if args[1] not in self.snapshots:
+                return f"Snapshot '{args[1]}' does not exist\n", False
+            time.sleep(self.restore_time)
+            self.ram[:] = self.snapshots[args[1]]
+            return "", False
+        if args[0] == "delvm" and args[1:]:
+            self.snapshots.pop(args[1], None)
+            return "", False
+        if args[:2] == ["info", "snapshots"]:
+            lines = ["List of snapshots present on all disks:",
+                     "ID        TAG               VM SIZE                DATE     VM CLOCK     ICOUNT"]
+            lines += [f"--        {name}   16 MiB 2024-10-18 12:00:00 00:00:01.000" for name in self.snapshots]
+            return "\n".join(lines) + "\n", False
+        if args[:2] == ["info", "block"]:
+            return f"virtio0 (#block100): {self.image} (qcow2)\n    Attached to:      /machine/peripheral-anon/device[0]\n", False
+        if args[0] == "snapshot_blkdev" and args[2:]:
+            open(args[2], "wb").close()
+            self.image = args[2]
+            return "", False
+        if args[0] == "pmemsave" and args[3:]:
+            offset = self.translate(int(args[1], 0), int(args[2], 0))
+            if offset is None:
+                return "Error: invalid address\n", False
+            with open(args[3], "wb") as f:
+                f.write(self.ram[offset:offset + int(args[2], 0)])
+            return "", False
+        if args[:2] == ["info", "status"]:
+            return "VM status: %s\n" % ("running" if self.running else "paused"), False
+        if args[:2] == ["info", "registers"]:
+            return " PC=%016x X00=0000000000000000\n" % self.pc, False
+        if args[:3] == ["info", "mtree", "-f"]:
+            return self.mtree(), False
+        return f"unknown command: '{args[0]}'\n", False
+
+    def mtree(self):
+        end = self.ram_base + len(self.ram) - 1
+        return ("FlatView #0\n"
+                ' AS "memory", root: system\n'
+                ' Root memory region: system\n'
+                f"  0000000000000000-{self.ram_base - 1:016x} (prio 0, i/o): io\n"
+                f"  {self.ram_base:016x}-{end:016x} (prio 0, ram): mach-virt.ram\n"
+                "\n")
+
+# commands FakeQmpServer answers
+COMMANDS = ("qmp_capabilities", "human-monitor-command", "stop", "cont", "query-status", "query-commands",
+            "query-block", "snapshot-load", "query-jobs", "job-dismiss")
+
+class FakeQmpServer:
+    """QMP socket of a FakeGdbStub vm, commands and snapshots act on the same fake vm"""
+    def __init__(self, path, stub: FakeGdbStub):
+        self.path = path
+        self.stub = stub
+        if os.path.exists(path):
+            os.unlink(path)
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(path)
+        self.server.listen()
+        self.conns = []
+        # job id -> {"id", "type", "status", ["error"]} of the snapshot-load jobs
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.thread = None
+        self.closing = False
+        stub.listeners.append(self.emit)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.closing = True
+        self.server.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def serve(self):
+        while not self.closing:
+            try:
+                conn, _ = self.server.accept()
+            except OSError:
+                return
+            threading.Thread(target=self.handle, args=(conn,), daemon=True).start()
+
+    def send(self, conn, message):
+        with self.lock:
+            try:
+                conn.sendall(json.dumps(message).encode() + b"\r\n")
+            except OSError:
+                pass
+
+    def emit(self, event, data=None):
+        message = {"event": event, "timestamp": {"seconds": 0, "microseconds": 0}}
+        if data is not None:
+            message["data"] = data
+        for conn in list(self.conns):
+            self.send(conn, message)
+
+    def handle(self, conn):
+        self.send(conn, {"QMP": {"version": {"qemu": {"major": 0, "minor": 0, "micro": 0}, "package": "fake"},
+                                 "capabilities": []}})
+        with conn:
+            buffer = b""
+            while True:
+                try:
+                    data = conn.recv(65536)
+                except OSError:
+                    data = b""
+                if not data:
+                    break
+                buffer += data
+                *lines, buffer = buffer.split(b"\n")
+                for line in lines:
+                    if line.strip():
+                        self.send(conn, self.execute(json.loads(line)))
+                        if conn not in self.conns:
+                            # events are sent after capabilities negotiation
+                            self.conns.append(conn)
+        if conn in self.conns:
+            self.conns.remove(conn)
+
+    def execute(self, request):
+        command = request.get("execute")
+        arguments = request.get("arguments", {})
+        reply = {"return": {}}
+        if command == "human-monitor-command":
+            reply["return"] = self.stub.monitor(arguments["command-line"])[0]
+        elif command in ("stop", "cont"):
+            self.stub.monitor(command)
+        elif command == "query-status":
+            reply["return"] = {"running": self.stub.running, "status": "running" if self.stub.running else "paused"}
+        elif command == "query-commands":
+            reply["return"] = [{"name": name} for name in COMMANDS]
+        elif command == "query-block":
+            reply["return"] = [{"device": "virtio0", "inserted": {"node-name": "#block100", "file": self.stub.image,
+                                                                  "ro": False, "drv": "qcow2"}}]
+        elif command == "snapshot-load":
+            job = {"id": arguments["job-id"], "type": "snapshot-load", "status": "created"}
+            self.jobs[job["id"]] = job
+            threading.Thread(target=self.load_job, args=(job, arguments["tag"]), daemon=True).start()
+        elif command == "query-jobs":
+            reply["return"] = list(self.jobs.values())
+        elif command == "job-dismiss":
+            if self.jobs.pop(arguments["id"], None) is None:
+                reply = {"error": {"class": "GenericError", "desc": f"Job not found: {arguments['id']}"}}
+        elif command != "qmp_capabilities":
+            reply = {"error": {"class": "CommandNotFound", "desc": f"The command {command} has not been found"}}
+        if "id" in request:
+            reply["id"] = request["id"]
+        return reply
+
+    def job_status(self, job, status):
+        job["status"] = status
+        self.emit("JOB_STATUS_CHANGE", {"id": job["id"], "status": status})
+
+    def load_job(self, job, tag):
+        self.job_status(job, "running")
+        output, _ = self.stub.monitor(f"loadvm {tag}")
+        if output:
+            job["error"] = output.strip()
+        self.job_status(job, "concluded")
+
+if __name__ == '__main__':
+    port = int(sys.argv[1]) if sys.argv[1:] else 1234
+    stub = FakeGdbStub(port)
+    print(f"fake gdbstub listening on localhost:{stub.port}")
+    if sys.argv[2:]:
+        FakeQmpServer(sys.argv[2], stub).start()
+        print(f"fake qmp listening on {sys.argv[2]}")
+    try:
+        stub.serve()
+    except KeyboardInterrupt:
+        stub.stop()
@@ -0,0 +1,156 @@
+# ==============================================================================
+# This file is the injection log shared by the gdb commands and the host side
+# scripts. Records are kept in a bounded in-memory buffer and written to disk
+# by a background thread, either as csv or as compact fixed-size binary records.
+#
+# Binary log layout (little-endian):
+#   header: magic b"FLIPLOG1"
+#   records: timestamp f64, trial u32, kind u8, address u64, old u64, new u64, register name 16s
+# Values wider than 64 bits are truncated to their low 64 bits in the binary format.
+# ==============================================================================
+
+import atexit
+import collections
+import csv
+import struct
+import threading
+import time
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+BINARY_MAGIC = b"FLIPLOG1"
+BINARY_RECORD = struct.Struct("<dIBQQQ16s")
+
+KIND_RAM = 0
+KIND_REG = 1
+KINDS = {"ram": KIND_RAM, "reg": KIND_REG}
+KIND_NAMES = {v: k for k, v in KINDS.items()}
+
+CSV_HEADER = ['Timestamp', 'Trial', 'Kind', 'Address/Register', 'Old Value', 'New Value']
+
+MASK64 = (1 << 64) - 1
+
+def format_target(target):
+    return hex(target) if isinstance(target, int) else target
+
+class CsvFormat:
+    def open(self, filename):
+        file = open(filename, mode='w', newline='')
+        csv.writer(file).writerow(CSV_HEADER)
+        return file
+
+    def write(self, file, records):
+        csv.writer(file).writerows(
+            ("%.6f" % timestamp, trial, kind, format_target(target), hex(old), hex(new))
+            for timestamp, trial, kind, target, old, new in records)
+
+class BinaryFormat:
+    def open(self, filename):
+        file = open(filename, mode='wb')
+        file.write(BINARY_MAGIC)
+        return file
+
+    def write(self, file, records):
+        out = bytearray()
+        for timestamp, trial, kind, target, old, new in records:
+            if isinstance(target, int):
+                address, name = target, b""
+            else:
+                address, name = 0, target.encode()
+            out += BINARY_RECORD.pack(timestamp, trial, KINDS[kind], address & MASK64, old & MASK64, new & MASK64, name)
+        file.write(out)
+
+FORMATS = {"csv": CsvFormat, "bin": BinaryFormat}
+
+def binary_dtype():
+    """NumPy dtype of a binary log record, for writing millions of records at once"""
+    return numpy.dtype([("timestamp", "<f8"), ("trial", "<u4"), ("kind", "u1"), ("address", "<u8"),
+                        ("old", "<u8"), ("new", "<u8"), ("register", "S16")])
+
+def write_binary_log(filename, records):
+    """Write a binary log of records, a NumPy array of binary_dtype()"""
+    assert records.dtype == binary_dtype(), "write_binary_log error: records are not binary_dtype()"
+    with open(filename, 'wb') as f:
+        f.write(BINARY_MAGIC)
+        f.write(records.tobytes())
+
+def read_binary_log(filename):
+    """Yield (timestamp, trial, kind, address or register, old, new) from a binary log"""
+    with open(filename, 'rb') as f:
+        assert f.read(len(BINARY_MAGIC)) == BINARY_MAGIC, "invalid binary log: %s" % filename
+        data = f.read()
+    usable = len(data) - len(data) % BINARY_RECORD.size
+    for timestamp, trial, kind, address, old, new, name in BINARY_RECORD.iter_unpack(data[:usable]):
+        target = name.rstrip(b"\0").decode() if kind == KIND_REG else address
+        yield timestamp, trial, KIND_NAMES[kind], target, old, new
+
+class BufferedLogger:
+    def __init__(self, filename, fmt="csv", flush_interval=1.0, capacity=65536):
+        """
+        :param fmt: "csv" or "bin"
+        :param flush_interval: seconds between two background flushes
+        :param capacity: records kept in memory, log() waits for the flusher when the buffer is full"""
+        assert fmt in FORMATS, "unknown log format: %s" % fmt
+        self.filename = filename
+        self.format = FORMATS[fmt]()
+        self.file = self.format.open(filename)
+        self.flush_interval = flush_interval
+        self.capacity = capacity
+        self.records = collections.deque()
+        self.cond = threading.Condition()
+        # serializes writes of the flusher thread and explicit flush() calls
+        self.write_lock = threading.Lock()
+        self.closed = False
+        self.trial = 0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def log(self, kind, target, old_value, new_value):
+        """Add one record, target is an address (int) or a register name"""
+        record = (time.time(), self.trial, kind, target, old_value, new_value)
+        with self.cond:
+            while len(self.records) >= self.capacity:
+                self.cond.notify_all()
+                self.cond.wait()
+            self.records.append(record)
+            if len(self.records) >= self.capacity // 2:
+                self.cond.notify_all()
+
+    def take(self):
+        with self.cond:
+            records, self.records = self.records, collections.deque()
+            # wake up writers waiting for space
+            self.cond.notify_all()
+        return records
+
+    def flush(self):
+        with self.write_lock:
+            records = self.take()
+            if records and not self.file.closed:
+                self.format.write(self.file, records)
+            self.file.flush()
+
+    def run(self):
+        while True:
+            with self.cond:
+                if not self.closed and len(self.records) < self.capacity // 2:
+                    self.cond.wait(self.flush_interval)
+                if self.closed:
+                    return
+            self.flush()
+
+    def close(self):
+        if self.closed:
+            return
+        # init_logger replaces loggers, only the open one keeps its exit handler
+        atexit.unregister(self.close)
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        self.thread.join()
+        self.flush()
+        self.file.close()
@@ -5,12 +5,27 @@
 # Date: 2024-10-18
 # ==============================================================================
 
+import asyncio
+import concurrent.futures
+import itertools
 import random
+import threading
 import time
 import subprocess
 import uuid
 
+import fliplog
+import iomem
+import ksyms
 from pygdbmi.gdbcontroller import GdbController
+from rsp import RspSession
+from plan import TARGET_RAM, iter_plan
+from qmp import FAILURE_EVENTS, QmpClient
+from attribution import crash_line, register_pc
+from console import OBSERVE_POLL_SEC, ConsoleClassifier
+from estimate import CONFIDENCE, AdaptiveStop
+from snapshot import DEFAULT_TMPFS, SnapshotPool
+from upset import Upset, flip_blocks, within
 
 def extract(file) -> dict:
     """
@@ -21,41 +36,196 @@ def extract(file) -> dict:
         "Kernel Data": [(start_address, end_address), ...],
         "System RAM": [(start_address, end_address), ...]
     }
+
+    Addresses are hex strings. Use iomem.load for the other resources and integer ranges.
     """
-    address_dict = {
-        "Kernel Code": [],
-        "Kernel Data": [],
-        "System RAM": []
-    }
+    index = iomem.load(file)
+    return {area: [("%x" % start, "%x" % end) for start, end in index.ranges(area)] for area in iomem.AREAS}
+
+# Poll interval used while waiting for a MI result record. pygdbmi keeps reading for another
+# 0.2s after any output unless the timeout is shorter, which was most of the per-flip latency.
+MI_POLL_SEC = 0.001
+
+class FlipSession:
+    """
+    Keep a single gdb attached to the qemu gdb server for a whole campaign.
+
+    The guest keeps running while attached, every flip is wrapped with `monitor stop` and
+    `monitor cont` so there is no `target remote`/`detach` round trip per fault.
+    """
+    def __init__(self, gdbmi: GdbController=None, address=":1234"):
+        self.gdbmi, self.shouldexit = (GdbController(), True) if gdbmi is None else (gdbmi, False)
+        self.address = address
+        self.token = 0
+        self.attached = False
+
+    def command(self, command, timeout_sec=10):
+        """Send one MI command and wait for its result record, return the record payload"""
+        return self.execute(command, timeout_sec)[0]
+
+    def execute(self, command, timeout_sec=10):
+        """Send one MI command and wait for its result record, return (record payload, console output)"""
+        self.token += 1
+        token = self.token
+        self.gdbmi.write(f'{token}{command}', read_response=False)
+        output = []
+        deadline = time.time() + timeout_sec
+        while time.time() < deadline:
+            for item in self.gdbmi.get_gdb_response(timeout_sec=MI_POLL_SEC, raise_error_on_timeout=False):
+                if item.get('type') == 'console' and isinstance(item.get('payload'), str):
+                    output.append(item['payload'])
+                if item.get('type') != 'result' or item.get('token') != token:
+                    continue
+                if item.get('message') == 'error':
+                    raise RuntimeError(f'gdb command {command!r} failed: {item.get("payload")}')
+                return item.get('payload'), ''.join(output)
+        raise TimeoutError(f'gdb command {command!r} timed out')
+
+    def console(self, command, timeout_sec=10):
+        """Run a gdb console command, e.g. `monitor stop`, return its output"""
+        escaped = command.replace('\\', '\\\\').replace('"', '\\"')
+        return self.execute(f'-interpreter-exec console "{escaped}"', timeout_sec)[1]
+
+    def attach(self):
+        if self.attached:
+            return
+        self.console("set logging enable on")
+        self.command(f"-target-select remote {self.address}")
+        self.console("maintenance packet Qqemu.PhyMemMode:1")
+        # attaching stops the guest, let it run until the next flip
+        self.console("monitor cont")
+        self.attached = True
+
+    def monitor(self, command, timeout_sec=10):
+        """Execute a qemu monitor command through the attached gdb"""
+        self.attach()
+        return self.console(f"monitor {command}", timeout_sec)
+
+    def read_byte(self, address):
+        return self.read_memory(address, 1)[0]
+
+    def read_memory(self, address, length):
+        payload = self.command(f'-data-read-memory-bytes 0x{address:x} {length}')
+        return bytes.fromhex(payload['memory'][0]['contents'])
+
+    def write_memory(self, address, data):
+        self.command(f'-data-write-memory-bytes 0x{address:x} {data.hex()}')
 
-    with open(file, 'r') as f:
-        address_lines = f.readlines()
-
-        for line in address_lines:
-            parts = line.strip().split(':')
-            start_address, end_address = parts[0].strip().split('-')
-            category = parts[-1].strip()
-            
-            if category == "Kernel code":
-                address_dict["Kernel Code"].append((start_address, end_address))
-            elif category == "Kernel data":
-                address_dict["Kernel Data"].append((start_address, end_address))
-            elif category == "System RAM":
-                address_dict["System RAM"].append((start_address, end_address))
-    return address_dict
-
-def flip_bit_in_area(address_dict, area, gdbmi: GdbController=None):
-    address_start = int(address_dict[area][0][0], base=16)
-    address_end = int(address_dict[area][0][1], base=16)
-
-    random.seed(time.time())
-    random_address = random.randint(address_start,address_end+1)
+    def flip(self, address, bit):
+        """Flip one bit of the byte at physical address, return (old, new) byte values read from the guest"""
+        self.attach()
+        self.console("monitor stop")
+        try:
+            oldvalue = self.read_byte(address)
+            self.command(f'-data-write-memory-bytes 0x{address:x} {oldvalue ^ (1 << bit):02x}')
+            newvalue = self.read_byte(address)
+        finally:
+            self.console("monitor cont")
+        return oldvalue, newvalue
+
+    def flip_cluster(self, flips):
+        """Flip the (address, bit) cells of a multi-bit upset in one stop, return [(address, old, new)] per byte"""
+        self.attach()
+        self.console("monitor stop")
+        try:
+            return flip_blocks(flips, self.read_memory, self.write_memory)
+        finally:
+            self.console("monitor cont")
+
+    def close(self):
+        if self.attached:
+            # detach to make qemu running
+            self.command("-target-detach")
+            self.attached = False
+        if self.shouldexit:
+            self.gdbmi.exit()
+
+def open_session(backend="gdbmi", gdbmi: GdbController=None):
+    """
+    Create the flip session of a backend:
+        gdbmi: gdb driven by pygdbmi, see FlipSession
+        rsp: talk to the qemu gdbstub directly, see rsp.RspSession
+    """
+    assert backend in ['gdbmi', 'rsp'], f"open_session error: unknown backend {backend}"
+    if backend == "rsp":
+        return RspSession()
+    return FlipSession(gdbmi)
+
+def flip_bit_in_area(index, area, gdbmi: GdbController=None, session=None, upset=None, exclude=None):
+    """
+    Flip a random bit in area of index (iomem.IomemIndex). With a session (FlipSession or RspSession) the flip goes
+    through the attached session, with a gdbmi it attaches and detaches around the flip, otherwise gdb.sh is executed.
+    upset (upset.Upset) flips the whole cluster of a multi-bit upset around the random bit.
+    exclude is a list of resources inside area that are not flipped, see iomem.IomemIndex.ranges.
+    """
+    random_address, random_bit = random_flip(index, area, exclude)
+    flip_bit(random_address, random_bit, area, gdbmi, session, upset, index.sampler(area, exclude).ranges)
+
+def random_flip(index, area, exclude=None):
+    """Return a random (address, bit) in all ranges of area, every byte has the same weight"""
+    random_address = index.sampler(area, exclude).sample()
     random_bit = random.randint(0,7)
+    return random_address, random_bit
+
+def target_sampler(area="System RAM", exclude=None, symbols=None, index=None, symbol_map="System.map"):
+    """
+    iomem.RangeSampler of the flip targets: the ranges of area in iomem.txt without the resources in exclude,
+    or the kernel symbols and sections matching the symbols patterns in symbol_map, System.map or vmlinux (see
+    ksyms.py).
+    """
+    index = index or iomem.load('iomem.txt')
+    if symbols:
+        symbol_index = ksyms.load(symbol_map)
+        ksyms.warn_inferred(symbol_index, symbols)
+        return iomem.RangeSampler(ksyms.physical_ranges(symbol_index, symbols, ksyms.kernel_offset(symbol_index, index)))
+    return index.sampler(area, exclude)
 
+def draw_records(fault_number, min_interval, max_interval, sampler):
+    """Draw fault_number random flips from sampler (see target_sampler) like autoinject_ram, as plan records"""
+    records = []
+    for _ in range(fault_number):
+        address, bit = sampler.sample(), random.randint(0, 7)
+        records.append((random.randint(min_interval, max_interval), address, bit, 1, TARGET_RAM))
+    return records
+
+def flip_bit(address, bit, area, gdbmi: GdbController=None, session=None, upset=None, ranges=None):
+    """
+    Flip bit (0-7) of the byte at physical address, or the cluster of upset around it, see flip_bit_in_area.
+    Cells of the cluster outside ranges (sorted, inclusive) are skipped.
+    With a session, return [(address, old, new)] of the flipped bytes as read back from the guest.
+    """
+    flips = upset.cluster(address, bit) if upset else [(address, bit)]
+    if ranges is not None:
+        cells = within(flips, ranges)
+        if len(cells) < len(flips):
+            print(f'Skip {len(flips) - len(cells)} of {len(flips)} cells of the upset at 0x{address:x} outside {area}')
+        flips = cells
+        if not flips:
+            return []
+    if session:
+        if len(flips) == 1:
+            # the struck cell itself may be clipped
+            address, bit = flips[0]
+            oldvalue, newvalue = session.flip(address, bit)
+            changes = [(address, oldvalue, newvalue)]
+        else:
+            # read, write and verify the cluster in one stop
+            changes = session.flip_cluster(flips)
+        assert ranges is None or len(within([(changed, 0) for changed, _, _ in changes], ranges)) == len(changes), \
+            f"flip_bit error: upset at 0x{address:x} flipped bytes outside {area}"
+        for address, oldvalue, newvalue in changes:
+            print(f'Inject fault at physical address 0x{address:x} in area {area}, old=0x{oldvalue:02x}, new=0x{newvalue:02x}')
+        return changes
+    # one byte is written per flipped byte, `set *0x...` would write a 4 byte int
+    masks = {}
+    for address, bit in flips:
+        masks[address] = masks.get(address, 0) ^ (1 << bit)
+    flip_commands = []
+    for address, mask in masks.items():
+        flip_commands += [f'x/bx 0x{address:x}', f'set {{unsigned char}}0x{address:x}^=0x{mask:02x}', f'x/bx 0x{address:x}']
     if gdbmi:
         # attached to qemu gdb server
-        commands = ["set logging enable on", "target remote:1234", "maintenance packet Qqemu.PhyMemMode:1", f'x/bx 0x{random_address:x}', 
-                    f'set *0x{random_address:x}^=1<<{random_bit}', f'x/bx 0x{random_address:x}']
+        commands = ["set logging enable on", "target remote:1234", "maintenance packet Qqemu.PhyMemMode:1"] + flip_commands
         # set read_response to clean the buffer, make sure the next command get clean response in buffer
         # 
         # gdbmi.write response example:
@@ -72,26 +242,26 @@ def flip_bit_in_area(address_dict, area, gdbmi: GdbController=None):
             if isinstance(payload, str) and payload.startswith('0x') and ':' in payload:
                 value.append(payload.split(':')[1].strip())
 
-        oldvalue = value[0] if value[0:] else None
-        newvalue = value[1] if value[1:] else None
-
         # detach to make qemu running
         gdbmi.write("detach", read_response=False)
-        print(f'Inject fault at physical address 0x{random_address:x} in area {area}, old={oldvalue}, new={newvalue}')
+        for i, address in enumerate(masks):
+            oldvalue = value[2 * i] if value[2 * i:] else None
+            newvalue = value[2 * i + 1] if value[2 * i + 1:] else None
+            print(f'Inject fault at physical address 0x{address:x} in area {area}, old={oldvalue}, new={newvalue}')
     else:
-        command_list = []
-        command_list.append(f'x/bx 0x{random_address:x}\n')
-        command_list.append(f'set *0x{random_address:x}^=1<<{random_bit}\n')
-        command_list.append(f'x/bx 0x{random_address:x}\n')
         with open('gdb_command.txt', 'w') as f:
-            f.writelines(command_list)
+            f.writelines(command + '\n' for command in flip_commands)
         subprocess.run(['./gdb.sh'], check=True, stdout=subprocess.DEVNULL)
-        print(f'Inject fault at physical address 0x{random_address:x} in area {area}')
+        for address in masks:
+            print(f'Inject fault at physical address 0x{address:x} in area {area}')
 
-def vm_action(action, snapname, gdbmi: GdbController=None):
+def vm_action(action, snapname, gdbmi: GdbController=None, session=None):
     """Execute savevm, loadvm or delvm command in qemu monitor"""
     assert action in ['savevm', 'loadvm', 'delvm'], "vm_action error: Invalid args"
-    if gdbmi:
+    if session:
+        # savevm/loadvm of a large guest can take a while
+        session.monitor(f"{action} {snapname}", timeout_sec=120)
+    elif gdbmi:
         commands = ["set logging enable on", "target remote:1234", "maintenance packet Qqemu.PhyMemMode:1",
                     f"monitor {action} {snapname}", "detach"]
         gdbmi.write(commands, timeout_sec=5, read_response=False)
@@ -103,41 +273,311 @@ def vm_action(action, snapname, gdbmi: GdbController=None):
         subprocess.run(['./gdb.sh'], check=True, stdout=subprocess.DEVNULL)
     print(f"{action} {snapname}")
 
-def autoinject_ram(fault_number: int, min_interval: int, max_interval: int, area: str = "System RAM", gdbmi: GdbController=None):
-    """Automatically inject faults into RAM, interval unit is nanosecond"""
-    address_dict = extract('iomem.txt')
+def autoinject_ram(fault_number: int, min_interval: int, max_interval: int, area: str = "System RAM", gdbmi: GdbController=None,
+                   session=None, backend="gdbmi", plan=None, upset=None, exclude=None, symbols=None, ranges=None,
+                   symbol_map="System.map", log=None):
+    """Automatically inject faults into RAM, interval unit is nanosecond.
+    backend is used to open a session when none is given, see open_session.
+    plan is a plan file or an iterator from plan.iter_plan. If given, the next fault_number records of the plan
+    are replayed and min_interval, max_interval and area are only used for printing.
+    upset is a multi-bit upset like "bits:3", "bytes:2" or "rows:4:8192" (see upset.py) flipped around every fault,
+    default is a single bit.
+    area is any resource name of iomem.txt, faults are drawn from all its ranges. exclude is a list of resources
+    inside area that are not flipped, e.g. ["Kernel code", "Kernel data"], or "*" for all its children.
+    symbols flips kernel symbols and sections of symbol_map instead of area, e.g. ["init_task", "*_cachep", ".rodata"],
+    see ksyms.py. symbol_map is System.map or, for exact symbol sizes, vmlinux.
+    The cells of an upset stay inside ranges (inclusive), default is the ranges the faults are drawn from, or the
+    ranges of area for a plan.
+    log is a fliplog.BufferedLogger or the name of a csv log every flipped byte is written to as a "ram" record of
+    the logger's current trial, see fliplog.py.
+    Return [(address, old, new)] of the flipped bytes, empty without a session (gdbmi and gdb.sh)."""
+    upset = Upset.parse(upset) if isinstance(upset, str) else upset
+    index = iomem.load('iomem.txt')
     print("current qemu ram mapping is:")
-    for k, v in address_dict.items():
-        print(f'{k}: [0x{v[0][0]}, 0x{v[0][1]}]')
-   
-    gdbmi, shouldexit = (GdbController(), True) if gdbmi is None else (gdbmi, False)
+    for name in dict.fromkeys(iomem.AREAS + (area,)):
+        area_ranges = index.ranges(name)
+        print(f'{name}: ' + (', '.join(f'[0x{start:x}, 0x{end:x}]' for start, end in area_ranges) or 'not in iomem.txt'))
+    if plan is None:
+        sampler = target_sampler(area, exclude, symbols, index, symbol_map)
+        if symbols:
+            area = ",".join(symbols)
+        assert sampler.size(), f"autoinject_ram error: no address of {area} left to flip"
+        if exclude or symbols:
+            print(f'{area}{f" without {exclude}" if exclude else ""}: {len(sampler.ranges)} ranges, 0x{sampler.size():x} bytes')
 
-    for _ in range(fault_number):
-        flip_bit_in_area(address_dict, area, gdbmi)
-        time.sleep(random.randint(min_interval, max_interval) * 1e-9)
+    if ranges is None:
+        ranges = index.ranges(area) if plan is not None else sampler.ranges
+    session, shouldclose = (open_session(backend, gdbmi), True) if session is None else (session, False)
+    logger = fliplog.BufferedLogger(log) if isinstance(log, str) else log
 
-    if shouldexit:
-        gdbmi.exit()
+    changes = []
 
-def snapinject_ram(fault_number: int, min_interval: int, max_interval: int, observe_time: int, loop = 1):
+    def inject(address, bit):
+        flipped = flip_bit(address, bit, area, session=session, upset=upset, ranges=ranges) or []
+        if logger:
+            for changed, old, new in flipped:
+                logger.log("ram", changed, old, new)
+        changes.extend(flipped)
+
+    if plan is not None:
+        records = iter_plan(plan) if isinstance(plan, str) else plan
+        for interval, address, bit, width, target in itertools.islice(records, fault_number):
+            assert target == TARGET_RAM, "autoinject_ram error: plan has non-ram records"
+            time.sleep(interval * 1e-9)
+            inject(address + bit // 8, bit % 8)
+    else:
+        for _ in range(fault_number):
+            inject(sampler.sample(), random.randint(0, 7))
+            time.sleep(random.randint(min_interval, max_interval) * 1e-9)
+
+    if shouldclose:
+        session.close()
+    if logger is not log:
+        logger.close()
+    return changes
+
+
+class Observer:
+    """
+    Wait for the observation window of a trial, but return as soon as the guest fails:
+    a GUEST_PANICKED/SHUTDOWN event on the QMP socket or a failure message in the console log (see console.py).
+    label() gives the outcome of the trial: crash, oops, hang, SDC or benign.
+    """
+    def __init__(self, qmp_path=None, console_file=None, golden=None):
+        """
+        :param golden: result the workload prints with its OK marker in a fault free run, see console.ConsoleClassifier"""
+        self.failed = threading.Event()
+        self.reason = None
+        self.started = self.failed_at = time.time()
+        self.trial = -1
+        self.console = ConsoleClassifier(console_file, golden=golden) if console_file else None
+        self.loop = None
+        if qmp_path:
+            # the qmp client runs in its own event loop thread, events arrive while the trial sleeps
+            self.loop = asyncio.new_event_loop()
+            self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+            self.thread.start()
+            self.client = QmpClient(qmp_path)
+            self.client.on("*", self.on_event)
+            asyncio.run_coroutine_threadsafe(self.client.connect(), self.loop).result(timeout=10)
+
+    def on_event(self, message):
+        if message["event"] in FAILURE_EVENTS:
+            self.fail(message["event"])
+
+    def fail(self, reason):
+        if not self.failed.is_set():
+            self.reason = reason
+            self.failed_at = time.time()
+            self.failed.set()
+
+    def arm(self):
+        """Start a trial, call it before the first flip so failures during injection count"""
+        self.failed.clear()
+        self.reason = None
+        self.started = time.time()
+        self.trial += 1
+        if self.console:
+            self.console.begin(self.trial)
+
+    def observe(self, observe_time):
+        """Wait up to observe_time seconds, return the seconds from arm() to the failure or None"""
+        deadline = time.time() + observe_time
+        while not self.failed.is_set():
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            if self.console:
+                match = self.console.failure(self.console.classify())
+                if match:
+                    self.fail("console: " + match.text)
+                    break
+                remaining = min(remaining, OBSERVE_POLL_SEC)
+            self.failed.wait(remaining)
+        return self.failed_at - self.started if self.failed.is_set() else None
+
+    def label(self):
+        """End the trial and return its label. Without a console log only failures seen on QMP count, as crash."""
+        label = self.console.end() if self.console else "benign"
+        if self.reason in FAILURE_EVENTS:
+            return "crash"
+        return label
+
+    def crash(self):
+        """(pc, backtrace) of the oops printed in the trial, see console.crash_report"""
+        return self.console.crash(self.trial) if self.console else (None, [])
+
+    def close(self):
+        if self.loop:
+            asyncio.run_coroutine_threadsafe(self.client.close(), self.loop).result(timeout=10)
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join(timeout=10)
+            self.loop.close()
+        if self.console:
+            self.console.close()
+
+# phases of a snapinject_ram trial, "stall" is host time the next trial waits for
+PHASES = ("inject", "observe", "capture", "revert", "stall")
+
+def snapinject_ram(fault_number: int, min_interval: int, max_interval: int, observe_time: int, loop = 1, backend="gdbmi",
+                   plan=None, qmp=None, console=None, tmpfs=None, area="System RAM", golden=None, track=None, upset=None,
+                   exclude=None, symbols=None, target_width=None, confidence=CONFIDENCE, method="wilson", per_area=False,
+                   symbol_map="System.map", log=None, log_format="csv"):
     """
     Record the current VM state, then automatically inject faults according to the user-provided fault count and 
     fault interval. After the faults are injected, wait for a while and then revert to the
     previous VM state. 
+    If plan file is given, every loop replays the next fault_number records of the plan.
+    If qmp socket file or console log file is given, the observation ends as soon as the guest panics or shuts down.
+    Every loop is labeled crash, oops, hang, SDC or benign from the console log, golden is the result the workload
+    prints with its OK marker when no fault is injected (see console.py).
+    If tmpfs directory is given, the disk is switched to an overlay in it so savevm/loadvm do not touch the disk image,
+    see snapshot.SnapshotPool.
+    Only inject, observe and revert touch the guest. The flips of the next loop are prepared and the outcome is
+    reported while the VM reverts, over the qmp socket (snapshot-load) if given, in a thread otherwise.
+    If track is given, the RAM flipped in (area, or the symbols or plan ranges) is captured into that directory (True: DEFAULT_TMPFS) at the snapshot, at the
+    end of a fault free observation first and at the end of every observation, and every flip is reported persisted
+    or overwritten, with the bytes of its page that differ from the fault free run, see propagation.py.
+    upset flips a multi-bit upset around every fault, exclude leaves resources inside area alone, symbols flips kernel
+    symbols of symbol_map instead of area, see autoinject_ram.
+    A failed loop also prints its crash (PC and call trace of the oops, or the PC after a panic), see attribution.py.
+    If target_width is given, loop is the maximum: the loops stop once the confidence interval (method "wilson" or
+    "clopper-pearson") of the failure rate is at most target_width wide, of every iomem area hit if per_area is set,
+    the estimate is printed after every loop, see estimate.py.
+    If log is given, every flipped byte is written to that fliplog file (log_format "csv" or "bin") with the number
+    of its trial, the trial printed with the outcome, so results.py can join the flips to the outcomes.
     """
+    # without a failure source every loop is benign and the estimate never moves
+    assert not target_width or qmp or console, "target_width needs qmp or console"
     # tmpname = uuid.uuid4().hex
     tmpname = "snapinject_begin"
-    gdbmi = GdbController()
+    session = open_session(backend)
+    upset = Upset.parse(upset) if isinstance(upset, str) else upset or Upset()
+    records = iter_plan(plan) if plan is not None else None
+    index = iomem.load('iomem.txt') if plan is None or track or per_area else None
+    sampler = target_sampler(area, exclude, symbols, index, symbol_map) if plan is None else None
+    # the cells of an upset stay in the flipped ranges
+    upset_ranges = sampler.ranges if sampler else (index or iomem.load('iomem.txt')).ranges(area)
+    observer = Observer(qmp, console, golden)
+    logger = fliplog.BufferedLogger(log, log_format) if log else None
+    stop = AdaptiveStop(target_width, confidence, method, iomem_index=index if per_area else None) \
+        if target_width else None
+    # savevm/loadvm of a large guest can take a while
+    pool = SnapshotPool(lambda command: session.monitor(command, timeout_sec=120), tmpfs)
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=2)
 
-    vm_action('savevm', tmpname, gdbmi)
+    def prepare():
+        if records is not None:
+            return list(itertools.islice(records, fault_number))
+        return draw_records(fault_number, min_interval, max_interval, sampler)
 
-    for _ in range(loop):
-        autoinject_ram(fault_number, min_interval, max_interval, gdbmi=gdbmi)
-        print("Observing the machine for %d seconds" % observe_time)
+    def revert(resume):
+        st = time.perf_counter()
+        if observer.loop:
+            asyncio.run_coroutine_threadsafe(pool.load_qmp(tmpname, observer.client), observer.loop).result()
+        else:
+            pool.load(tmpname)
+        if resume:
+            # a panicked or stopped guest stays paused, loadvm only resumes a running vm
+            session.monitor("cont")
+        return time.perf_counter() - st
+
+    if track:
+        # propagation.py needs numpy, the other modes do not
+        import propagation
+        track = DEFAULT_TMPFS if track is True else track
+        # the ranges flips are drawn from and upsets are clipped to, so every flipped byte is captured
+        track_ranges = propagation.capture_ranges(upset_ranges)
+        hmp = lambda command: session.monitor(command, timeout_sec=120)
+        # every trial starts from the snapshot, its memory is captured once
+        session.monitor("stop")
+        pool.save(tmpname)
+        before = propagation.capture(hmp, track_ranges, track, "before")
+        after = []
+        # a fault free run of the snapshot is the reference of the propagated bytes, not the memory before the flips
+        print("Observing the machine for %d seconds without faults" % observe_time)
+        session.monitor("cont")
         time.sleep(observe_time)
-        vm_action('loadvm', tmpname, gdbmi)
+        session.monitor("stop")
+        reference = propagation.capture(hmp, track_ranges, track, "reference")
+        pool.load(tmpname)
+        session.monitor("cont")
+    else:
+        pool.save(tmpname)
+
+    timings = dict.fromkeys(PHASES, 0.0)
+    upcoming = executor.submit(prepare)
+    loops = 0
+    for i in range(loop):
+        st = time.perf_counter()
+        flips = upcoming.result()
+        timings["stall"] += time.perf_counter() - st
+
+        observer.arm()
+        if logger:
+            logger.trial = observer.trial
+        st = time.perf_counter()
+        changes = autoinject_ram(fault_number, min_interval, max_interval, area, session=session, plan=iter(flips),
+                                 upset=upset, ranges=upset_ranges, log=logger)
+        timings["inject"] += time.perf_counter() - st
+        print("Observing the machine for %d seconds" % observe_time)
+        st = time.perf_counter()
+        failure_time = observer.observe(observe_time)
+        reason = observer.reason
+        timings["observe"] += time.perf_counter() - st
+        if track:
+            st = time.perf_counter()
+            session.monitor("stop")
+            after = propagation.capture(hmp, track_ranges, track, "after")
+            timings["capture"] += time.perf_counter() - st
+
+        # the guest is paused by its panic until the revert
+        pc = register_pc(session.monitor("info registers")) if reason == "GUEST_PANICKED" else None
+        # the guest is restored while this loop is reported and the flips of the next one are drawn
+        st = time.perf_counter()
+        reverting = executor.submit(revert, reason == "GUEST_PANICKED" or bool(track))
+        if i + 1 < loop:
+            upcoming = executor.submit(prepare)
+        if failure_time is not None:
+            print("Guest failed (%s) %.3fs after the first flip" % (reason, failure_time))
+        label = observer.label()
+        print("Trial %d: %s" % (observer.trial, label))
+        console_pc, backtrace = observer.crash()
+        if label != "benign" and (console_pc or pc or backtrace):
+            print(crash_line(observer.trial, console_pc or pc, backtrace))
+        if track:
+            cells = [cell for _, address, bit, _, _ in flips for cell in within(upset.cluster(address, bit), upset_ranges)]
+            _, totals = propagation.diff(before, after, cells, reference,
+                                         injected_values={address: new for address, _, new in changes})
+            print("Trial %d: %d flips persisted, %d overwritten, %d bytes changed in their pages from the fault free run"
+                  % (observer.trial, totals["persisted"], totals["overwritten"], totals["propagated"]))
+            if totals["missing"]:
+                print("Trial %d: %d flipped bytes are outside the captures" % (observer.trial, totals["missing"]))
+        if stop:
+            stop.add(label != "benign", [address for _, address, _, _, _ in flips])
+            print("Failure rate after %d loops:\n%s" % (i + 1, stop.report()))
+        revert_time = reverting.result()
+        timings["revert"] += revert_time
+        timings["stall"] += max(0.0, time.perf_counter() - st - revert_time)
+        loops = i + 1
+        if stop and stop.done():
+            print("Stopping after %d loops: the failure rate intervals are at most %.2f%% wide"
+                  % (loops, target_width * 100))
+            break
 
-    # WARN: If QEMU shutdown before this vm_action, snapshot will not delete correctly.
-    vm_action('delvm', tmpname, gdbmi)
+    executor.shutdown()
+    if track:
+        propagation.remove(before)
+        propagation.remove(reference)
+        propagation.remove(after)
+    print("mean per loop: " + ", ".join("%s %.2f ms" % (phase, timings[phase] / max(loops, 1) * 1000)
+                                         for phase in PHASES))
+    # the pool deletes the snapshot, at exit also if an exception ends the loop. If QEMU is gone before,
+    # the snapshot only survives in the disk image when no tmpfs overlay is used.
+    pool.report()
+    pool.close()
 
-    gdbmi.exit()
\ No newline at end of file
+    if logger:
+        logger.close()
+    observer.close()
+    session.close()
@@ -1,10 +1,30 @@
 import gdb
+import bisect
+import json
+import os
 import random
 import re
+import sys
 import time
-import csv
 import uuid
 
+# plan.py and fliplog.py live in the repository root, shared with the host side scripts
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from plan import TARGET_RAM, iter_plan
+from fliplog import BufferedLogger, format_target
+from console import ConsoleClassifier
+from attribution import crash_line, register_pc
+from snapshot import SnapshotPool
+from upset import Upset, flip_blocks, within
+from iomem import RangeSampler, load as load_iomem
+import ksyms
+
+try:
+    import numpy
+except ImportError:
+    # gdb may be linked against a python without numpy, fall back to plain bytearray loops
+    numpy = None
+
 class MemoryRange:
     def __init__(self, start, end, priority, kind, name):
         self.start, self.end, self.priority, self.kind, self.name = start, end, priority, kind, name
@@ -27,6 +47,8 @@ class MemoryRange:
 class FlatView:
     def __init__(self):
         self.ranges = []
+        # (ram start addresses, prefix sums of ram sizes), built on the first sample
+        self.ram_index = None
 
     @staticmethod
     def parse(lines):
@@ -38,43 +60,60 @@ class FlatView:
     def ram_ranges(self):
         return [(r.start, r.end) for r in self.ranges if r.kind == "ram"]
 
+    def build_ram_index(self):
+        starts, offsets = [], [0]
+        for start, end in self.ram_ranges():
+            # mtree ranges are inclusive
+            starts.append(start)
+            offsets.append(offsets[-1] + end - start + 1)
+        assert starts, "no ram ranges in view"
+        self.ram_index = (starts, offsets)
+
     def random_address(self):
-        ranges = self.ram_ranges()
-        lens = [(end - start) for start, end in ranges]
-        offset = random.randint(0, sum(lens) - 1)
-        for start, end in ranges:
-            offset += start
-            if offset < end:
-                return offset
-            offset -= end
-        assert False, "should have been in range!"
-
-class CsvLogger:
-    def __init__(self, filename) -> None:
-        self.filename = filename
-        with open(self.filename, mode='w', newline='') as file:
-            writer = csv.writer(file)
-            # 写入表头
-            writer.writerow(['Address/Register', 'Old Value', 'New Value'])
-
-    def log(self, address_or_register, old_value, new_value):
-        with open(self.filename, mode='a', newline='') as file:
-            writer = csv.writer(file)
-            writer.writerow([address_or_register, old_value, new_value])
+        if self.ram_index is None:
+            self.build_ram_index()
+        starts, offsets = self.ram_index
+        offset = random.randrange(offsets[-1])
+        i = bisect.bisect_right(offsets, offset) - 1
+        return starts[i] + offset - offsets[i]
 
 logger = None
 
-def init_logger(filename):
+def init_logger(filename, fmt="csv", flush_interval=1.0, capacity=65536):
     global logger
-    logger = CsvLogger(filename)
+    if logger:
+        logger.close()
+    logger = BufferedLogger(filename, fmt, flush_interval, capacity)
 
-def log_single(address_or_register, old_value, new_value):
+def log_single(kind, address_or_register, old_value, new_value):
     if logger:
-        logger.log(address_or_register, old_value, new_value)
+        logger.log(kind, address_or_register, old_value, new_value)
     else:
-        print("Injected bitflip into address/register %s: old value %s -> new value %s" % (address_or_register, old_value, new_value))
+        print("Injected bitflip into address/register %s: old value %s -> new value %s"
+              % (format_target(address_or_register), hex(old_value), hex(new_value)))
+
+# id of the current snapinject trial
+trial = 0
+
+def next_trial():
+    """Tag the following log records and console messages with a new trial id"""
+    global trial
+    trial += 1
+    if logger:
+        logger.trial = trial
+    if console_tail:
+        console_tail.begin(trial)
+
+def flush_log():
+    if logger:
+        logger.flush()
+
+# monitor commands after which the memory map may be different
+MTREE_CHANGING_COMMANDS = ("loadvm", "system_reset", "device_add", "device_del", "object_add", "object_del")
 
 def qemu_hmp(cmdstr):
+    if cmdstr.split(" ", 1)[0] in MTREE_CHANGING_COMMANDS:
+        invalidate_memory_view()
     return gdb.execute("monitor %s" % cmdstr, to_string=True).strip()
 
 def mtree():
@@ -112,23 +151,143 @@ def mtree():
             assert not line, "unexpected line: %r" % line
     return {name: FlatView.parse(body) for name, body in views.items()}
 
-cached_reg_list = None
+cached_memory_view = None
+
+def memory_view():
+    """The FlatView of the "memory" address space, parsed once and reused until invalidated"""
+    global cached_memory_view
+    if cached_memory_view is None:
+        cached_memory_view = mtree()["memory"]
+    return cached_memory_view
+
+def invalidate_memory_view(*args):
+    global cached_memory_view
+    cached_memory_view = None
+
+# a new connection or a restarted qemu may have another memory map
+gdb.events.exited.connect(invalidate_memory_view)
+if hasattr(gdb.events, "connection_removed"):
+    gdb.events.connection_removed.connect(invalidate_memory_view)
+
+# register types that can be flipped. We can avoid needing to handle float and 'union neon_q', because on ARM,
+# there are d# registers that alias to all of the more specialized registers in question.
+INJECTABLE_TYPES = ("long", "void *", "void (*)()", "union aarch64v")
+# register flips only reach the lower 64 bits of a register or of a vector lane
+REG_BITS = 64
+
+class RegisterLayout:
+    """Where the flippable bits of a register are and how to write them, worked out once per register"""
+    def __init__(self, descriptor, value):
+        self.name = descriptor.name
+        self.descriptor = descriptor
+        self.sizeof = value.type.sizeof
+        # union aarch64v have 128 bits, they are flipped as two 64 bit lanes $v.d.u[0] and $v.d.u[1]
+        self.vector = str(value.type) == "union aarch64v"
+        self.lanes = 2 if self.vector else 1
+        # "long" and pointers of a 32 bit guest have 4 bytes
+        self.bits = REG_BITS if self.vector else min(8 * self.sizeof, REG_BITS)
+        self.mask = (1 << self.bits) - 1
+        # assignment expression evaluated by gdb.parse_and_eval, no command output to print and parse
+        self.assign = ("$%s.d.u[%%d] = %%d" if self.vector else "$%s = %%d") % self.name
+
+    def read(self, frame, lane=0):
+        value = frame.read_register(self.descriptor)
+        if self.vector:
+            value = value["d"]["u"][lane]
+        return int(value) & self.mask
+
+    def write(self, lane, new_value):
+        gdb.parse_and_eval(self.assign % ((lane, new_value) if self.vector else new_value))
+
+class RegisterTable:
+    """The injectable registers of a frame with their layouts, and the registers matched by wildcard patterns"""
+    def __init__(self, frame):
+        self.layouts = []
+        for descriptor in frame.architecture().registers():
+            value = frame.read_register(descriptor)
+            if str(value.type) in INJECTABLE_TYPES:
+                self.layouts.append(RegisterLayout(descriptor, value))
+        self.by_name = {layout.name: layout for layout in self.layouts}
+        self.architecture = frame.architecture().name()
+        # pattern -> matching layouts
+        self.filters = {}
+
+    def match(self, pattern):
+        """Layouts matching a pattern with wildcards like "r*x", None matches all"""
+        if pattern is None:
+            return self.layouts
+        if pattern not in self.filters:
+            regexp = re.compile("^" + ".*".join(re.escape(segment) for segment in pattern.split("*")) + "$")
+            self.filters[pattern] = [layout for layout in self.layouts if regexp.match(layout.name)]
+        return self.filters[pattern]
+
+# thread number -> RegisterTable, threads of the same architecture share one table
+register_tables = {}
+# the vCPU threads of the inferior in cpu index order, and "uniform" or their sampling weights (regthreads)
+cached_threads = None
+thread_weights = None
+# vCPU -> number of register flips
+register_flip_counts = {}
+
+def vcpu_threads():
+    global cached_threads
+    if cached_threads is None:
+        cached_threads = sorted(gdb.selected_inferior().threads(), key=lambda thread: thread.ptid[1])
+    return cached_threads
+
+def vcpu_name(thread):
+    # qemu numbers its remote threads cpu index + 1, thread.num is gdb's own counter
+    return "cpu%d" % (thread.ptid[1] - 1)
+
+def sample_thread():
+    """A random vCPU thread, uniform or weighted by thread_weights"""
+    threads = vcpu_threads()
+    if thread_weights is None:
+        return random.choice(threads)
+    weights = (thread_weights + [0] * len(threads))[:len(threads)]
+    return random.choices(threads, weights=weights)[0]
+
+def register_table(thread=None):
+    """The register table of thread, default is the selected thread. Select thread before using its layouts."""
+    thread = thread or gdb.selected_thread()
+    table = register_tables.get(thread.num)
+    if table is None:
+        frame = gdb.selected_frame()
+        architecture = frame.architecture().name()
+        # another thread of the same architecture already has the metadata
+        table = next((table for table in register_tables.values() if table.architecture == architecture), None)
+        table = table or RegisterTable(frame)
+        register_tables[thread.num] = table
+    return table
+
+def invalidate_register_table(*args):
+    global cached_threads
+    register_tables.clear()
+    cached_threads = None
+
+def invalidate_threads(*args):
+    global cached_threads
+    cached_threads = None
+
+# another connection may be another architecture
+gdb.events.exited.connect(invalidate_register_table)
+if hasattr(gdb.events, "connection_removed"):
+    gdb.events.connection_removed.connect(invalidate_register_table)
+if hasattr(gdb.events, "new_thread"):
+    gdb.events.new_thread.connect(invalidate_threads)
 
 def list_registers():
-    global cached_reg_list
-    if cached_reg_list is None:
-        # we can avoid needing to handle float and 'union neon_q', because on ARM, there are d# registers that alias
-        # to all of the more specialized registers in question.
-        frame = gdb.selected_frame()
-        cached_reg_list = [(r, frame.read_register(r).type.sizeof)
-                           for r in frame.architecture().registers()
-                           if str(frame.read_register(r).type) in ("long", "void *", "void (*)()", "union aarch64v")]
-    return cached_reg_list[:]
+    return [(layout.descriptor, layout.sizeof) for layout in register_table().layouts]
+
+# multi-bit upset flipped around every ram fault, set by the upset command
+upset_mode = Upset()
 
 def inject_bitflip(address, bytewidth, bit=None):
     assert bytewidth >= 1, "invalid bytewidth: %u" % bytewidth
     if bit is None:
         bit = random.randint(0, bytewidth * 8 - 1)
+    if upset_mode.mode != "single":
+        return inject_upset(address, bit)
 
     inferior = gdb.selected_inferior()
     # endianness doesn't actually matter for this purpose, so always use little-endian
@@ -140,78 +299,144 @@ def inject_bitflip(address, bytewidth, bit=None):
 
     assert nvalue == rnvalue and nvalue != ovalue, \
         "mismatched values: o=0x%x n=0x%x rn=0x%x" % (ovalue, nvalue, rnvalue)
-    log_single(hex(address), hex(ovalue), hex(nvalue))
+    log_single("ram", address, ovalue, nvalue)
+
+def inject_upset(address, bit):
+    """
+    Flip the cluster of upset_mode around bit of address, every block is read, written and verified once.
+    Cells outside the RAM of the memory map are skipped.
+    """
+    inferior = gdb.selected_inferior()
+    read = lambda start, length: bytes(inferior.read_memory(start, length))
+    cluster = upset_mode.cluster(address, bit)
+    cells = within(cluster, memory_view().ram_ranges())
+    if len(cells) < len(cluster):
+        print("Skip %d of %d cells of the upset at 0x%x outside RAM" % (len(cluster) - len(cells), len(cluster), address))
+    for changed, ovalue, nvalue in flip_blocks(cells, read, inferior.write_memory):
+        log_single("ram", changed, ovalue, nvalue)
+
+# bytes read and written at once by inject_range sequential mode
+RANGE_CHUNK = 1 << 20
+
+def flip_words(buf, bytewidth):
+    """Flip one random bit in every bytewidth-sized word of buf in place, return the flipped bit of each word"""
+    count = len(buf) // bytewidth
+    if numpy is not None:
+        bits = numpy.random.randint(0, bytewidth * 8, count)
+        view = numpy.frombuffer(buf, dtype=numpy.uint8)
+        view[numpy.arange(count) * bytewidth + bits // 8] ^= (1 << (bits % 8)).astype(numpy.uint8)
+        return bits.tolist()
+    bits = [random.randrange(bytewidth * 8) for _ in range(count)]
+    for i, bit in enumerate(bits):
+        buf[i * bytewidth + bit // 8] ^= 1 << (bit % 8)
+    return bits
+
+def inject_bitflip_sweep(start, end, bytewidth):
+    """Flip one bit in every word from start to end (inclusive), one read/write/verify per RANGE_CHUNK"""
+    inferior = gdb.selected_inferior()
+    chunk_words = max(RANGE_CHUNK // bytewidth, 1)
+    count = len(range(start, end + 1, bytewidth))
+    for first in range(0, count, chunk_words):
+        address = start + first * bytewidth
+        length = min(chunk_words, count - first) * bytewidth
+        old = bytes(inferior.read_memory(address, length))
+        new = bytearray(old)
+        flip_words(new, bytewidth)
+        inferior.write_memory(address, new)
+
+        readback = bytes(inferior.read_memory(address, length))
+        assert readback == new, "mismatched values in chunk at 0x%x" % address
+        for offset in range(0, length, bytewidth):
+            log_single("ram", address + offset,
+                       int.from_bytes(old[offset:offset + bytewidth], "little"),
+                       int.from_bytes(new[offset:offset + bytewidth], "little"))
+
+def sample_range_addresses(ranges, bytewidth, k):
+    """Sample k distinct word addresses from inclusive ranges without listing them"""
+    starts, offsets = [], [0]
+    for start, end in ranges:
+        starts.append(start)
+        offsets.append(offsets[-1] + len(range(start, end + 1, bytewidth)))
+    if k > offsets[-1]:
+        return None
+    addresses = []
+    # random.sample only keeps the selected indexes of a range population
+    for index in random.sample(range(offsets[-1]), k):
+        i = bisect.bisect_right(offsets, index) - 1
+        addresses.append(starts[i] + (index - offsets[i]) * bytewidth)
+    return addresses
 
 def sample_address():
-    return mtree()["memory"].random_address()
+    return memory_view().random_address()
+
+def flip_registers(flips, vcpu=None):
+    """
+    Flip (layout, lane, bit) of several registers of the selected thread in one stop: all are read, written,
+    then verified. Return the layouts that took the flip. vcpu is logged with the register names.
+    """
+    frame = gdb.selected_frame()
+    old_values = [layout.read(frame, lane) for layout, lane, bit in flips]
+    for (layout, lane, bit), old_value in zip(flips, old_values):
+        layout.write(lane, old_value ^ (1 << bit))
+    # gdb drops its frames after a register write
+    frame = gdb.selected_frame()
+    flipped = []
+    for (layout, lane, bit), old_value in zip(flips, old_values):
+        new_value = old_value ^ (1 << bit)
+        read_value = layout.read(frame, lane)
+        if read_value == new_value:
+            log_single("reg", "%s/%s" % (vcpu, layout.name) if vcpu else layout.name, old_value, read_value)
+            flipped.append(layout)
+        elif read_value == old_value:
+            print("Bitflip could not be injected into register %s. (%s -> %s ignored.)"
+                  % (layout.name, hex(old_value), hex(new_value)))
+        else:
+            raise RuntimeError("double-mismatched register values on register %s: o=%s n=%s rr=%s"
+                               % (layout.name, hex(old_value), hex(new_value), hex(read_value)))
+    if vcpu:
+        register_flip_counts[vcpu] = register_flip_counts.get(vcpu, 0) + len(flipped)
+    return flipped
+
+def on_thread(thread, function, *args):
+    """Call function(*args, vcpu) with thread selected, vcpu is its name when the guest has several vCPUs"""
+    previous = gdb.selected_thread()
+    if thread != previous:
+        thread.switch()
+    try:
+        return function(*args, vcpu_name(thread) if len(vcpu_threads()) > 1 else None)
+    finally:
+        if thread != previous and previous is not None:
+            previous.switch()
+
+def random_register_flip(layout, bit=None, lane=None):
+    """(layout, lane, bit) of a random bit of the register, the lane of a vector is random too unless given"""
+    lane = random.randrange(layout.lanes) if lane is None else lane
+    return layout, lane, random.randrange(layout.bits) if bit is None else bit
 
 def inject_register_bitflip(register_name, bit=None):
-    value = gdb.selected_frame().read_register(register_name)
+    """Flip a bit of a register of the selected thread"""
+    return bool(flip_registers([random_register_flip(register_table().by_name[register_name], bit)]))
 
-    # union aarch64v have 128 bits, but we can only flip 64 of them
-    bitcount = min(8 * value.type.sizeof, 64)
-    bitmask = (1 << bitcount) - 1
-    if bit is None:
-        bit = random.randint(0, bitcount - 1)
-
-    if str(value.type) == "union aarch64v":
-        # $v register, 128 bits.
-        # register $v schema: 
-        #  {
-        #   d = {f = {double, double}, u = {uint64_t, uint64_t}, s = {int64_t, int64_t}}, 
-        #   s = {f = {float, ... 3 times}, u = {uint32_t,... 3 times}, s = {int32_t, ... 3 times}}, 
-        #   h = {u = {unsigned, ... 7 times}, s = {signed, ... 7 times}}, 
-        #   b = {u = {uint8_t, <repeats 15 times>}, s = {int8_t, <repeats 15 times>}}, 
-        #   q = {u = {uint128_t}, s = {int128_t}}
-        #  }
-        # For example, access registers q0-q31 to get the 128 bits, d0-d31 to get the 64 bits, and so on.
-
-        # random pick upper 64 or lower 64
-        index = random.randint(0, 1)
-        oldval = int(gdb.execute("p ((int64_t[2])$%s)[%d]" % (register_name, index), to_string=True)
-                     .split("=")[1].strip())
-        newval = oldval ^ (1 << bit)
-        gdb.execute("set ((int64_t[2])$%s)[%d] = %d" % (register_name, index, newval))
-        rrval = int(gdb.execute("p ((int64_t[2])$%s)[%d]" % (register_name, index), to_string=True)
-                    .split("=")[1].strip())
-    else:
-        # normal register, 64 bits
-        assert value.type.sizeof == 8, "invalid general register size: %u" % value.type.sizeof
-        oldval = int(value)
-        newval = oldval ^ (1 << bit)
-        gdb.execute("set $%s = %d" % (register_name, newval))
-        rrval = int(gdb.selected_frame().read_register(register_name))
-    
-    if (newval & bitmask) == (rrval & bitmask):
-        log_single(register_name, hex(oldval), hex(rrval))
-        return True
-    elif (oldval & bitmask) == (rrval & bitmask):
-        print("Bitflip could not be injected into register %s. (%s -> %s ignored.)"
-              % (register_name, hex(oldval), hex(newval)))
-        return False
-    else:
-        raise RuntimeError("double-mismatched register values on register %s: o=%s n=%s rr=%s"
-                           % (register_name, hex(oldval), hex(newval), hex(rrval)))
-    
-def inject_reg_internal(register_name, bit=None):
-    registers = [r.name for r, nb in list_registers()]
-    if register_name:
-        # Support wildcard input like "r*x"
-        regexp = re.compile("^" + ".*".join(re.escape(segment) for segment in register_name.split("*")) + "$")
-        registers = [rname for rname in registers if regexp.match(rname)]
-    if not registers:
+def inject_reg_internal(register_name, bit=None, count=1, thread=None):
+    """Flip count distinct random registers matching register_name in one stop, of thread or a sampled vCPU"""
+    on_thread(thread or sample_thread(), inject_thread_registers, register_name, bit, count)
+
+def inject_thread_registers(register_name, bit, count, vcpu):
+    layouts = register_table().match(register_name)
+    if not layouts:
         print("No registers found!")
         return
     # this is the order to try them in
-    random.shuffle(registers)
-
-    for reg in registers:
-        # keep retrying until we find a register that we CAN successfully inject into
-        if inject_register_bitflip(reg, bit):
-            break
-
-        print("Trying another register...")
-    else:
+    candidates = random.sample(layouts, len(layouts))
+
+    remaining = count
+    while remaining and candidates:
+        # keep retrying until enough registers took the flip
+        batch, candidates = candidates[:remaining], candidates[remaining:]
+        remaining -= len(flip_registers([random_register_flip(layout, bit) for layout in batch], vcpu))
+        if remaining and candidates:
+            print("Trying another register...")
+    if remaining:
         print("Out of registers to try!")
 
 def inject_instant_restart():
@@ -224,6 +449,52 @@ def inject_instant_restart():
 def step_ns(ns):
     qemu_hmp("cont")
     qemu_hmp("stop_delayed %s" % ns)
+    flush_registers()
+
+def flush_registers():
+    """Drop the register values gdb cached, monitor cont/stop run the guest behind the back of gdb"""
+    try:
+        gdb.execute("maintenance flush register-cache", to_string=True)
+    except gdb.error:
+        # gdb < 12
+        gdb.execute("flushregs", to_string=True)
+
+# observation runs in slices of this many nano-seconds, guest failures are checked between slices. Every slice
+# stops and restarts the guest, so they are long, see the observeslice command
+OBSERVE_SLICE_NS = 1000 * 1000 * 1000
+observe_slice_ns = OBSERVE_SLICE_NS
+
+console_tail = None
+snapshot_pool = None
+
+def get_snapshot_pool():
+    global snapshot_pool
+    if snapshot_pool is None:
+        snapshot_pool = SnapshotPool(qemu_hmp)
+    return snapshot_pool
+
+def guest_failed():
+    """Return why the guest failed, None if it is still alive"""
+    status = qemu_hmp("info status")
+    if "guest-panicked" in status or "shutdown" in status:
+        return status
+    if console_tail:
+        match = console_tail.failure(console_tail.classify())
+        if match:
+            return "console: " + match.text
+    return None
+
+def observe_ns(ns):
+    """Run the VM for ns nano-seconds, but stop as soon as the guest fails. Return (reason or None, elapsed ns)"""
+    elapsed = 0
+    while elapsed < ns:
+        step = min(observe_slice_ns, ns - elapsed)
+        step_ns(step)
+        elapsed += step
+        reason = guest_failed()
+        if reason:
+            return reason, elapsed
+    return None, elapsed
 
 time_units = {
     "": 1,
@@ -265,7 +536,9 @@ def listram(args):
     """List all RAM ranges allocated by QEMU."""
 
     print("QEMU RAM list:")
-    memory = mtree()["memory"]
+    global cached_memory_view
+    # always re-read the map here, this also refreshes the sampling cache
+    memory = cached_memory_view = mtree()["memory"]
     for start, end in memory.ram_ranges():
         print("  RAM allocated from 0x%x to 0x%x" % (start, end))
     print("Sampled index: 0x%x" % memory.random_address())
@@ -302,6 +575,7 @@ def inject(args):
         print("if no address specified, will be randomly selected, and bytewidth will default to 1")
         print("otherwise, bytewidth defaults to 4 bytes")
         print("bit specifies the bit index within the integer to flip")
+        print("with a multi-bit upset set by the upset command, its cluster is flipped around the bit")
         return
 
     if args and args[0]:
@@ -319,18 +593,120 @@ def inject(args):
 
     inject_bitflip(address, bytewidth, bit)
 
+# savevm/loadvm rounds of benchinject
+BENCH_SNAPSHOTS = 5
+
+@BuildCmd
+def benchinject(args):
+    """Measure the latency of inject, of its read/write/verify steps and of savevm/loadvm
+Usage: benchinject <count> [<output file>]"""
+
+    args = args.strip().split(" ")
+    if len(args) > 2 or not args[0]:
+        print("usage: benchinject <count> [<output file>]")
+        print("Inject <count> random bitflips and time them, then time the read, write and verify steps")
+        print("of the same flips one by one and %d savevm/loadvm rounds." % BENCH_SNAPSHOTS)
+        print("The samples in seconds are written to <output file> as json, see bench.py")
+        return
+
+    count = int(args[0])
+    inferior = gdb.selected_inferior()
+    samples = {"flip": [], "read": [], "write": [], "verify": [], "savevm": [], "loadvm": []}
+    addresses = [sample_address() for _ in range(count)]
+    for address in addresses:
+        st = time.perf_counter()
+        inject_bitflip(address, 1)
+        samples["flip"].append(time.perf_counter() - st)
+
+    # the steps of inject_bitflip, timed one by one
+    for address in addresses:
+        st = time.perf_counter()
+        ovalue = int.from_bytes(inferior.read_memory(address, 1), "little")
+        rt = time.perf_counter()
+        inferior.write_memory(address, int.to_bytes(ovalue ^ 1, 1, "little"))
+        wt = time.perf_counter()
+        inferior.read_memory(address, 1)
+        vt = time.perf_counter()
+        samples["read"].append(rt - st)
+        samples["write"].append(wt - rt)
+        samples["verify"].append(vt - wt)
+
+    for _ in range(BENCH_SNAPSHOTS):
+        for action in ("savevm", "loadvm"):
+            st = time.perf_counter()
+            qemu_hmp("%s benchinject" % action)
+            samples[action].append(time.perf_counter() - st)
+    qemu_hmp("delvm benchinject")
+
+    for phase, values in samples.items():
+        if values:
+            print("%s: mean %.1f us max %.1f us" % (phase, sum(values) / len(values) * 1e6, max(values) * 1e6))
+    if args[1:]:
+        with open(args[1], "w") as f:
+            json.dump(samples, f)
+
 @BuildCmd
 def inject_reg(args):
     """Inject a bitflip into a register."""
 
     args = args.split()
-    if len(args) > 2:
-        print("usage: inject_reg [<register name>] [<bit index>]")
+    if len(args) > 4:
+        print("usage: inject_reg [<register name>] [<bit index>] [<count>] [<vcpu index>]")
         print("if no register specified, will be randomly selected")
-        print("a pattern involving wildcards can be specified if desired")
+        print("a pattern involving wildcards can be specified if desired, use * for any register")
+        print("count distinct registers matching the pattern are flipped at once, default is 1")
+        print("without a vcpu index or with *, the vCPU is sampled as set by regthreads")
         return
 
-    inject_reg_internal(args[0] if args[0:] else None, int(args[1]) if args[1:] else None)
+    pattern = args[0] if args[0:] and args[0] != "*" else None
+    bit = int(args[1]) if args[1:] and args[1] != "*" else None
+    thread = None
+    if args[3:] and args[3] != "*":
+        thread = next((thread for thread in vcpu_threads() if vcpu_name(thread) == "cpu" + args[3]), None)
+        assert thread is not None, "no vCPU %s" % args[3]
+    inject_reg_internal(pattern, bit, int(args[2]) if args[2:] else 1, thread)
+
+@BuildCmd
+def upset(args):
+    """Set the multi-bit upset flipped around every ram fault of inject, inject_range random and autoinject
+Usage: upset [single | bits <n> | bytes <n> | rows <n> [<stride>]]"""
+
+    global upset_mode
+    args = args.split()
+    if args:
+        try:
+            upset_mode = Upset.parse(":".join(args))
+        except (AssertionError, ValueError, TypeError):
+            print("usage: upset [single | bits <n> | bytes <n> | rows <n> [<stride>]]")
+            print("single: one bit (default), bits: n adjacent bits, bytes: the bit in n adjacent bytes,")
+            print("rows: the bit in n bytes stride bytes apart (default 8192, adjacent DRAM rows)")
+            return
+    print("upset: %s" % upset_mode)
+
+@BuildCmd
+def regthreads(args):
+    """Choose how register flips pick the vCPU, and show the flips per vCPU
+Usage: regthreads [uniform | weighted <weight of cpu0>,<weight of cpu1>,...]"""
+
+    global thread_weights
+    args = args.split()
+    if args[:1] == ["uniform"] and len(args) == 1:
+        thread_weights = None
+    elif args[:1] == ["weighted"] and len(args) == 2:
+        thread_weights = [float(weight) for weight in args[1].split(",")]
+        assert sum(thread_weights) > 0 and min(thread_weights) >= 0, "weights must be >= 0 and not all 0"
+    elif args:
+        print("usage: regthreads [uniform | weighted <weight of cpu0>,<weight of cpu1>,...]")
+        print("Register flips go to a random vCPU, uniform by default. With weights, cpuN is picked")
+        print("in proportion to its weight, missing weights are 0.")
+        return
+
+    threads = vcpu_threads()
+    print("%d vCPUs, %s sampling" % (len(threads), "uniform" if thread_weights is None else "weighted"))
+    for i, thread in enumerate(threads):
+        weight = "" if thread_weights is None else " weight %g" % (thread_weights[i] if i < len(thread_weights) else 0)
+        print("  %s (thread %d):%s %d register flips" % (vcpu_name(thread), thread.num, weight,
+                                                        register_flip_counts.get(vcpu_name(thread), 0)))
 
 # @BuildCmd
 # def task_restart(args):
@@ -343,15 +719,22 @@ def inject_reg(args):
 
 @BuildCmd
 def loginject(args):
-    """Log the injection of a bitflip"""
+    """Log the injection of a bitflip
+Usage: loginject <filename> [<format>] [<flush_interval>] [<buffer_size>]"""
     
     args = args.strip().split(" ")
-    if len(args) != 1:
-        print("usage: loginject <filename>")
+    if not args[0] or len(args) > 4 or (args[1:] and args[1] not in ("csv", "bin")):
+        print("usage: loginject <filename> [<format>] [<flush_interval>] [<buffer_size>]")
         print("Log the injection of a bitflip to a csv file")
+        print("format is 'csv' (default) or 'bin' for compact binary records, see fliplog.py")
+        print("records are written by a background thread every flush_interval (default 1s)")
+        print("or when half of buffer_size (default 65536) records are pending")
         return
 
-    init_logger(args[0])
+    fmt = args[1] if args[1:] else "csv"
+    flush_interval = parse_time(args[2]) / time_units["s"] if args[2:] else 1.0
+    capacity = int(args[3]) if args[3:] else 65536
+    init_logger(args[0], fmt, flush_interval, capacity)
 
 @BuildCmd
 def inject_range(args):
@@ -386,24 +769,73 @@ def inject_range(args):
 
     if mode == "sequential":
         for start, end in ranges:
-            for address in range(start, end + 1, bytewidth):
-                inject_bitflip(address, bytewidth)
+            inject_bitflip_sweep(start, end, bytewidth)
     elif mode == "random":
         if 'num_errors' not in locals():
             print("usage: inject_range <bytewidth> random <range1> [<range2> ...] <num_errors>")
             return
-        all_addresses = []
-        for start, end in ranges:
-            all_addresses.extend(range(start, end + 1, bytewidth))
-        if num_errors > len(all_addresses):
+        random_addresses = sample_range_addresses(ranges, bytewidth, num_errors)
+        if random_addresses is None:
             print("Number of errors exceeds the number of available addresses.")
             return
-        random_addresses = random.sample(all_addresses, num_errors)
         for address in random_addresses:
             inject_bitflip(address, bytewidth)
     else:
         print("Invalid mode. Use 'sequential' or 'random'.")
 
+# kernel symbols and the physical - virtual address offset of the kernel image, set by symbolmap
+symbol_index = None
+kernel_offset = 0
+# pattern list -> RangeSampler of inject_sym
+symbol_samplers = {}
+
+@BuildCmd
+def symbolmap(args):
+    """Load the kernel symbols used by inject_sym.
+Usage: symbolmap <System.map or vmlinux> [<iomem.txt> | <physical - virtual offset>]"""
+
+    global symbol_index, kernel_offset
+    args = args.split()
+    if not 1 <= len(args) <= 2:
+        print("usage: symbolmap <System.map or vmlinux> [<iomem.txt> | <physical - virtual offset>]")
+        print("The offset of the kernel image is taken from Kernel data in iomem.txt by default.")
+        return
+
+    symbol_index = ksyms.load(args[0])
+    if args[1:] and not os.path.exists(args[1]):
+        kernel_offset = int(args[1], 0)
+    else:
+        kernel_offset = ksyms.kernel_offset(symbol_index, load_iomem(args[1] if args[1:] else "iomem.txt"))
+    symbol_samplers.clear()
+    print("%d symbols, kernel image offset %#x" % (len(symbol_index), kernel_offset))
+
+@BuildCmd
+def inject_sym(args):
+    """Inject bitflips into kernel symbols or sections, see ksyms.py.
+Usage: inject_sym <pattern>[,<pattern>...] [<count>]"""
+
+    args = args.split()
+    if not 1 <= len(args) <= 2 or symbol_index is None:
+        print("usage: inject_sym <pattern>[,<pattern>...] [<count>]")
+        print("Flip count random bits (default 1) in the symbols matching the shell patterns, e.g. init_task or")
+        print("*_cachep, or in the sections .text, .rodata, .init, .data and .bss. Load the symbols with symbolmap first.")
+        return
+
+    patterns = args[0].split(",")
+    if args[0] not in symbol_samplers:
+        ksyms.warn_inferred(symbol_index, patterns)
+        symbol_samplers[args[0]] = RangeSampler(ksyms.physical_ranges(symbol_index, patterns, kernel_offset))
+    sampler = symbol_samplers[args[0]]
+    if not sampler.size():
+        print("No symbols found!")
+        return
+    for _ in range(int(args[1]) if args[1:] else 1):
+        address = sampler.sample()
+        # sections may have gaps between sized symbols
+        symbol = symbol_index.lookup(address - kernel_offset)
+        print("Flip in %s+%#x" % symbol if symbol else "Flip at %#x" % address)
+        inject_bitflip(address, 1)
+
 def autoinject_parser(args):
     times = int(args[0])
     assert times >= 1, "fatal: times < 1"
@@ -422,6 +854,27 @@ def autoinject_inner(times, mint, maxt, ftype):
         elif ftype == "ram":
             inject_bitflip(sample_address(), 1)
 
+def autoinject_plan(filename):
+    """Replay every record of a plan file generated by plan.py in order"""
+    for interval, address, bit, width, target in iter_plan(filename):
+        step_ns(interval)
+
+        if target == TARGET_RAM:
+            inject_bitflip(address, width, bit)
+        else:
+            # the address selects the register, then the vCPU, then the lane of a vector register
+            threads = vcpu_threads()
+            registers = len(register_table().layouts)
+            thread = threads[(address // registers) % len(threads)]
+            on_thread(thread, flip_plan_register, address, bit, address // (registers * len(threads)))
+
+def flip_plan_register(address, bit, lane, vcpu):
+    """Flip the register of a plan record, nothing is random so the same plan flips the same bits"""
+    layouts = register_table().layouts
+    layout = layouts[address % len(layouts)]
+    # plans draw bits for 64 bit registers
+    flip_registers([random_register_flip(layout, bit % layout.bits, lane % layout.lanes)], vcpu)
+
 @BuildCmd
 def autoinject(args):
     """Automatically inject fault into the VM accroding to the provided inject type. 
@@ -429,25 +882,32 @@ Cause `total_fault_number` faults with a random cycle between `min_interval` and
 fault type is `fault_type`
 
 Usage: `autoinject <total_fault_number> <min_interval> <max_interval> <fault_type>`
+       `autoinject <plan_file>`
 
 Supported types:
-1. ram: inject fault in RAM
-2. reg: inject fault in Registers"""
+1. ram: inject fault in RAM, a multi-bit upset if set by the upset command
+2. reg: inject fault in Registers
+
+A plan file generated by plan.py is replayed record by record, with its times, addresses and bits."""
 
     args = args.strip().split(" ")
-    if len(args) != 4 or args[3] not in ("ram", "reg"):
+    if not (len(args) == 1 and args[0]) and (len(args) != 4 or args[3] not in ("ram", "reg")):
         print("usage: autoinject <total_fault_number> <min_interval> <max_interval> <fault_type>")
+        print("       autoinject <plan_file>")
         print("Automatically inject faults into the VM accroding to the provided inject type.")
         print("Interval is uniformly random at [min, max].")
         print("unit should be 'ms', 'us', 'ns', 's', 'm'. Default is 'ns'.")
         print("Fault type should be 'ram' or 'reg'")
+        print("A plan file generated by plan.py is replayed in order instead.")
         return
 
-    times, mint, maxt, ftype = autoinject_parser(args)
-
     stime = time.time()
-    autoinject_inner(times, mint, maxt, ftype)
+    if len(args) == 1:
+        autoinject_plan(args[0])
+    else:
+        autoinject_inner(*autoinject_parser(args))
     etime = time.time()
+    flush_log()
     duration = etime - stime
     print("Total injection duration: %.3f s" % duration)
 
@@ -457,6 +917,9 @@ def snapinject(args):
 fault type, and fault interval. After the faults are injected, wait for a while and then revert to the
 previous VM state, delete the tmp checkpoint.
 If snapshot_tag is specified, do not create new checkpoint, and DO NOT revert to the checkpoint.
+The observation ends early when the guest panics or shuts down, or when the console log set by
+`watchconsole` shows a failure. A failed trial prints its crash (PC and call trace of the oops, or
+the PC after a panic) for attribution.py.
 
 Usage: snapinject <total_fault_number> <min_interval> <max_interval> <fault_type> <observe_time> [snapshot_tag]
 
@@ -480,10 +943,12 @@ Supported time units: default is ns. Time format: 10s, 244ms and etc.
     times, mint, maxt, ftype = autoinject_parser(args)
     obtime = parse_time(args[4])
     tmpname = uuid.uuid4()
+    next_trial()
 
     snapname = args[5] if args[5:] else tmpname
+    pool = get_snapshot_pool()
     if snapname == tmpname:
-        qemu_hmp("savevm %s" % snapname)
+        pool.save(snapname)
         print("Create a tmp checkpoint %s" % snapname)
     else:
         qemu_hmp("loadvm %s" % snapname)
@@ -496,17 +961,88 @@ Supported time units: default is ns. Time format: 10s, 244ms and etc.
     print("Total injection duration: %.3f s" % duration)
 
     print("Observing VM %s" % args[4])
-    step_ns(obtime)
-    print("time up.")
+    reason, elapsed = observe_ns(obtime)
+    if reason:
+        print("Guest failed (%s) after %.3f ms of observation" % (reason, elapsed / time_units["ms"]))
+    else:
+        print("time up.")
+    # a panicked guest stays paused until the revert
+    pc = register_pc(qemu_hmp("info registers")) if reason and "guest-panicked" in reason else None
+    if console_tail:
+        label = console_tail.end()
+        if reason and not reason.startswith("console"):
+            label = "crash"
+        print("Trial %d: %s" % (trial, label))
+        console_pc, backtrace = console_tail.crash(trial)
+        if label != "benign" and (console_pc or pc or backtrace):
+            print(crash_line(trial, console_pc or pc, backtrace))
+    elif pc:
+        print(crash_line(trial, pc, []))
+    flush_log()
 
     if snapname == tmpname:
         # Revert to the previous VM state
-        qemu_hmp("loadvm %s" % snapname)
+        pool.load(snapname)
         print("Back to checkpoint %s finished." % snapname)
         # Del this tmp VM checkpoint
-        qemu_hmp("delvm %s" % tmpname)
+        pool.delete(tmpname)
         print("Delete tmp VM checkpoint")
 
+@BuildCmd
+def watchconsole(args):
+    """Follow the guest console log to end snapinject observations early and label the trials
+Usage: watchconsole <filename> [<golden result>]"""
+
+    args = args.strip().split(" ")
+    if len(args) > 2 or not args[0]:
+        print("usage: watchconsole <filename> [<golden result>]")
+        print("Follow the console log written by `| tee <filename>`, snapinject stops observing")
+        print("as soon as a panic, Oops, BUG or lockup message appears in it, and labels every trial")
+        print("crash, oops, hang, SDC or benign. The workload prints `FLIP_OK [<result>]` when it is done,")
+        print("a result different from <golden result> is a silent data corruption (SDC).")
+        return
+
+    global console_tail
+    if console_tail:
+        console_tail.close()
+    console_tail = ConsoleClassifier(args[0], golden=args[1] if args[1:] else None)
+
+@BuildCmd
+def observeslice(args):
+    """Set how often snapinject checks the observed guest for failures
+Usage: observeslice [<time>]"""
+
+    args = args.strip()
+    global observe_slice_ns
+    if args:
+        try:
+            observe_slice_ns = parse_time(args)
+        except ValueError:
+            print("usage: observeslice [<time>]")
+            print("snapinject runs the guest in slices of <time> (default 1s) and checks `info status` and the")
+            print("console between them, every slice stops the guest once. Shorter slices end failed trials")
+            print("sooner, longer ones disturb the guest less. Units as in autoinject, default is 'ns'.")
+            return
+    print("observe slice: %.3f ms" % (observe_slice_ns / time_units["ms"]))
+
+@BuildCmd
+def snapshotdir(args):
+    """Keep the snapinject checkpoints in a qcow2 overlay in a tmpfs directory
+Usage: snapshotdir <directory> [<device>]"""
+
+    args = args.strip().split(" ")
+    if len(args) > 2 or not args[0]:
+        print("usage: snapshotdir <directory> [<device>]")
+        print("Switch the disk (default: the first block device) to a qcow2 overlay in <directory>, e.g. /dev/shm/x,")
+        print("so savevm/loadvm of snapinject do not touch the disk image. See snapshot.py.")
+        return
+
+    global snapshot_pool
+    if snapshot_pool:
+        snapshot_pool.report()
+        snapshot_pool.close()
+    snapshot_pool = SnapshotPool(qemu_hmp, args[0], args[1] if args[1:] else None)
+
 @BuildCmd
 def loop(args):
     """Loop a action for provide times
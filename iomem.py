@@ -0,0 +1,192 @@
+# ==============================================================================
+# This file indexes the /proc/iomem of the guest (iomem.txt, see get_iomem.sh).
+# Every line is a resource, children are indented two spaces more than their
+# parent:
+#   40000000-13fffffff : System RAM
+#     40210000-40ffffff : Kernel code
+#     41000000-4127ffff : Kernel data
+#
+# The whole tree is parsed into integer intervals in address order and cached
+# next to the file (iomem.txt.json), the cache is used while iomem.txt is
+# unchanged. An area is every resource with a name (case-insensitive, so
+# "Kernel Code" is "Kernel code"), children can be cut out of it, e.g. System
+# RAM without Kernel code. Addresses are drawn from all ranges of an area
+# weighted by their size, with one bisect over the prefix sums of the sizes.
+# ==============================================================================
+
+import bisect
+import json
+import os
+import random
+
+# the areas fliputils.extract reports
+AREAS = ("Kernel Code", "Kernel Data", "System RAM")
+# exclude value cutting every child out of an area
+ALL_CHILDREN = "*"
+
+class Resource:
+    def __init__(self, start, end, name, depth, parent):
+        """
+        :param start: first address
+        :param end: last address, inclusive
+        :param depth: 0 for the top level resources
+        :param parent: index of the parent resource, -1 at the top level"""
+        self.start = start
+        self.end = end
+        self.name = name
+        self.depth = depth
+        self.parent = parent
+
+    def __repr__(self):
+        return f"Resource(0x{self.start:x}-0x{self.end:x}, {self.name!r})"
+
+class RangeSampler:
+    """Uniform random addresses over inclusive ranges, every byte has the same weight"""
+    def __init__(self, ranges):
+        self.ranges = ranges
+        self.starts = [start for start, end in ranges]
+        self.offsets = [0]
+        for start, end in ranges:
+            self.offsets.append(self.offsets[-1] + end - start + 1)
+
+    def size(self):
+        return self.offsets[-1]
+
+    def sample(self, rng=random):
+        assert self.offsets[-1], "no address to sample from"
+        offset = rng.randrange(self.offsets[-1])
+        i = bisect.bisect_right(self.offsets, offset) - 1
+        return self.starts[i] + offset - self.offsets[i]
+
+class IomemIndex:
+    def __init__(self, resources):
+        """
+        :param resources: Resource list in the order of /proc/iomem, parents before children"""
+        self.resources = resources
+        self.starts = [resource.start for resource in resources]
+        # (area, exclude) -> RangeSampler
+        self.samplers = {}
+
+    @staticmethod
+    def parse(lines):
+        resources = []
+        # indexes of the open ancestors
+        stack = []
+        for line in lines:
+            if not line.strip():
+                continue
+            depth = (len(line) - len(line.lstrip(" "))) // 2
+            # names may hold colons, e.g. "PCI Bus 0000:00"
+            interval, name = line.strip().split(" : ", 1)
+            start, end = (int(address, 16) for address in interval.split("-"))
+            del stack[depth:]
+            resources.append(Resource(start, end, name, len(stack), stack[-1] if stack else -1))
+            stack.append(len(resources) - 1)
+        return IomemIndex(resources)
+
+    def rows(self):
+        return [[r.start, r.end, r.name, r.depth, r.parent] for r in self.resources]
+
+    @staticmethod
+    def from_rows(rows):
+        return IomemIndex([Resource(*row) for row in rows])
+
+    def names(self):
+        return list(dict.fromkeys(resource.name for resource in self.resources))
+
+    def find(self, area):
+        """Indexes of the resources named area"""
+        area = area.casefold()
+        return [i for i, resource in enumerate(self.resources) if resource.name.casefold() == area]
+
+    def ranges(self, area, exclude=None):
+        """
+        Inclusive (start, end) ranges of area in address order.
+        exclude is a list of resource names cut out of the ranges, or ALL_CHILDREN to cut all children of area.
+        """
+        found = self.find(area)
+        ranges = [(self.resources[i].start, self.resources[i].end) for i in found]
+        if not exclude:
+            return sorted(ranges)
+        if exclude == ALL_CHILDREN:
+            parents = set(found)
+            holes = [(r.start, r.end) for r in self.resources if r.parent in parents]
+        else:
+            names = {name.casefold() for name in exclude}
+            holes = [(r.start, r.end) for r in self.resources if r.name.casefold() in names]
+        return subtract(sorted(ranges), sorted(holes))
+
+    def sampler(self, area, exclude=None):
+        key = (area, tuple(exclude) if exclude and exclude != ALL_CHILDREN else exclude)
+        if key not in self.samplers:
+            self.samplers[key] = RangeSampler(self.ranges(area, exclude))
+        return self.samplers[key]
+
+    def lookup(self, address):
+        """The innermost resource holding address, None if no resource does"""
+        i = bisect.bisect_right(self.starts, address) - 1
+        while i >= 0 and not self.resources[i].start <= address <= self.resources[i].end:
+            # resource i ends before address, only its ancestors may still hold it
+            i = self.resources[i].parent
+        return self.resources[i] if i >= 0 else None
+
+def merge(ranges):
+    """Union of sorted inclusive ranges as disjoint sorted ranges"""
+    merged = []
+    for start, end in ranges:
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+def subtract(ranges, holes):
+    """Cut sorted inclusive holes out of sorted inclusive ranges"""
+    holes = merge(holes)
+    result = []
+    for start, end in ranges:
+        # the hole before start may reach into the range
+        for hole_start, hole_end in holes[max(bisect.bisect_left(holes, (start,)) - 1, 0):]:
+            if hole_start > end:
+                break
+            if hole_end < start:
+                continue
+            if hole_start > start:
+                result.append((start, hole_start - 1))
+            start = max(start, hole_end + 1)
+            if start > end:
+                break
+        if start <= end:
+            result.append((start, end))
+    return result
+
+# (path, mtime, size) -> IomemIndex of the files loaded by this process
+loaded = {}
+
+def load(filename="iomem.txt"):
+    """IomemIndex of filename, from the cache next to it while the file is unchanged"""
+    stat = os.stat(filename)
+    key = [os.path.abspath(filename), stat.st_mtime_ns, stat.st_size]
+    if tuple(key) in loaded:
+        return loaded[tuple(key)]
+    cache = filename + ".json"
+    index = None
+    try:
+        with open(cache) as f:
+            cached = json.load(f)
+        if cached["key"] == key:
+            index = IomemIndex.from_rows(cached["resources"])
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    if index is None:
+        with open(filename) as f:
+            index = IomemIndex.parse(f)
+        try:
+            with open(cache + ".tmp", "w") as f:
+                json.dump({"key": key, "resources": index.rows()}, f)
+            os.replace(cache + ".tmp", cache)
+        except OSError:
+            # e.g. a read-only directory, the index is only kept in memory
+            pass
+    loaded[tuple(key)] = index
+    return index
@@ -0,0 +1,242 @@
+# ==============================================================================
+# This file indexes the kernel symbols of the guest to target flips at named
+# kernel objects and sections instead of whole iomem areas.
+#
+# The index is built once from System.map, or from vmlinux with `nm -n -S`
+# (exact symbol sizes), and cached next to it (System.map.json) while the
+# file is unchanged. Symbols are sorted by address and searched with bisect,
+# or with one NumPy searchsorted for a whole array of addresses (lookup_array,
+# used to attribute millions of flips, see attribution.py). Without sizes a
+# symbol reaches up to the next symbol, which can be far more than the object
+# (an 8 byte pointer followed by padding), targets with such inferred sizes
+# print a warning, load vmlinux for exact ones.
+#
+# Targets are shell patterns of symbol names (`init_task`, `*_cachep`,
+# `tcp_*`) or section names (.text, .rodata, .data, .bss, .init).
+# Slab caches are allocated at run time and have no symbol, their kmem_cache
+# pointers (`*_cachep`) are the closest static target.
+#
+# The kernel image is mapped linearly: physical = virtual + offset. The offset
+# is taken from iomem.txt, where "Kernel data" starts at the physical address
+# of _sdata on arm64 and x86 (also with KASLR, System.map has link addresses).
+#
+# Usage: python3 ksyms.py System.map "init_task" ".rodata" [--iomem iomem.txt]
+# ==============================================================================
+
+import bisect
+import fnmatch
+import json
+import os
+import subprocess
+
+try:
+    import numpy
+except ImportError:
+    # gdb may run a python without it, only lookup_array needs it
+    numpy = None
+
+from iomem import load as load_iomem, merge
+
+# section name -> (first symbol, symbol after the end)
+SECTIONS = {
+    ".text": ("_stext", "_etext"),
+    ".rodata": ("__start_rodata", "__end_rodata"),
+    ".init": ("__init_begin", "__init_end"),
+    ".data": ("_sdata", "_edata"),
+    ".bss": ("__bss_start", "__bss_stop"),
+}
+# symbol types of code and data, absolute and undefined symbols are no memory
+MEMORY_TYPES = set("tTdDbBrRvVwW")
+# symbol at the start of the "Kernel data" resource of iomem.txt
+DATA_ANCHOR = "_sdata"
+# version of the System.map.json rows, 2 keeps unknown sizes as 0
+CACHE_FORMAT = 2
+
+class SymbolIndex:
+    def __init__(self, addresses, sizes, names):
+        """
+        :param addresses: virtual link addresses in ascending order
+        :param sizes: size in bytes of every symbol, 0 if unknown
+        :param names: symbol names"""
+        self.addresses = addresses
+        self.names = names
+        # a symbol without size reaches up to the next symbol at a higher address
+        self.sizes = list(sizes)
+        self.inferred = [not size for size in sizes]
+        for i in range(len(addresses) - 1, -1, -1):
+            if not self.sizes[i]:
+                following = bisect.bisect_right(addresses, addresses[i])
+                self.sizes[i] = addresses[following] - addresses[i] if following < len(addresses) else 0
+        # name -> indexes of the symbols of that name, static symbols of different files may share one
+        self.by_name = {}
+        for i, name in enumerate(names):
+            self.by_name.setdefault(name, []).append(i)
+        # (starts, ends, symbol indexes) of lookup_array, built on first use
+        self.arrays = None
+
+    @staticmethod
+    def parse(lines):
+        """Parse System.map lines (address type name) or `nm -S` lines (address [size] type name)"""
+        symbols = []
+        for line in lines:
+            parts = line.split()
+            if len(parts) == 3:
+                address, kind, name = parts
+                size = "0"
+            elif len(parts) == 4:
+                address, size, kind, name = parts
+            else:
+                continue
+            if kind in MEMORY_TYPES:
+                symbols.append((int(address, 16), int(size, 16), name))
+        symbols.sort()
+        return SymbolIndex([s[0] for s in symbols], [s[1] for s in symbols], [s[2] for s in symbols])
+
+    def rows(self):
+        """Rows of the cache, inferred sizes are inferred again"""
+        return [self.addresses, [0 if inferred else size for size, inferred in zip(self.sizes, self.inferred)],
+                self.names]
+
+    def __len__(self):
+        return len(self.addresses)
+
+    def address(self, name):
+        return self.addresses[self.by_name[name][0]]
+
+    def lookup(self, address):
+        """(name, offset) of the symbol holding the virtual address, None outside all symbols"""
+        i = bisect.bisect_right(self.addresses, address) - 1
+        # several symbols may share an address, the sized one holds it
+        while i >= 0 and self.addresses[i] + self.sizes[i] <= address:
+            if i == 0 or self.addresses[i - 1] != self.addresses[i]:
+                return None
+            i -= 1
+        return (self.names[i], address - self.addresses[i]) if i >= 0 else None
+
+    def lookup_array(self, addresses):
+        """
+        Indexes of the symbols holding an array of virtual addresses, -1 outside all symbols, like lookup.
+        Symbols sharing an address are one interval that ends with the largest of them.
+        """
+        assert numpy is not None, "lookup_array needs numpy"
+        if self.arrays is None:
+            starts = numpy.array(self.addresses, dtype=numpy.uint64)
+            ends = starts + numpy.array(self.sizes, dtype=numpy.uint64)
+            # the symbol of the largest size last in every group of one address
+            order = numpy.lexsort((ends, starts))
+            last = numpy.ones(len(order), dtype=bool)
+            last[:-1] = starts[order][1:] != starts[order][:-1]
+            self.arrays = (starts[order][last], ends[order][last], order[last])
+        starts, ends, symbols = self.arrays
+        addresses = numpy.asarray(addresses, dtype=numpy.uint64)
+        i = numpy.searchsorted(starts, addresses, side="right") - 1
+        inside = (i >= 0) & (addresses < ends[i])
+        return numpy.where(inside, symbols[i], -1)
+
+    def match(self, pattern):
+        """Inclusive virtual (start, end) ranges of a section name or the symbols matching a shell pattern"""
+        if pattern in SECTIONS:
+            first, after = SECTIONS[pattern]
+            assert first in self.by_name and after in self.by_name, f"no section {pattern} in the symbol map"
+            return [(self.address(first), self.address(after) - 1)]
+        return [(self.addresses[i], self.addresses[i] + self.sizes[i] - 1) for i in self.indexes(pattern)]
+
+    def indexes(self, pattern):
+        """Indexes of the symbols matching a shell pattern that take memory"""
+        if not any(c in pattern for c in "*?["):
+            return [i for i in self.by_name.get(pattern, []) if self.sizes[i]]
+        return [i for i, (size, name) in enumerate(zip(self.sizes, self.names)) if size and fnmatch.fnmatchcase(name, pattern)]
+
+    def inferred_sizes(self, patterns):
+        """[(name, size)] of the symbols matching patterns with a size inferred from the next symbol"""
+        return [(self.names[i], self.sizes[i]) for pattern in patterns if pattern not in SECTIONS
+                for i in self.indexes(pattern) if self.inferred[i]]
+
+    def ranges(self, patterns):
+        """Merged inclusive virtual ranges of all patterns, see match"""
+        return merge(sorted(r for pattern in patterns for r in self.match(pattern)))
+
+def warn_inferred(index, patterns):
+    """Print a warning when symbols of the patterns have inferred sizes"""
+    inferred = index.inferred_sizes(patterns)
+    if inferred:
+        examples = ", ".join(f"{name} 0x{size:x}" for name, size in inferred[:3])
+        print(f"warning: {len(inferred)} target symbols have no size and reach up to the next symbol ({examples}), "
+              f"give vmlinux instead of System.map for their sizes")
+
+def kernel_offset(index, iomem_index):
+    """physical - virtual address of the kernel image, from the "Kernel data" resource of an iomem.IomemIndex"""
+    data = iomem_index.ranges("Kernel data")
+    assert data, "no Kernel data in iomem, give the physical offset of the kernel image"
+    assert DATA_ANCHOR in index.by_name, f"no {DATA_ANCHOR} in the symbol map"
+    return data[0][0] - index.address(DATA_ANCHOR)
+
+def physical_ranges(index, patterns, offset):
+    """Inclusive physical ranges of the patterns, see SymbolIndex.match"""
+    return [(start + offset, end + offset) for start, end in index.ranges(patterns)]
+
+def target_ranges(patterns, symbol_map="System.map", iomem="iomem.txt", offset=None):
+    """Inclusive physical ranges of the patterns in symbol_map, the offset defaults to the one of iomem"""
+    index = load(symbol_map)
+    warn_inferred(index, patterns)
+    offset = kernel_offset(index, load_iomem(iomem)) if offset is None else offset
+    return physical_ranges(index, patterns, offset)
+
+def read_symbols(filename):
+    with open(filename, "rb") as f:
+        elf = f.read(4) == b"\x7fELF"
+    if elf:
+        # sizes of vmlinux symbols, sorted by address
+        return subprocess.run(["nm", "-n", "-S", "--defined-only", filename], check=True, capture_output=True,
+                              text=True).stdout.splitlines()
+    with open(filename) as f:
+        return f.readlines()
+
+# (path, mtime, size) -> SymbolIndex of the files loaded by this process
+loaded = {}
+
+def load(filename="System.map"):
+    """SymbolIndex of a System.map or vmlinux, from the cache next to it while the file is unchanged"""
+    stat = os.stat(filename)
+    key = [os.path.abspath(filename), stat.st_mtime_ns, stat.st_size, CACHE_FORMAT]
+    if tuple(key) in loaded:
+        return loaded[tuple(key)]
+    cache = filename + ".json"
+    index = None
+    try:
+        with open(cache) as f:
+            cached = json.load(f)
+        if cached["key"] == key:
+            index = SymbolIndex(*cached["symbols"])
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    if index is None:
+        index = SymbolIndex.parse(read_symbols(filename))
+        try:
+            with open(cache + ".tmp", "w") as f:
+                json.dump({"key": key, "symbols": index.rows()}, f)
+            os.replace(cache + ".tmp", cache)
+        except OSError:
+            # e.g. a read-only directory, the index is only kept in memory
+            pass
+    loaded[tuple(key)] = index
+    return index
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Show the physical ranges of kernel symbols and sections")
+    parser.add_argument("symbol_map", help="System.map or vmlinux")
+    parser.add_argument("patterns", nargs="+", help="symbol name patterns or section names")
+    parser.add_argument("--iomem", default="iomem.txt")
+    parser.add_argument("--offset", type=lambda x: int(x, 0), help="physical - virtual address of the kernel image")
+    args = parser.parse_args()
+
+    index = load(args.symbol_map)
+    warn_inferred(index, args.patterns)
+    offset = args.offset if args.offset is not None else kernel_offset(index, load_iomem(args.iomem))
+    ranges = physical_ranges(index, args.patterns, offset)
+    print(f"{len(index)} symbols, offset {offset:#x}, {len(ranges)} ranges, "
+          f"0x{sum(end - start + 1 for start, end in ranges):x} bytes")
+    for start, end in ranges[:20]:
+        print(f"[0x{start:x}, 0x{end:x}] {index.lookup(start - offset)[0]}")
@@ -0,0 +1,225 @@
+# ==============================================================================
+# This file injects faults into a guest physical memory image instead of a
+# live VM. The image is memory-mapped and a whole plan (see plan.py) is
+# applied with vectorized NumPy operations, every flip is annotated with the
+# old and new value of its byte and the area it hit.
+#
+# Supported images:
+#   ELF core of `dump-guest-memory <file>`, physical addresses from PT_LOAD
+#   raw `pmemsave <address> <size> <file>`, the start address is given by --base
+#
+# Areas are the resources of iomem.txt ("System RAM", "Kernel Code", ...,
+# see iomem.py), without iomem.txt the whole image is one "image" area.
+#
+# Usage: python3 offline.py dump.elf --output flipped.elf --area "Kernel Code" --count 1000000
+#        python3 offline.py mem.raw --base 0x40000000 --plan plan.bin --annotations flips.log
+#
+# Note: This file should run in Host machine.
+# ==============================================================================
+
+import mmap
+import os
+import shutil
+import struct
+import time
+
+import numpy
+
+import plan
+from fliplog import KIND_RAM, binary_dtype, write_binary_log
+from iomem import AREAS, load
+
+ELF_MAGIC = b"\x7fELF"
+PT_LOAD = 1
+# (e_phoff, e_phentsize, e_phnum) of the ELF header and the program header, by ELF class (1: 32 bit, 2: 64 bit)
+ELF_HEADER = {1: struct.Struct("<28xI10xHH"), 2: struct.Struct("<32xQ14xHH")}
+# fields (p_type, p_offset, p_paddr, p_filesz) are picked from these in segments()
+ELF_PHDR = {1: struct.Struct("<IIIIIIII"), 2: struct.Struct("<IIQQQQQQ")}
+
+def annotation_dtype():
+    return numpy.dtype([("time", "<u8"), ("address", "<u8"), ("bit", "u1"), ("old", "u1"), ("new", "u1"), ("area", "u1")])
+
+class MemoryImage:
+    def __init__(self, filename, base=None, writable=False):
+        """
+        :param filename: ELF core or raw image
+        :param base: physical address of the first byte of a raw image, None for an ELF core
+        :param writable: flips are written to the file, otherwise they only live in this mapping"""
+        self.filename = filename
+        self.file = open(filename, "r+b" if writable else "rb")
+        access = mmap.ACCESS_WRITE if writable else mmap.ACCESS_COPY
+        self.mmap = mmap.mmap(self.file.fileno(), 0, access=access)
+        self.memory = numpy.frombuffer(self.mmap, dtype=numpy.uint8)
+        # (physical address, file offset, size) sorted by address
+        self.segments = self.elf_segments() if self.mmap[:4] == ELF_MAGIC else [(base or 0, 0, len(self.mmap))]
+        assert self.segments, f"no memory in image {filename}"
+        assert base is None or self.mmap[:4] != ELF_MAGIC, "base is only used for raw images"
+        self.starts = numpy.array([address for address, offset, size in self.segments], dtype=numpy.uint64)
+        self.ends = numpy.array([address + size for address, offset, size in self.segments], dtype=numpy.uint64)
+        self.offsets = numpy.array([offset for address, offset, size in self.segments], dtype=numpy.uint64)
+
+    def elf_segments(self):
+        elf_class, data = self.mmap[4], self.mmap[5]
+        assert elf_class in ELF_HEADER and data == 1, "only little-endian ELF cores are supported"
+        phoff, phentsize, phnum = ELF_HEADER[elf_class].unpack_from(self.mmap)
+        segments = []
+        for i in range(phnum):
+            fields = ELF_PHDR[elf_class].unpack_from(self.mmap, phoff + i * phentsize)
+            if elf_class == 2:
+                p_type, _, p_offset, _, p_paddr, p_filesz = fields[:6]
+            else:
+                p_type, p_offset, _, p_paddr, p_filesz = fields[:5]
+            if p_type == PT_LOAD and p_filesz:
+                segments.append((p_paddr, p_offset, p_filesz))
+        return sorted(segments)
+
+    def ranges(self):
+        """Inclusive (start, end) physical ranges in the image"""
+        return [(address, address + size - 1) for address, offset, size in self.segments]
+
+    def translate(self, addresses):
+        """File offsets of physical addresses (NumPy array), -1 where the image has no byte"""
+        addresses = numpy.asarray(addresses, dtype=numpy.uint64)
+        index = numpy.searchsorted(self.starts, addresses, side="right") - 1
+        inside = (index >= 0) & (addresses < self.ends[index.clip(0)])
+        offsets = self.offsets[index.clip(0)] + (addresses - self.starts[index.clip(0)])
+        return numpy.where(inside, offsets.astype(numpy.int64), -1)
+
+    def read(self, address, size):
+        offset = int(self.translate([address])[0])
+        assert offset >= 0 and int(self.translate([address + size - 1])[0]) == offset + size - 1, \
+            f"0x{address:x}+{size} is not in the image"
+        return bytes(self.memory[offset:offset + size])
+
+    def apply(self, flips):
+        """
+        Apply ram records of a plan array (plan.plan_dtype) in order and return their annotations (annotation_dtype).
+        Several flips of the same byte see each other: old is the value before the flip, new after it.
+        """
+        assert numpy.all(flips["target"] == plan.TARGET_RAM), "apply error: only ram flips can be applied to an image"
+        addresses = flips["address"] + (flips["bit"] // 8).astype(numpy.uint64)
+        offsets = self.translate(addresses)
+        missing = numpy.flatnonzero(offsets < 0)
+        assert missing.size == 0, f"apply error: 0x{int(addresses[missing[0]]):x} is not in the image"
+        masks = (1 << (flips["bit"] % 8)).astype(numpy.uint8)
+
+        # old and new of every flip from prefix xors of the masks, per byte in plan order
+        order = numpy.argsort(offsets, kind="stable")
+        sorted_offsets, sorted_masks = offsets[order], masks[order]
+        prefix = numpy.bitwise_xor.accumulate(sorted_masks)
+        first = numpy.ones(len(order), dtype=bool)
+        first[1:] = sorted_offsets[1:] != sorted_offsets[:-1]
+        group_start = numpy.maximum.accumulate(numpy.where(first, numpy.arange(len(order)), 0))
+        before_group = numpy.where(group_start > 0, prefix[group_start - 1], 0).astype(numpy.uint8)
+        original = self.memory[sorted_offsets]
+        new = numpy.empty(len(order), dtype=numpy.uint8)
+        new[order] = original ^ prefix ^ before_group
+        old = new ^ masks
+
+        numpy.bitwise_xor.at(self.memory, offsets, masks)
+        annotations = numpy.zeros(len(flips), dtype=annotation_dtype())
+        annotations["time"] = flips["time"]
+        annotations["address"] = addresses
+        annotations["bit"] = flips["bit"] % 8
+        annotations["old"] = old
+        annotations["new"] = new
+        return annotations
+
+    def flush(self):
+        self.mmap.flush()
+
+    def close(self):
+        del self.memory
+        self.mmap.close()
+        self.file.close()
+
+def iomem_ranges(iomem="iomem.txt", names=AREAS):
+    """{area: [(start, end)]} of the resources names in iomem"""
+    index = load(iomem)
+    return {area: index.ranges(area) for area in names}
+
+def label_areas(annotations, areas):
+    """
+    Set annotations["area"] to the index of the area of every address in list(areas), the smallest area wins
+    (Kernel Code inside System RAM is Kernel Code). 255 is outside all areas.
+    """
+    names = list(areas)
+    annotations["area"] = 255
+    by_size = sorted(names, key=lambda name: -sum(end - start + 1 for start, end in areas[name]))
+    for name in by_size:
+        inside = numpy.zeros(len(annotations), dtype=bool)
+        for start, end in areas[name]:
+            inside |= (annotations["address"] >= start) & (annotations["address"] <= end)
+        annotations["area"][inside] = names.index(name)
+    return names
+
+def to_log(annotations):
+    """Annotations as fliplog binary records, readable with fliplog.read_binary_log"""
+    records = numpy.zeros(len(annotations), dtype=binary_dtype())
+    records["timestamp"] = annotations["time"] * 1e-9
+    records["kind"] = KIND_RAM
+    records["address"] = annotations["address"]
+    records["old"] = annotations["old"]
+    records["new"] = annotations["new"]
+    return records
+
+def inject_image(image, flips, output=None, base=None, areas=None):
+    """
+    Apply the plan array flips to the memory image file.
+    The flipped image is written to output, without output the image file is left as is.
+    Return (annotations, area names), see label_areas.
+    """
+    if output:
+        shutil.copyfile(image, output)
+    memory = MemoryImage(output or image, base, writable=bool(output))
+    try:
+        annotations = memory.apply(flips)
+        if output:
+            memory.flush()
+    finally:
+        memory.close()
+    names = label_areas(annotations, areas or {"image": memory.ranges()})
+    return annotations, names
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Inject a plan of bit flips into a guest memory image")
+    parser.add_argument("image", help="ELF core of dump-guest-memory or raw image of pmemsave")
+    parser.add_argument("--base", type=lambda x: int(x, 0), help="physical start address of a raw image")
+    parser.add_argument("--output", help="write the flipped image here, default: only annotate")
+    parser.add_argument("--plan", help="plan file to apply, default: generate one")
+    parser.add_argument("--count", type=int, default=1000, help="flips of a generated plan")
+    parser.add_argument("--area", help="area of a generated plan, default: the whole image")
+    parser.add_argument("--iomem", default="iomem.txt")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--annotations", help="write old/new of every flip as a binary log (fliplog.py)")
+    args = parser.parse_args()
+
+    names = tuple(dict.fromkeys(AREAS + ((args.area,) if args.area else ())))
+    areas = iomem_ranges(args.iomem, names) if os.path.exists(args.iomem) else None
+    if args.plan:
+        flips = numpy.array(plan.load(args.plan))
+    else:
+        if args.area:
+            assert areas and areas[args.area], f"no ranges of {args.area} in {args.iomem}"
+            ranges = areas[args.area]
+        else:
+            memory = MemoryImage(args.image, args.base)
+            ranges = memory.ranges()
+            memory.close()
+        flips = plan.generate(args.count, 0, 0, ranges, seed=args.seed)
+
+    st = time.time()
+    annotations, names = inject_image(args.image, flips, args.output, args.base, areas)
+    et = time.time()
+    print(f"{len(flips)} flips in {et - st:.3f}s, {len(flips) / max(et - st, 1e-9):.0f} flips/s")
+    counts = numpy.bincount(annotations["area"], minlength=256)
+    for i, name in enumerate(names):
+        print(f"{name}: {counts[i]} flips")
+    if counts[255]:
+        print(f"outside the areas: {counts[255]} flips")
+    for record in annotations[:10]:
+        print(f"0x{int(record['address']):x} bit {record['bit']}: old=0x{record['old']:02x} new=0x{record['new']:02x}")
+    if args.annotations:
+        write_binary_log(args.annotations, to_log(annotations))
@@ -0,0 +1,143 @@
+# ==============================================================================
+# This file generates fault plans: every flip of a campaign (time offset,
+# address, bit, width, target) is drawn up front with one seeded NumPy
+# generator and stored in a flat binary file, so injection loops only replay
+# records in order.
+#
+# Plan file layout (little-endian):
+#   header: magic b"FLIPPLAN", version u32, record size u32, seed u64, count u64
+#   records: time u64 (ns since campaign start), address u64, bit u8, width u8, target u8
+#
+# Generating needs NumPy, reading does not (gdb may run a python without it).
+# ==============================================================================
+
+import mmap
+import struct
+import sys
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+MAGIC = b"FLIPPLAN"
+VERSION = 1
+HEADER = struct.Struct("<8sIIQQ")
+RECORD = struct.Struct("<QQBBB")
+# records unpacked at once by iter_plan
+ITER_RECORDS = 4096
+
+TARGET_RAM = 0
+# for register records the address field selects the register: address % number of registers, the vCPU:
+# address // registers % vCPUs, and the lane of a vector register: address // (registers * vCPUs) % lanes
+TARGET_REG = 1
+TARGETS = {"ram": TARGET_RAM, "reg": TARGET_REG}
+
+# register flips only reach the lower 64 bits, see inject_register_bitflip in gdb/fliputils.py
+REG_BITS = 64
+
+def plan_dtype():
+    return numpy.dtype([("time", "<u8"), ("address", "<u8"), ("bit", "u1"), ("width", "u1"), ("target", "u1")])
+
+def generate(count, min_interval, max_interval, ranges=None, seed=0, width=1, target="ram"):
+    """
+    Generate a plan of count flips as a NumPy structured array.
+
+    :param min_interval: minimal interval between two flips in nanoseconds
+    :param max_interval: maximal interval between two flips in nanoseconds
+    :param ranges: inclusive (start, end) ram ranges, addresses are uniform over their total size
+    :param seed: the only source of randomness, the same arguments always give the same plan
+    :param width: word width in bytes, the flipped bit is uniform in [0, 8 * width)
+    :param target: "ram" or "reg"
+    """
+    assert numpy is not None, "generating a plan needs numpy"
+    assert target in TARGETS, f"generate error: unknown target {target}"
+    assert 0 <= min_interval <= max_interval, "generate error: min_interval > max_interval"
+    rng = numpy.random.default_rng(seed)
+    plan = numpy.zeros(count, dtype=plan_dtype())
+    plan["time"] = numpy.cumsum(rng.integers(min_interval, max_interval, count, dtype=numpy.uint64, endpoint=True))
+    plan["target"] = TARGETS[target]
+    if target == "ram":
+        assert ranges, "generate error: no ranges to sample ram addresses from"
+        starts = numpy.array([start for start, end in ranges], dtype=numpy.uint64)
+        sizes = numpy.array([end - start + 1 for start, end in ranges], dtype=numpy.uint64)
+        prefix = numpy.concatenate(([0], numpy.cumsum(sizes))).astype(numpy.uint64)
+        offsets = rng.integers(0, int(prefix[-1]), count, dtype=numpy.uint64)
+        index = numpy.searchsorted(prefix, offsets, side="right") - 1
+        plan["address"] = starts[index] + (offsets - prefix[index])
+        plan["width"] = width
+        plan["bit"] = rng.integers(0, 8 * width, count)
+    else:
+        plan["address"] = rng.integers(0, 1 << 63, count, dtype=numpy.uint64)
+        plan["width"] = REG_BITS // 8
+        plan["bit"] = rng.integers(0, REG_BITS, count)
+    return plan
+
+def save(filename, plan, seed=0):
+    with open(filename, "wb") as f:
+        f.write(HEADER.pack(MAGIC, VERSION, RECORD.size, seed, len(plan)))
+        f.write(plan.tobytes())
+
+def read_header(f):
+    magic, version, size, seed, count = HEADER.unpack(f.read(HEADER.size))
+    assert magic == MAGIC and version == VERSION and size == RECORD.size, "invalid plan file"
+    return seed, count
+
+def load(filename):
+    """Memory map a plan file as a NumPy structured array"""
+    with open(filename, "rb") as f:
+        read_header(f)
+    return numpy.memmap(filename, dtype=plan_dtype(), mode="r", offset=HEADER.size)
+
+def iter_plan(filename):
+    """
+    Yield (interval, address, bit, width, target) for every record in order, interval is the time in
+    nanoseconds since the previous flip. Works without numpy.
+    """
+    with open(filename, "rb") as f:
+        seed, count = read_header(f)
+        if count == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            last = 0
+            end = HEADER.size + count * RECORD.size
+            # copied ITER_RECORDS at a time, not the whole plan. A memoryview would not copy at all, but its exports
+            # keep the map from closing when the caller stops early
+            for offset in range(HEADER.size, end, ITER_RECORDS * RECORD.size):
+                chunk = m[offset:min(offset + ITER_RECORDS * RECORD.size, end)]
+                for ftime, address, bit, width, target in RECORD.iter_unpack(chunk):
+                    yield ftime - last, address, bit, width, target
+                    last = ftime
+
+if __name__ == '__main__':
+    import argparse
+    import time
+    import iomem
+    import ksyms
+
+    parser = argparse.ArgumentParser(description="Generate a fault plan file")
+    parser.add_argument("output")
+    parser.add_argument("count", type=int)
+    parser.add_argument("min_interval", type=int, help="nanoseconds")
+    parser.add_argument("max_interval", type=int, help="nanoseconds")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--area", default="System RAM", help="resource name in iomem.txt, see iomem.py")
+    parser.add_argument("--exclude", action="append", help="resource inside area that is not flipped, * for all")
+    parser.add_argument("--symbols", action="append", help="flip kernel symbols or sections matching this pattern "
+                                                             "instead of area, see ksyms.py")
+    parser.add_argument("--symbol-map", default="System.map", help="System.map or vmlinux of the guest kernel")
+    parser.add_argument("--iomem", default="iomem.txt")
+    parser.add_argument("--width", type=int, default=1)
+    parser.add_argument("--target", choices=list(TARGETS), default="ram")
+    args = parser.parse_args()
+
+    ranges = None
+    if args.target == "ram" and args.symbols:
+        ranges = ksyms.target_ranges(args.symbols, args.symbol_map, args.iomem)
+    elif args.target == "ram":
+        exclude = iomem.ALL_CHILDREN if args.exclude == [iomem.ALL_CHILDREN] else args.exclude
+        ranges = iomem.load(args.iomem).ranges(args.area, exclude)
+    st = time.time()
+    plan = generate(args.count, args.min_interval, args.max_interval, ranges, args.seed, args.width, args.target)
+    save(args.output, plan, args.seed)
+    print("generated %d flips in %.3fs" % (args.count, time.time() - st), file=sys.stderr)
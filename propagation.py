@@ -0,0 +1,143 @@
+# ==============================================================================
+# This file tracks what happened to the injected flips until the end of the
+# observation window. Guest RAM is captured with `pmemsave` before the flips
+# and at the end of the observation, and the captures are compared chunk by
+# chunk with NumPy on memory-mapped files. For every flipped byte it reports:
+#   persisted    the byte still holds the injected value
+#   overwritten  the guest wrote the byte again
+#   propagated   bytes changed in the page of the flip, compared with a
+#                reference capture
+#   missing      the byte is outside the captured ranges, nothing is known
+# The injected value is the byte read back when it was flipped, or the byte of
+# the capture before the flips with the bits flipped when it is not known.
+# The reference is the capture at the end of a fault free run of the same
+# snapshot (deterministic with icount), so the normal writes of the guest do
+# not count. Without a reference propagated is not computed, compared with the
+# capture before the flips it would mostly count the writes of the workload.
+#
+# A capture is a list of (start address, file), one raw file per range, the
+# files are offline.MemoryImage raw images with base=start.
+# ==============================================================================
+
+import mmap
+import os
+
+import numpy
+
+# bytes compared at once, a multiple of PAGE
+CHUNK = 64 << 20
+PAGE = 4096
+
+PERSISTED = 0
+OVERWRITTEN = 1
+MISSING = 2
+STATUS_NAMES = {PERSISTED: "persisted", OVERWRITTEN: "overwritten", MISSING: "missing"}
+
+def report_dtype():
+    return numpy.dtype([("address", "<u8"), ("bit", "u1"), ("injected", "u1"), ("final", "u1"), ("status", "u1"),
+                        ("propagated", "<u4")])
+
+def capture_ranges(ranges, gap=PAGE):
+    """Sorted inclusive ranges joined when less than gap bytes apart, e.g. many kernel symbols in few pmemsave"""
+    joined = []
+    for start, end in ranges:
+        if joined and start - joined[-1][1] <= gap:
+            joined[-1] = (joined[-1][0], max(joined[-1][1], end))
+        else:
+            joined.append((start, end))
+    return joined
+
+def capture(hmp, ranges, directory, tag):
+    """
+    Save the guest memory of ranges with `pmemsave` into directory, return the capture [(start, file)].
+    The VM should be stopped, hmp runs a monitor command (see snapshot.SnapshotPool).
+    """
+    os.makedirs(directory, exist_ok=True)
+    files = []
+    for start, end in ranges:
+        filename = os.path.join(os.path.abspath(directory), f"{tag}-{start:x}.raw")
+        output = hmp(f"pmemsave 0x{start:x} 0x{end - start + 1:x} {filename}") or ""
+        assert "rror" not in output, f"pmemsave 0x{start:x} failed: {output.strip()}"
+        files.append((start, filename))
+    return files
+
+def map_file(filename):
+    with open(filename, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return numpy.zeros(0, dtype=numpy.uint8)
+        return numpy.frombuffer(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ), dtype=numpy.uint8)
+
+def changed_pages(after, reference, window=PAGE):
+    """Number of bytes that differ between after and reference in every window of bytes, compared in CHUNK pieces"""
+    assert len(after) == len(reference), "captures of different sizes"
+    counts = numpy.zeros((len(after) + window - 1) // window, dtype=numpy.uint32)
+    for offset in range(0, len(after), CHUNK):
+        changed = after[offset:offset + CHUNK] != reference[offset:offset + CHUNK]
+        full = len(changed) // window * window
+        first = offset // window
+        counts[first:first + full // window] = changed[:full].reshape(-1, window).sum(axis=1, dtype=numpy.uint32)
+        if full < len(changed):
+            counts[first + full // window] = numpy.count_nonzero(changed[full:])
+    return counts
+
+def diff(before, after, flips, reference=None, window=PAGE, injected_values=None):
+    """
+    Compare the captures before and after the flips.
+
+    :param before: capture before the flips
+    :param after: capture at the end of the observation, of the same ranges
+    :param flips: (address, bit) pairs of the flipped bytes, bit 0-7
+    :param reference: capture at the end of a fault free run, None leaves propagated 0 and its total None
+    :param window: propagated counts the changed bytes in the window sized block of every flip
+    :param injected_values: {address: byte} read back at flip time, default is before with the flipped bits
+    :return: (array of report_dtype in the order of flips, {"persisted", "overwritten", "missing", "propagated"}
+              totals), flips outside the captures are missing
+    """
+    flips = numpy.array(flips, dtype=numpy.uint64).reshape(-1, 2)
+    report = numpy.zeros(len(flips), dtype=report_dtype())
+    report["address"] = flips[:, 0]
+    report["bit"] = flips[:, 1]
+    found = numpy.zeros(len(flips), dtype=bool)
+    propagated_total = 0 if reference else None
+    for (start, before_file), (after_start, after_file), (ref_start, ref_file) in zip(before, after, reference or before):
+        assert start == after_start == ref_start, "captures of different ranges"
+        old, new = map_file(before_file), map_file(after_file)
+        inside = (report["address"] >= start) & (report["address"] < start + len(old))
+        if not inside.any():
+            continue
+        found |= inside
+        offsets = (report["address"][inside] - start).astype(numpy.int64)
+        masks = (1 << report["bit"][inside]).astype(numpy.uint8)
+        # several flips of one byte add up
+        unique, inverse = numpy.unique(offsets, return_inverse=True)
+        xor = numpy.zeros(len(unique), dtype=numpy.uint8)
+        numpy.bitwise_xor.at(xor, inverse, masks)
+        injected = old[unique] ^ xor
+        if injected_values:
+            known = [injected_values.get(start + int(offset)) for offset in unique]
+            injected = numpy.array([value if value is not None else default for value, default in zip(known, injected)],
+                                   dtype=numpy.uint8)
+        final = new[unique]
+        report["injected"][inside] = injected[inverse]
+        report["final"][inside] = final[inverse]
+        report["status"][inside] = numpy.where(final == injected, PERSISTED, OVERWRITTEN)[inverse]
+
+        if not reference:
+            continue
+        ref = map_file(ref_file)
+        counts = changed_pages(new, ref, window)
+        # the flipped bytes themselves are not propagation
+        numpy.subtract.at(counts, unique[new[unique] != ref[unique]] // window, 1)
+        report["propagated"][inside] = counts[offsets // window]
+        propagated_total += int(counts[numpy.unique(unique // window)].sum())
+    report["status"][~found] = MISSING
+    totals = {"persisted": int(numpy.count_nonzero(report["status"] == PERSISTED)),
+              "overwritten": int(numpy.count_nonzero(report["status"] == OVERWRITTEN)),
+              "missing": int(numpy.count_nonzero(~found)),
+              "propagated": propagated_total}
+    return report, totals
+
+def remove(capture_files):
+    for start, filename in capture_files:
+        if os.path.exists(filename):
+            os.unlink(filename)
@@ -0,0 +1,254 @@
+# ==============================================================================
+# This file is an asyncio QMP client. One connection carries both the QEMU
+# events (GUEST_PANICKED, SHUTDOWN, STOP, RESUME, ...) and the commands
+# (savevm/loadvm/delvm through human-monitor-command, stop, cont), so there
+# is no telnet monitor and no listener thread per VM.
+#
+# QEMU option: -qmp unix:/tmp/qmp.sock,server,nowait
+#
+# Note: This file should run in Host machine.
+# ==============================================================================
+
+import asyncio
+import collections
+import itertools
+import json
+
+# bytes read from the qmp socket at once
+READ_SIZE = 1 << 16
+# events of a failed guest, they end the observation window of a trial early
+FAILURE_EVENTS = ("GUEST_PANICKED", "SHUTDOWN")
+
+class QmpError(Exception):
+    pass
+
+class QmpDecoder:
+    """
+    Incremental decoder of a QMP byte stream. QEMU terminates every message with a newline, so complete lines are
+    decoded as they arrive and only the trailing partial line is kept. Bytes are decoded to str only up to the last
+    newline, a multibyte character split between two reads is never cut.
+    """
+    def __init__(self):
+        self.buffer = bytearray()
+        self.decoder = json.JSONDecoder()
+
+    def feed(self, data: bytes) -> list:
+        """Add received bytes, return the list of messages completed by them"""
+        start = len(self.buffer)
+        self.buffer += data
+        # only the new bytes can hold the last newline
+        end = self.buffer.rfind(b"\n", start)
+        if end < 0:
+            return []
+        text = self.buffer[:end].decode()
+        del self.buffer[:end + 1]
+        try:
+            # json strings never hold a raw newline, so the complete lines form one json array
+            return self.decoder.decode("[" + text.replace("\n", ",") + "]")
+        except json.JSONDecodeError:
+            # e.g. blank lines, fall back to one line at a time
+            return [self.decoder.decode(line) for line in text.split("\n") if line.strip()]
+
+class QmpClient:
+    def __init__(self, address):
+        """
+        :param address: unix socket file path, or (host, port) for a tcp qmp server"""
+        self.address = address
+        self.reader = None
+        self.writer = None
+        self.reader_task = None
+        self.ids = itertools.count(1)
+        # command id -> future of the reply
+        self.pending = {}
+        # event name -> list of callbacks, "*" receives every event
+        self.callbacks = {}
+        # running coroutine callbacks
+        self.tasks = set()
+        self.greeting = None
+        self.decoder = QmpDecoder()
+        # decoded messages not handled yet
+        self.queued = collections.deque()
+
+    async def receive(self):
+        """Return the next message, None if the connection is closed"""
+        while not self.queued:
+            data = await self.reader.read(READ_SIZE)
+            if not data:
+                return None
+            self.queued.extend(self.decoder.feed(data))
+        return self.queued.popleft()
+
+    async def connect(self):
+        if isinstance(self.address, str):
+            self.reader, self.writer = await asyncio.open_unix_connection(self.address)
+        else:
+            self.reader, self.writer = await asyncio.open_connection(*self.address)
+        self.greeting = await self.receive()
+        self.reader_task = asyncio.ensure_future(self.read_loop())
+        await self.execute("qmp_capabilities")
+        print(f"qmp connection {self.address} established.")
+
+    def on(self, event, callback):
+        """Call callback(message) for every `event` message, event "*" matches all events.
+        callback may be a coroutine function, it is scheduled as a task."""
+        self.callbacks.setdefault(event, []).append(callback)
+
+    def wait_event(self, event, match=None):
+        """Return a future of the next `event` message for which match(message) is true, e.g. the end of a job.
+        Create it before sending the command that causes the event."""
+        future = asyncio.get_running_loop().create_future()
+
+        def callback(message):
+            if future.done():
+                return
+            if message["event"] == "QMP_CLOSED":
+                future.set_exception(ConnectionError("qmp connection closed"))
+            elif match is None or match(message):
+                future.set_result(message)
+            else:
+                return
+            self.callbacks[event].remove(callback)
+            self.callbacks["QMP_CLOSED"].remove(callback)
+        self.on(event, callback)
+        self.on("QMP_CLOSED", callback)
+        return future
+
+    async def read_loop(self):
+        try:
+            while True:
+                message = await self.receive()
+                if message is None:
+                    # qemu shutdown
+                    break
+                self.dispatch(message)
+        except ConnectionError:
+            pass
+        finally:
+            for future in self.pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionError("qmp connection closed"))
+            self.pending.clear()
+            self.dispatch({"event": "QMP_CLOSED"})
+
+    def dispatch(self, message):
+        if "event" in message:
+            for callback in self.callbacks.get(message["event"], []) + self.callbacks.get("*", []):
+                result = callback(message)
+                if asyncio.iscoroutine(result):
+                    task = asyncio.ensure_future(result)
+                    self.tasks.add(task)
+                    task.add_done_callback(self.task_done)
+            return
+        future = self.pending.pop(message.get("id"), None)
+        if future is None or future.done():
+            return
+        if "error" in message:
+            future.set_exception(QmpError(message["error"].get("desc", message["error"])))
+        else:
+            future.set_result(message.get("return"))
+
+    def task_done(self, task):
+        self.tasks.discard(task)
+        if not task.cancelled() and task.exception():
+            print(f"qmp event callback failed: {task.exception()!r}")
+
+    def send(self, command, arguments=None):
+        """Send a command and return the future of its reply without waiting"""
+        cid = next(self.ids)
+        message = {"execute": command, "id": cid}
+        if arguments:
+            message["arguments"] = arguments
+        future = asyncio.get_running_loop().create_future()
+        self.pending[cid] = future
+        self.writer.write(json.dumps(message).encode() + b"\n")
+        return future
+
+    async def execute(self, command, arguments=None):
+        return await self.send(command, arguments)
+
+    async def hmp(self, command_line):
+        """Run a human monitor command, e.g. "savevm snap", and return its output"""
+        output = await self.execute("human-monitor-command", {"command-line": command_line})
+        # savevm/loadvm report failures as output instead of a qmp error
+        if output and ("Error" in output or "does not exist" in output):
+            raise QmpError(f"{command_line}: {output.strip()}")
+        return output
+
+    async def vm_action(self, action, snapname):
+        """Execute savevm, loadvm or delvm"""
+        assert action in ['savevm', 'loadvm', 'delvm'], "vm_action error: Invalid args"
+        return await self.hmp(f"{action} {snapname}")
+
+    async def stop(self):
+        return await self.execute("stop")
+
+    async def cont(self):
+        return await self.execute("cont")
+
+    async def close(self):
+        if self.writer:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except ConnectionError:
+                pass
+        if self.reader_task:
+            await asyncio.gather(self.reader_task, return_exceptions=True)
+        self.writer = None
+
+class PanicCounter:
+    """
+    Count GUEST_PANICKED events of one VM. If snapname is given the VM is reverted to the snapshot after every panic,
+    the snapshot is created on start.
+    """
+    def __init__(self, address, snapname=None, verbose=True):
+        self.client = QmpClient(address)
+        self.snapname = snapname
+        self.verbose = verbose
+        self.panic = 0
+        self.closed = None
+
+    async def start(self):
+        self.closed = asyncio.get_running_loop().create_future()
+        self.client.on("GUEST_PANICKED", self.on_panic)
+        self.client.on("QMP_CLOSED", self.on_closed)
+        if self.verbose:
+            self.client.on("*", print)
+        await self.client.connect()
+        if self.snapname:
+            # create a snapshot to revert to after qemu crashes
+            await self.client.vm_action("savevm", self.snapname)
+
+    async def on_panic(self, message):
+        self.panic += 1
+        if not self.snapname:
+            return
+        try:
+            await self.client.vm_action("loadvm", self.snapname)
+            # a panicked guest is paused, loadvm only resumes a running vm
+            if message.get("data", {}).get("action") == "pause":
+                await self.client.cont()
+        except ConnectionError:
+            print("qemu shutdown before reverting to the snapshot")
+
+    def on_closed(self, message):
+        if not self.closed.done():
+            self.closed.set_result(None)
+
+    async def run(self):
+        """Count panics until qemu shuts down"""
+        await self.start()
+        await self.closed
+        return self.panic
+
+async def count_panics(addresses, snapname=None):
+    """Count panics of several VMs over one event loop, return {address: panic count}"""
+    counters = [PanicCounter(address, snapname) for address in addresses]
+    counts = await asyncio.gather(*(counter.run() for counter in counters))
+    return dict(zip(addresses, counts))
+
+if __name__ == '__main__':
+    import sys
+    sockfiles = sys.argv[1:] or ["/tmp/qmp.sock"]
+    for sockfile, panic in asyncio.run(count_panics(sockfiles)).items():
+        print(f"{sockfile} panic count: {panic}")
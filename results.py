@@ -0,0 +1,317 @@
+# ==============================================================================
+# This file keeps the results of injection campaigns in one SQLite database,
+# so the flips and the outcomes of the trials join on the run and trial id:
+#   flips   run, trial, time, kind, address, register, vcpu, bit, old, new,
+#           area, symbol, failed
+#   trials  run, trial, vm, outcome, label, failure_time, failed
+#   crashes run, trial, pc, backtrace   (see attribution.py)
+#
+# Trial ids restart with every campaign, so every campaign is a run of its
+# own: the name of the manifest or log it is ingested from, or a generated
+# id. The failure rates are over all runs of the database.
+#
+# Sources: the binary and csv logs of fliplog.py (`loginject` in gdb, or the
+# log of snapinject_ram, `snap.py --log`), the manifests of `campaign.py --record` (or `campaign.py --results` directly),
+# and the "Trial <n>: <label>" and "Crash <n>: ..." lines of snapinject in
+# gdb.txt or of snapinject_ram on the host, in any order. Rows are inserted in batches, one
+# transaction per batch. The outcome of a trial is copied to the failed column
+# of its flips, so the failure rate by area, bit, symbol or vCPU is one GROUP
+# BY over a covering index, nothing is loaded into memory.
+#
+# A trial failed unless its label is benign (see console.py). Values of 64
+# bits are stored as signed integers, export() returns them unsigned.
+#
+# Usage: python3 results.py results.db ingest --log flips.bin --trials gdb.txt --iomem iomem.txt [--run run1]
+#        python3 results.py results.db report --by area --by bit
+#        python3 results.py results.db export results.npz
+#
+# Note: This file should run in Host machine.
+# ==============================================================================
+
+import csv
+import json
+import os
+import re
+import sqlite3
+import time
+import uuid
+
+import numpy
+
+from attribution import parse_crash_line
+from fliplog import BINARY_MAGIC, KIND_NAMES, KIND_RAM, binary_dtype
+
+# rows inserted per transaction
+BATCH = 50000
+# columns report() can group the flips by, the first ones have an index
+INDEXED = ("area", "bit", "symbol", "vcpu")
+GROUPS = INDEXED + ("register", "kind")
+# "Trial 3: crash" lines of snapinject and snapinject_ram
+TRIAL_LINE = re.compile(r"^Trial (\d+): (\w+)\s*$")
+SIGN = 1 << 63
+# columns of export(), text columns become uint32 codes
+EXPORT_COLUMNS = {"flips": ("run", "trial", "time", "kind", "address", "register", "vcpu", "bit", "old", "new", "area",
+                            "symbol", "failed"),
+                  "trials": ("run", "trial", "vm", "outcome", "label", "failure_time", "failed")}
+TEXT_COLUMNS = ("run", "kind", "register", "vcpu", "area", "symbol", "vm", "outcome", "label")
+UNSIGNED_COLUMNS = ("address", "old", "new")
+EXPORT_TYPES = {"time": numpy.float64, "failure_time": numpy.float64, **dict.fromkeys(TEXT_COLUMNS, numpy.uint32)}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS flips (run TEXT NOT NULL, trial INTEGER, time REAL, kind TEXT, address INTEGER,
+                                  register TEXT, vcpu TEXT, bit INTEGER, old INTEGER, new INTEGER, area TEXT,
+                                  symbol TEXT, failed INTEGER NOT NULL DEFAULT 0);
+CREATE TABLE IF NOT EXISTS trials (run TEXT NOT NULL, trial INTEGER, vm TEXT, outcome TEXT, label TEXT,
+                                   failure_time REAL, failed INTEGER NOT NULL, PRIMARY KEY (run, trial));
+CREATE TABLE IF NOT EXISTS crashes (run TEXT NOT NULL, trial INTEGER, pc TEXT, backtrace TEXT,
+                                    PRIMARY KEY (run, trial));
+CREATE INDEX IF NOT EXISTS flips_trial ON flips (run, trial);
+""" + "".join(f"CREATE INDEX IF NOT EXISTS flips_{group} ON flips ({group}, failed);\n" for group in INDEXED)
+
+def signed(value):
+    """value of 64 bits as the signed integer sqlite stores"""
+    return value - (SIGN << 1) if value is not None and value >= SIGN else value
+
+def split_register(name):
+    """(vcpu, register) of a logged register name, "cpu2/x1" or "x1" (see flip_registers in gdb/fliputils.py)"""
+    vcpu, _, register = name.rpartition("/")
+    return vcpu or None, register
+
+def new_run():
+    """Run id of a campaign with no manifest or log name, unique across hosts"""
+    return time.strftime("%Y%m%d-%H%M%S-") + uuid.uuid4().hex[:8]
+
+def run_name(filename):
+    """Run id of a manifest or log, its file name without the extension"""
+    return os.path.splitext(os.path.basename(filename))[0]
+
+def flipped_bit(old, new):
+    """Lowest flipped bit, None if no bit changed"""
+    diff = old ^ new
+    return (diff & -diff).bit_length() - 1 if diff else None
+
+class ResultStore:
+    def __init__(self, filename, iomem_index=None, symbol_index=None, kernel_offset=0, run=None):
+        """
+        :param run: run id of the rows added, a generated one (new_run) if None
+        :param iomem_index: iomem.IomemIndex, ram flips get the name of the innermost resource as area
+        :param symbol_index: ksyms.SymbolIndex, ram flips get the symbol at address - kernel_offset"""
+        self.filename = filename
+        self.db = sqlite3.connect(filename)
+        columns = [row[1] for row in self.db.execute("PRAGMA table_info(flips)")]
+        assert not columns or "run" in columns, f"{filename} has no run column, ingest into a new database"
+        self.db.executescript(SCHEMA)
+        self.run = run or new_run()
+        self.iomem_index = iomem_index
+        self.symbol_index = symbol_index
+        self.kernel_offset = kernel_offset
+        self.flips = []
+        self.trials = []
+        self.crashes = []
+
+    def area(self, address):
+        resource = self.iomem_index.lookup(address) if self.iomem_index else None
+        return resource.name if resource else None
+
+    def symbol(self, address):
+        symbol = self.symbol_index.lookup(address - self.kernel_offset) if self.symbol_index else None
+        return symbol[0] if symbol else None
+
+    def add_flip(self, trial, time, kind, target, old=None, new=None, bit=None):
+        """
+        Add one flip. target is a physical address for kind "ram", a register name for "reg".
+        bit defaults to the lowest bit flipped between old and new.
+        """
+        if bit is None and old is not None and new is not None:
+            bit = flipped_bit(old, new)
+        if kind == "ram":
+            row = (self.run, trial, time, kind, target, None, None, bit, signed(old), signed(new),
+                   self.area(target), self.symbol(target))
+        else:
+            vcpu, register = split_register(target)
+            row = (self.run, trial, time, kind, None, register, vcpu, bit, signed(old), signed(new), None, None)
+        self.flips.append(row)
+        if len(self.flips) >= BATCH:
+            self.flush()
+
+    def add_trial(self, trial, label, outcome=None, vm=None, failure_time=None):
+        self.trials.append((self.run, trial, vm, outcome, label, failure_time, int(label != "benign")))
+        if len(self.trials) >= BATCH:
+            self.flush()
+
+    def add_crash(self, trial, pc, backtrace):
+        """
+        :param pc: faulting PC as "symbol+0xoffset" or "0x<virtual address>", None if unknown
+        :param backtrace: frames of the call trace, innermost first"""
+        self.crashes.append((self.run, trial, pc, ",".join(backtrace)))
+
+    def flush(self):
+        """Insert the buffered rows in one transaction, new flips take the failed flag of their known trial"""
+        with self.db:
+            self.db.executemany("INSERT OR REPLACE INTO trials VALUES (?, ?, ?, ?, ?, ?, ?)", self.trials)
+            self.db.executemany("INSERT OR REPLACE INTO crashes VALUES (?, ?, ?, ?)", self.crashes)
+            self.db.executemany("INSERT INTO flips (run, trial, time, kind, address, register, vcpu, bit, old, new, "
+                                "area, symbol, failed) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, "
+                                "COALESCE((SELECT failed FROM trials WHERE run = ?1 AND trial = ?2), 0))", self.flips)
+            # flips stored before their trial
+            self.db.executemany("UPDATE flips SET failed = ?3 WHERE run = ?1 AND trial = ?2 AND failed != ?3",
+                                [(trial[0], trial[1], trial[-1]) for trial in self.trials])
+        self.flips, self.trials, self.crashes = [], [], []
+
+    def ingest_log(self, filename):
+        """Add the flips of a binary or csv log of fliplog.py, return their number"""
+        with open(filename, "rb") as f:
+            binary = f.read(len(BINARY_MAGIC)) == BINARY_MAGIC
+        count = 0
+        if binary:
+            records = numpy.fromfile(filename, dtype=binary_dtype(), offset=len(BINARY_MAGIC))
+            for start in range(0, len(records), BATCH):
+                for timestamp, trial, kind, address, old, new, name in records[start:start + BATCH].tolist():
+                    target = address if kind == KIND_RAM else name.rstrip(b"\0").decode()
+                    self.add_flip(trial, timestamp, KIND_NAMES[kind], target, old, new)
+            count = len(records)
+        else:
+            with open(filename, newline="") as f:
+                reader = csv.reader(f)
+                # header
+                next(reader, None)
+                for timestamp, trial, kind, target, old, new in reader:
+                    target = int(target, 16) if kind == "ram" else target
+                    self.add_flip(int(trial), float(timestamp), kind, target, int(old, 16), int(new, 16))
+                    count += 1
+        self.flush()
+        return count
+
+    def ingest_manifest(self, filename):
+        """Add the trials and flips of a campaign.py manifest, return the number of trials"""
+        count = 0
+        with open(filename) as f:
+            # settings
+            f.readline()
+            for entry in map(json.loads, f):
+                self.add_result(entry)
+                count += 1
+        self.flush()
+        return count
+
+    def add_result(self, result):
+        """Add a trial result of campaign.py, with its flips if it was recorded"""
+        self.add_trial(result["trial"], result["label"], result["outcome"], result["vm"], result["failure_time"])
+        if result.get("crash"):
+            self.add_crash(result["trial"], *result["crash"])
+        for ftime, address, bit, width, target in result.get("flips", []):
+            self.add_flip(result["trial"], ftime * 1e-9, "ram", address + bit // 8, bit=bit % 8)
+
+    def ingest_trials(self, filename):
+        """Add the trial labels and crashes of "Trial <n>: <label>" and "Crash <n>: ..." lines in a text log,
+        return the number of trials"""
+        count = 0
+        with open(filename, errors="replace") as f:
+            for line in f:
+                match = TRIAL_LINE.match(line)
+                if match:
+                    self.add_trial(int(match.group(1)), match.group(2))
+                    count += 1
+                crash = parse_crash_line(line)
+                if crash:
+                    self.add_crash(*crash)
+        self.flush()
+        return count
+
+    def rates(self, group):
+        """[(value, flips, flips in failed trials)] of the flips grouped by a column of GROUPS, most flips first"""
+        assert group in GROUPS, f"rates error: cannot group by {group}"
+        return self.db.execute(f"SELECT {group}, COUNT(*), SUM(failed) FROM flips WHERE {group} IS NOT NULL "
+                               f"GROUP BY {group} ORDER BY COUNT(*) DESC").fetchall()
+
+    def outcomes(self):
+        """[(label, trials)]"""
+        return self.db.execute("SELECT label, COUNT(*) FROM trials GROUP BY label ORDER BY COUNT(*) DESC").fetchall()
+
+    def export(self, filename):
+        """
+        Write the flips and trials column by column to a NumPy .npz file, fetched BATCH rows at a time. Text columns
+        are stored as codes into a <table>_<column>_names array, missing numbers as -1 (NaN for times).
+        """
+        columns = {}
+        for table, names in EXPORT_COLUMNS.items():
+            count = self.db.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+            arrays = {name: numpy.empty(count, dtype=EXPORT_TYPES.get(name, numpy.int64)) for name in names}
+            codes = {name: {} for name in names if name in TEXT_COLUMNS}
+            cursor = self.db.execute(f"SELECT {', '.join(names)} FROM {table}")
+            offset = 0
+            for rows in iter(lambda: cursor.fetchmany(BATCH), []):
+                for name, values in zip(names, zip(*rows)):
+                    if name in codes:
+                        values = [codes[name].setdefault(value, len(codes[name])) for value in values]
+                    else:
+                        missing = numpy.nan if arrays[name].dtype.kind == "f" else -1
+                        values = [missing if value is None else value for value in values]
+                    arrays[name][offset:offset + len(rows)] = values
+                offset += len(rows)
+            for name in names:
+                columns[f"{table}_{name}"] = arrays[name].view(numpy.uint64) if name in UNSIGNED_COLUMNS else arrays[name]
+                if name in codes:
+                    columns[f"{table}_{name}_names"] = numpy.array([str(value) for value in codes[name]])
+        numpy.savez(filename, **columns)
+        return columns
+
+    def close(self):
+        self.flush()
+        self.db.close()
+
+def report(store, groups, limit=20):
+    for label, count in store.outcomes():
+        print(f"{label}: {count} trials")
+    for group in groups:
+        print(f"failure rate by {group}:")
+        for value, flips, failed in store.rates(group)[:limit]:
+            print(f"  {value}: {failed}/{flips} flips in failed trials ({failed / flips * 100:.2f}%)")
+
+if __name__ == '__main__':
+    import argparse
+    import iomem
+    import ksyms
+
+    parser = argparse.ArgumentParser(description="Store and report campaign results")
+    parser.add_argument("database")
+    commands = parser.add_subparsers(dest="command", required=True)
+    ingest = commands.add_parser("ingest", help="add logs, manifests and trial labels")
+    ingest.add_argument("--log", action="append", default=[], help="binary or csv log of fliplog.py")
+    ingest.add_argument("--manifest", action="append", default=[], help="manifest of campaign.py --record")
+    ingest.add_argument("--trials", action="append", default=[],
+                        help="text log with 'Trial <n>: <label>' and 'Crash <n>: ...' lines")
+    ingest.add_argument("--run", help="run id of the campaign, default: the name of the first manifest or log")
+    ingest.add_argument("--iomem", default="iomem.txt", help="label ram flips with their iomem resource")
+    ingest.add_argument("--symbol-map", help="label ram flips with their kernel symbol, see ksyms.py")
+    rep = commands.add_parser("report", help="failure rates")
+    rep.add_argument("--by", action="append", choices=GROUPS, help="default: area and bit")
+    rep.add_argument("--limit", type=int, default=20)
+    export = commands.add_parser("export", help="write the columns to a NumPy .npz file")
+    export.add_argument("output")
+    args = parser.parse_args()
+
+    st = time.time()
+    if args.command == "ingest":
+        iomem_index = iomem.load(args.iomem) if os.path.exists(args.iomem) else None
+        symbol_index = ksyms.load(args.symbol_map) if args.symbol_map else None
+        offset = ksyms.kernel_offset(symbol_index, iomem_index) if symbol_index else 0
+        sources = args.manifest + args.log + args.trials
+        run = args.run or (run_name(sources[0]) if sources else None)
+        store = ResultStore(args.database, iomem_index, symbol_index, offset, run)
+        print(f"run {store.run}")
+        for filename in args.log:
+            print(f"{filename}: {store.ingest_log(filename)} flips")
+        for filename in args.manifest:
+            print(f"{filename}: {store.ingest_manifest(filename)} trials")
+        for filename in args.trials:
+            print(f"{filename}: {store.ingest_trials(filename)} trials")
+    else:
+        store = ResultStore(args.database)
+        if args.command == "report":
+            report(store, args.by or ["area", "bit"], args.limit)
+        else:
+            columns = store.export(args.output)
+            print(f"{args.output}: {len(columns['flips_trial'])} flips, {len(columns['trials_trial'])} trials")
+    store.close()
+    print(f"{args.command} took {time.time() - st:.3f}s")
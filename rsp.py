@@ -0,0 +1,239 @@
+# ==============================================================================
+# This file is a minimal GDB remote serial protocol client that talks to the
+# QEMU gdbstub directly, without spawning gdb or parsing MI output.
+#
+# Only the packets used by the flip scripts are implemented:
+#   Qqemu.PhyMemMode:1, m/M memory packets, qRcmd monitor commands and D.
+#
+# Note: This file should run in Host machine.
+# ==============================================================================
+
+import random
+import socket
+import time
+
+from upset import flip_blocks
+
+# QEMU advertises PacketSize=1000 (hex), keep memory packets well below it
+MAX_MEMORY_CHUNK = 0x400
+
+def checksum(data: bytes) -> int:
+    return sum(data) & 0xff
+
+def encode_packet(payload: str) -> bytes:
+    data = escape(payload.encode())
+    return b'$' + data + b'#' + b'%02x' % checksum(data)
+
+def escape(data: bytes) -> bytes:
+    out = bytearray()
+    for c in data:
+        if c in b'#$}*':
+            out += bytes((0x7d, c ^ 0x20))
+        else:
+            out.append(c)
+    return bytes(out)
+
+def unescape(data: bytes) -> bytes:
+    """Undo '}' escaping and '*' run-length encoding of a packet body"""
+    out = bytearray()
+    i = 0
+    while i < len(data):
+        c = data[i]
+        if c == 0x7d:
+            i += 1
+            out.append(data[i] ^ 0x20)
+        elif c == 0x2a and out:
+            i += 1
+            out += bytes((out[-1],)) * (data[i] - 29)
+        else:
+            out.append(c)
+        i += 1
+    return bytes(out)
+
+class RspError(Exception):
+    pass
+
+class RspClient:
+    def __init__(self, host="localhost", port=1234, timeout=10):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.sock = None
+        self.buffer = bytearray()
+        self.noack = False
+
+    def connect(self):
+        """Connect to the gdbstub and switch to no-ack mode if supported"""
+        self.sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.buffer.clear()
+        self.noack = False
+        if self.packet("QStartNoAckMode") == "OK":
+            self.noack = True
+
+    def close(self):
+        if self.sock:
+            self.sock.close()
+            self.sock = None
+
+    def _fill(self):
+        data = self.sock.recv(65536)
+        if not data:
+            raise ConnectionError("gdbstub closed the connection")
+        self.buffer += data
+
+    def _read_packet(self) -> str:
+        while True:
+            start = self.buffer.find(b'$')
+            if start >= 0:
+                # drop acks and anything before the packet start
+                del self.buffer[:start]
+                end = self.buffer.find(b'#')
+                if end >= 0 and len(self.buffer) >= end + 3:
+                    data = bytes(self.buffer[1:end])
+                    csum = int(self.buffer[end + 1:end + 3], 16)
+                    del self.buffer[:end + 3]
+                    if not self.noack:
+                        self.sock.sendall(b'+' if csum == checksum(data) else b'-')
+                    if csum != checksum(data):
+                        continue
+                    return unescape(data).decode('latin-1')
+            else:
+                self.buffer.clear()
+            self._fill()
+
+    def _send_packet(self, payload: str):
+        packet = encode_packet(payload)
+        self.sock.sendall(packet)
+        if self.noack:
+            return
+        while True:
+            if not self.buffer:
+                self._fill()
+            ack = self.buffer[0]
+            if ack == ord('+'):
+                del self.buffer[:1]
+                return
+            if ack == ord('-'):
+                del self.buffer[:1]
+                self.sock.sendall(packet)
+            else:
+                # QEMU sends no ack for some packets
+                return
+
+    def packet(self, payload: str) -> str:
+        """Send one packet and return the reply, skipping asynchronous stop replies"""
+        self._send_packet(payload)
+        while True:
+            reply = self._read_packet()
+            # qemu reports a stop reply every time the vm stops, e.g. after `monitor stop`
+            if reply[:1] in ('T', 'S') and not payload.startswith('?'):
+                continue
+            return reply
+
+    def _check(self, reply, payload):
+        if reply.startswith('E') and len(reply) == 3:
+            raise RspError(f"packet {payload[:32]!r} failed: {reply}")
+        return reply
+
+    def set_phy_mem_mode(self, enable=True):
+        reply = self.packet(f"Qqemu.PhyMemMode:{int(enable)}")
+        if reply != "OK":
+            raise RspError(f"gdbstub does not support physical memory mode: {reply!r}")
+
+    def read_memory(self, address: int, length: int) -> bytes:
+        data = bytearray()
+        while len(data) < length:
+            size = min(MAX_MEMORY_CHUNK, length - len(data))
+            payload = f"m{address + len(data):x},{size:x}"
+            data += bytes.fromhex(self._check(self.packet(payload), payload))
+        return bytes(data)
+
+    def write_memory(self, address: int, data: bytes):
+        for offset in range(0, len(data), MAX_MEMORY_CHUNK):
+            chunk = data[offset:offset + MAX_MEMORY_CHUNK]
+            payload = f"M{address + offset:x},{len(chunk):x}:{chunk.hex()}"
+            if self._check(self.packet(payload), payload) != "OK":
+                raise RspError(f"unexpected reply to memory write at 0x{address + offset:x}")
+
+    def monitor(self, command: str) -> str:
+        """Run a qemu monitor command with qRcmd and return its output"""
+        self._send_packet("qRcmd," + command.encode().hex())
+        output = []
+        while True:
+            reply = self._read_packet()
+            if reply.startswith('O') and reply != 'OK':
+                output.append(bytes.fromhex(reply[1:]).decode(errors='replace'))
+            elif reply[:1] in ('T', 'S'):
+                continue
+            elif reply == 'OK' or reply == '':
+                return ''.join(output)
+            else:
+                # some stubs return the output as a plain hex reply
+                return ''.join(output) + bytes.fromhex(self._check(reply, command)).decode(errors='replace')
+
+    def detach(self):
+        self.packet("D")
+
+class RspSession:
+    """
+    Flip session speaking the gdb remote protocol directly, the same interface as fliputils.FlipSession.
+    """
+    def __init__(self, host="localhost", port=1234):
+        self.client = RspClient(host, port)
+        self.attached = False
+
+    def attach(self):
+        if self.attached:
+            return
+        self.client.connect()
+        self.client.set_phy_mem_mode(True)
+        # qemu stops the guest when a debugger connects, let it run until the next flip
+        self.client.monitor("cont")
+        self.attached = True
+
+    def monitor(self, command, timeout_sec=10):
+        self.attach()
+        self.client.sock.settimeout(timeout_sec)
+        try:
+            return self.client.monitor(command)
+        finally:
+            self.client.sock.settimeout(self.client.timeout)
+
+    def flip(self, address, bit):
+        """Flip one bit of the byte at physical address, return (old, new) byte values read from the guest"""
+        self.attach()
+        self.client.monitor("stop")
+        try:
+            oldvalue = self.client.read_memory(address, 1)[0]
+            self.client.write_memory(address, bytes((oldvalue ^ (1 << bit),)))
+            newvalue = self.client.read_memory(address, 1)[0]
+        finally:
+            self.client.monitor("cont")
+        return oldvalue, newvalue
+
+    def flip_cluster(self, flips):
+        """Flip the (address, bit) cells of a multi-bit upset in one stop, return [(address, old, new)] per byte"""
+        self.attach()
+        self.client.monitor("stop")
+        try:
+            return flip_blocks(flips, self.client.read_memory, self.client.write_memory)
+        finally:
+            self.client.monitor("cont")
+
+    def close(self):
+        if self.attached:
+            # detach to make qemu running
+            self.client.detach()
+            self.attached = False
+        self.client.close()
+
+if __name__ == '__main__':
+    # Simple throughput test against a running gdbstub, e.g. `python3 fakestub.py`
+    session = RspSession()
+    st = time.time()
+    for _ in range(1000):
+        session.flip(0x40000000 + random.randint(0, 0xfff), random.randint(0, 7))
+    et = time.time()
+    session.close()
+    print("1000 flips duration %.3fs" % (et - st))
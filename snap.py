@@ -4,18 +4,36 @@
 # The testing method is to save a snapshot of the machine before the flip, 
 # run it for a period of time after the flip, record the running status, 
 # then load the previous snapshot and repeat the experiment.
+# With --target-width the experiment is repeated until the confidence interval
+# of the failure rate is narrow enough, at most --loops times (see estimate.py).
+#
+# Failures are detected over /tmp/qmp.sock and, with --console, from the guest console log.
+#
+# Usage: python3 snap.py [--loops 6] [--console console.log] [--target-width 0.05 [--per-area]]
 # 
 # Author: Yexuan Yang <myemailyyxg@gmail.com>
 # Date: 2024-10-18
 # ==============================================================================
 
 from fliputils import *
-from countpanic import *
-import threading
 
 if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Flip, observe and revert to the snapshot in a loop")
+    parser.add_argument("--loops", type=int, default=6, help="number of loops, the maximum with --target-width")
+    parser.add_argument("--qmp", default="/tmp/qmp.sock", help="QMP socket to watch for panics and shutdowns, "
+                                                                 "'' to disable")
+    parser.add_argument("--console", help="guest console log to label the loops from")
+    parser.add_argument("--target-width", type=float, help="stop once the confidence interval of the failure rate is "
+                                                           "at most this wide")
+    parser.add_argument("--per-area", action="store_true", help="--target-width for every iomem area hit")
+    parser.add_argument("--log", help="fliplog file every flipped byte is written to, see results.py")
+    parser.add_argument("--log-format", choices=["csv", "bin"], default="csv", help="format of --log")
+    args = parser.parse_args()
+    if args.target_width and not (args.qmp or args.console):
+        parser.error("--target-width needs --qmp or --console to detect failures")
+
     # snapinject_ram(4800, 0.345 * 1e9, 0.345 * 1e9, 2 * 60, 10)
-    counter = threading.Thread(target=count_panic, args=("/tmp/qmp.sock",))
-    counter.start()
-    snapinject_ram(1, 1 * 1e9, 2 * 1e9, 10, 6)
-    counter.join()
+    snapinject_ram(1, 1 * 1e9, 2 * 1e9, 10, args.loops, qmp=args.qmp or None, console=args.console,
+                   target_width=args.target_width, per_area=args.per_area, log=args.log, log_format=args.log_format)
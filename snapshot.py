@@ -0,0 +1,246 @@
+# ==============================================================================
+# This file manages the VM snapshots of the injection campaigns.
+#
+# The disk of the VM can be switched to a qcow2 overlay in a tmpfs directory
+# (`snapshot_blkdev`), so savevm/loadvm read and write RAM instead of the disk
+# image. Baseline snapshots are kept by name in a registry next to the overlay
+# and reused by later campaigns of the same QEMU, temporary snapshots are
+# deleted when the pool is closed, also when the script dies with an exception.
+# The latency of every savevm and loadvm is recorded per snapshot.
+#
+# The pool only needs a function running a monitor command and returning its
+# output, e.g. FlipSession.monitor, RspSession.monitor or qemu_hmp in gdb.
+# load_qmp restores over an asyncio QMP client instead, with the snapshot-load
+# job when QEMU has it, so the host keeps working while the guest is restored.
+# ==============================================================================
+
+import atexit
+import itertools
+import json
+import os
+import re
+import time
+
+DEFAULT_TMPFS = "/dev/shm/flip_snapshots"
+REGISTRY = "registry.json"
+
+class SnapshotError(Exception):
+    pass
+
+def new_entry(persistent):
+    return {"persistent": persistent, "created": time.time(), "last_used": time.time(),
+            "save": [0, 0.0, 0.0], "load": [0, 0.0, 0.0]}
+
+class SnapshotPool:
+    def __init__(self, hmp, tmpfs=None, device=None):
+        """
+        :param hmp: function running a qemu monitor command, returns the output
+        :param tmpfs: directory in a tmpfs for the disk overlay and the registry, None keeps snapshots in the disk image
+        :param device: block device switched to the overlay, default is the first device with an image file"""
+        self.hmp = hmp
+        self.tmpfs = tmpfs
+        self.device = device
+        self.overlay = None
+        # name -> {"persistent", "created", "last_used", "save": [count, total, max], "load": [...]}
+        self.snapshots = {}
+        self.closed = False
+        # whether the qmp server has snapshot-load, and its (vmstate node, [nodes]), found by the first load_qmp
+        self.qmp_jobs = None
+        self.job_nodes = None
+        self.job_ids = itertools.count()
+        if tmpfs:
+            os.makedirs(tmpfs, exist_ok=True)
+            self.attach_overlay()
+            self.load_registry()
+        atexit.register(self.close)
+
+    def run(self, command):
+        output = self.hmp(command) or ""
+        if "Error" in output or "does not exist" in output or "not found" in output:
+            raise SnapshotError(f"{command}: {output.strip()}")
+        return output
+
+    def block_devices(self):
+        """Return [(device, image file)] from `info block`"""
+        devices = []
+        for line in self.run("info block").splitlines():
+            # e.g. "virtio0 (#block143): /path/disk.qcow2 (qcow2)"
+            match = re.match(r'^(\S+)(?: \(#\w+\))?: (\S+) \((\w+)\)', line)
+            if match:
+                devices.append((match.group(1), match.group(2)))
+        return devices
+
+    def attach_overlay(self):
+        """Put a qcow2 overlay in the tmpfs directory on top of the disk, once per QEMU"""
+        devices = self.block_devices()
+        if not devices:
+            raise SnapshotError("no block device with an image file, savevm needs a qcow2 disk")
+        device, image = next(((d, i) for d, i in devices if d == self.device), devices[0]) if self.device else devices[0]
+        self.device = device
+        if os.path.dirname(image) == os.path.abspath(self.tmpfs):
+            # a previous campaign already switched this QEMU to an overlay
+            self.overlay = image
+            return
+        self.overlay = os.path.join(os.path.abspath(self.tmpfs), f"{device}-{os.getpid()}-{int(time.time())}.qcow2")
+        self.run(f"snapshot_blkdev {device} {self.overlay} qcow2")
+        print(f"{device} overlay {self.overlay}")
+
+    def registry_path(self):
+        return os.path.join(self.tmpfs, REGISTRY)
+
+    def load_registry(self):
+        """Reuse the persistent snapshots of previous campaigns that still exist in the overlay"""
+        if not os.path.exists(self.registry_path()):
+            return
+        with open(self.registry_path()) as f:
+            registry = json.load(f)
+        existing = self.existing()
+        for name, entry in registry.get(self.overlay, {}).items():
+            if name in existing and entry.get("persistent"):
+                self.snapshots[name] = entry
+
+    def save_registry(self):
+        if not self.tmpfs:
+            return
+        registry = {}
+        if os.path.exists(self.registry_path()):
+            with open(self.registry_path()) as f:
+                registry = json.load(f)
+        registry[self.overlay] = {name: entry for name, entry in self.snapshots.items() if entry["persistent"]}
+        # drop overlays that no longer exist
+        registry = {overlay: entries for overlay, entries in registry.items() if os.path.exists(overlay)}
+        tmpname = self.registry_path() + ".tmp"
+        with open(tmpname, "w") as f:
+            json.dump(registry, f, indent=1)
+        os.replace(tmpname, self.registry_path())
+
+    def existing(self):
+        """Names of the snapshots `info snapshots` lists"""
+        names = set()
+        for line in self.hmp("info snapshots").splitlines():
+            # e.g. "--        snapinject_begin   1.2 GiB 2024-10-18 12:00:00 00:01:02.345  ..."
+            parts = line.split()
+            if len(parts) >= 2 and (parts[0] == "--" or parts[0].isdigit()):
+                names.add(parts[1])
+        return names
+
+    def record(self, name, action, elapsed):
+        entry = self.snapshots[name]
+        stats = entry["save" if action == "savevm" else "load"]
+        stats[0] += 1
+        stats[1] += elapsed
+        stats[2] = max(stats[2], elapsed)
+        entry["last_used"] = time.time()
+        print(f"{action} {name} {elapsed * 1000:.1f} ms")
+
+    def timed(self, name, action):
+        st = time.perf_counter()
+        self.run(f"{action} {name}")
+        elapsed = time.perf_counter() - st
+        self.record(name, action, elapsed)
+        return elapsed
+
+    def save(self, name, persistent=False):
+        """
+        Create snapshot name. A persistent snapshot that already exists from a previous campaign is reused as is,
+        other snapshots are deleted by close().
+        """
+        if name in self.snapshots and self.snapshots[name]["persistent"]:
+            print(f"reuse snapshot {name}")
+            return 0.0
+        self.snapshots[name] = new_entry(persistent)
+        elapsed = self.timed(name, "savevm")
+        self.save_registry()
+        return elapsed
+
+    def baseline(self, name):
+        """Bring the VM to the persistent snapshot name, created now if no previous campaign left it"""
+        if name in self.snapshots and self.snapshots[name]["persistent"]:
+            return self.load(name)
+        return self.save(name, persistent=True)
+
+    def adopt(self, name):
+        """Add snapshot name that QEMU already has, e.g. the baseline of a recorded campaign, as persistent"""
+        if name in self.snapshots:
+            return
+        if name not in self.existing():
+            raise SnapshotError(f"snapshot {name} does not exist")
+        self.snapshots[name] = new_entry(persistent=True)
+        self.save_registry()
+
+    def load(self, name):
+        if name not in self.snapshots:
+            raise SnapshotError(f"snapshot {name} is not in the pool")
+        return self.timed(name, "loadvm")
+
+    async def load_qmp(self, name, client):
+        """
+        load() over a qmp.QmpClient, the other tasks of the event loop run during the restore.
+        Uses the snapshot-load job of QEMU >= 6.0 when the server has it, the loadvm monitor command otherwise.
+        """
+        if name not in self.snapshots:
+            raise SnapshotError(f"snapshot {name} is not in the pool")
+        st = time.perf_counter()
+        if self.qmp_jobs is None:
+            commands = await client.execute("query-commands")
+            self.qmp_jobs = any(command["name"] == "snapshot-load" for command in commands)
+        if self.qmp_jobs:
+            await self.load_job(name, client)
+            action = "snapshot-load"
+        else:
+            output = await client.execute("human-monitor-command", {"command-line": f"loadvm {name}"}) or ""
+            if "Error" in output or "does not exist" in output or "not found" in output:
+                raise SnapshotError(f"loadvm {name}: {output.strip()}")
+            action = "loadvm"
+        elapsed = time.perf_counter() - st
+        self.record(name, action, elapsed)
+        return elapsed
+
+    async def load_job(self, name, client):
+        if self.job_nodes is None:
+            # the snapshot is in every writable disk, the vm state in the disk of self.device
+            blocks = [block for block in await client.execute("query-block")
+                      if "inserted" in block and not block["inserted"].get("ro")]
+            if not blocks:
+                raise SnapshotError("no writable block node for snapshot-load")
+            nodes = [block["inserted"]["node-name"] for block in blocks]
+            vmstate = next((block["inserted"]["node-name"] for block in blocks if block["device"] == self.device), nodes[0])
+            self.job_nodes = (vmstate, nodes)
+        vmstate, nodes = self.job_nodes
+        job_id = f"load-{name}-{next(self.job_ids)}"
+        concluded = client.wait_event("JOB_STATUS_CHANGE", lambda message: message["data"]["id"] == job_id
+                                      and message["data"]["status"] == "concluded")
+        await client.execute("snapshot-load", {"job-id": job_id, "tag": name, "vmstate": vmstate, "devices": nodes})
+        await concluded
+        job = next((job for job in await client.execute("query-jobs") if job["id"] == job_id), {})
+        # snapshot jobs are not dismissed automatically
+        await client.execute("job-dismiss", {"id": job_id})
+        if "error" in job:
+            raise SnapshotError(f"snapshot-load {name}: {job['error']}")
+
+    def delete(self, name):
+        self.snapshots.pop(name, None)
+        self.run(f"delvm {name}")
+        print(f"delvm {name}")
+        self.save_registry()
+
+    def report(self):
+        for name, entry in self.snapshots.items():
+            for action in ("save", "load"):
+                count, total, worst = entry[action]
+                if count:
+                    print(f"{name}: {action} x{count} mean {total / count * 1000:.1f} ms max {worst * 1000:.1f} ms")
+
+    def close(self):
+        """Delete the temporary snapshots"""
+        if self.closed:
+            return
+        self.closed = True
+        for name, entry in list(self.snapshots.items()):
+            if not entry["persistent"]:
+                try:
+                    self.delete(name)
+                except Exception as e:
+                    # QEMU is gone, the snapshot went with it unless it lives in a kept overlay
+                    print(f"could not delete snapshot {name}: {e}")
+        self.save_registry()
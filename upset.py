@@ -0,0 +1,110 @@
+# ==============================================================================
+# This file describes multi-bit upsets: a particle strike flips a cluster of
+# cells instead of a single bit. The cluster is computed from the origin
+# (address, bit) of the strike:
+#   single               the origin bit only
+#   bits:<n>             n adjacent bits from the origin bit up, into the next bytes
+#   bytes:<n>            the origin bit in n adjacent bytes
+#   rows:<n>[:<stride>]  the origin bit in n bytes stride bytes apart, the same
+#                        column of adjacent DRAM rows (default stride ROW_STRIDE)
+#
+# A cluster is injected in one stop of the guest: flips close to each other are
+# merged into blocks, every block is read once, written once and verified once.
+# Cells outside the flipped ranges (past the end of RAM, in MMIO or unmapped
+# space) are left out with within(), a write there would fail the campaign.
+#
+# Shared by the host side scripts and gdb/fliputils.py, standard library only.
+# ==============================================================================
+
+import bisect
+
+MODES = ("single", "bits", "bytes", "rows")
+# bytes between the same column of two adjacent rows of a bank, a 8 KiB DRAM page
+ROW_STRIDE = 8192
+# flips less than BLOCK_GAP bytes apart are read and written as one block
+BLOCK_GAP = 64
+
+class Upset:
+    def __init__(self, mode="single", size=1, stride=ROW_STRIDE):
+        assert mode in MODES, "unknown upset mode %s" % mode
+        assert size >= 1 and stride >= 1, "upset size and stride must be >= 1"
+        self.mode = mode
+        self.size = 1 if mode == "single" else size
+        self.stride = stride
+
+    @staticmethod
+    def parse(spec):
+        """Upset of a spec like "single", "bits:3", "bytes:2" or "rows:4:8192", None is single"""
+        if spec is None:
+            return Upset()
+        parts = spec.split(":")
+        assert len(parts) <= (3 if parts[0] == "rows" else 2), "invalid upset %s" % spec
+        return Upset(parts[0], *(int(part, 0) for part in parts[1:]))
+
+    def __str__(self):
+        if self.mode == "single":
+            return "single"
+        if self.mode == "rows":
+            return "rows:%d:%d" % (self.size, self.stride)
+        return "%s:%d" % (self.mode, self.size)
+
+    def cluster(self, address, bit):
+        """(byte address, bit 0-7) of every cell flipped by a strike of bit at address, bit may be >= 8"""
+        address, bit = address + bit // 8, bit % 8
+        if self.mode == "bits":
+            return [(address + (bit + i) // 8, (bit + i) % 8) for i in range(self.size)]
+        if self.mode == "bytes":
+            return [(address + i, bit) for i in range(self.size)]
+        if self.mode == "rows":
+            return [(address + i * self.stride, bit) for i in range(self.size)]
+        return [(address, bit)]
+
+def within(cells, ranges):
+    """The (address, bit) cells inside the sorted, inclusive (start, end) ranges"""
+    kept = []
+    for address, bit in cells:
+        # ranges starting at or before address
+        i = bisect.bisect_right(ranges, (address + 1,)) - 1
+        if i >= 0 and address <= ranges[i][1]:
+            kept.append((address, bit))
+    return kept
+
+def blocks(flips, gap=BLOCK_GAP):
+    """
+    Merge the (address, bit) flips into [(start, length, {address: xor mask})] blocks in address order,
+    flips less than gap bytes apart share a block. Two flips of the same bit cancel out.
+    """
+    masks = {}
+    for address, bit in flips:
+        masks[address] = masks.get(address, 0) ^ (1 << bit)
+    result = []
+    for address in sorted(masks):
+        if not masks[address]:
+            continue
+        if result and address - (result[-1][0] + result[-1][1]) < gap:
+            start, length, block = result[-1]
+            result[-1] = (start, address - start + 1, block)
+        else:
+            result.append((address, 1, {}))
+        result[-1][2][address] = masks[address]
+    return result
+
+def flip_blocks(flips, read, write):
+    """
+    Flip the (address, bit) cells with one read, one write and one verifying read per block.
+
+    :param read: function(address, length) returning the bytes of guest memory
+    :param write: function(address, data) writing guest memory
+    :return: [(address, old byte, new byte)] of every flipped byte, new as read back
+    """
+    changes = []
+    for start, length, masks in blocks(flips):
+        old = bytes(read(start, length))
+        new = bytearray(old)
+        for address, mask in masks.items():
+            new[address - start] ^= mask
+        write(start, bytes(new))
+        readback = bytes(read(start, length))
+        assert readback == new, "mismatched values in block 0x%x+%d" % (start, length)
+        changes.extend((address, old[address - start], readback[address - start]) for address in masks)
+    return changes